@@ -8,6 +8,7 @@ Kisuk Lee <kisuklee@mit.edu>, 2017
 
 import data_augmentation
 import numpy as np
+from utils import writable
 from scipy.ndimage.filters import gaussian_filter
 
 class BlurAugment(data_augmentation.DataAugment):
@@ -34,14 +35,14 @@ class BlurAugment(data_augmentation.DataAugment):
 
     def augment(self, sample, **kwargs):
         """Apply out-of-focus section data augmentation."""
-        if np.random.rand() > self.skip_ratio:
+        if self.rng.rand() > self.skip_ratio:
             sample = self._do_augment(sample, **kwargs)
         return sample
 
     def _do_augment(self, sample, **kwargs):
         """Apply out-of-section section data augmentation."""
         # Randomly draw the number of sections to introduce.
-        num_sec = np.random.randint(1, self.MAX_SEC + 1)
+        num_sec = self.rng.randint(1, self.MAX_SEC + 1)
 
         # DEBUG(kisuk)
         # print "num_sec = %d" % num_sec
@@ -51,6 +52,7 @@ class BlurAugment(data_augmentation.DataAugment):
         imgs = kwargs['imgs']
         dims = set([])
         for key in imgs:
+            sample[key] = writable(sample[key])
             dim = self.spec[key][-3:]
             assert num_sec < dim[-3]
             dims.add(dim)
@@ -61,13 +63,13 @@ class BlurAugment(data_augmentation.DataAugment):
         zdim = dim[-3]
 
         # Randomly draw z-slices to blur.
-        zlocs = np.random.choice(zdim, num_sec, replace=False)
+        zlocs = self.rng.choice(zdim, num_sec, replace=False)
 
         # Apply full or partial missing sections according to the mode.
         if self.mode == 'full':
             for z in zlocs:
                 for key in imgs:
-                    sigma = np.random.rand() * self.sigma_max
+                    sigma = self.rng.rand() * self.sigma_max
                     img = sample[key][...,z,:,:]
                     sample[key][...,z,:,:] = gaussian_filter(img, sigma=sigma)
                     # DEBUG(kisuk)
@@ -75,7 +77,7 @@ class BlurAugment(data_augmentation.DataAugment):
         else:
             for z in zlocs:
                 # Random sigma.
-                sigma = np.random.rand() * self.sigma_max
+                sigma = self.rng.rand() * self.sigma_max
                 # DEBUG(kisuk)
                 # print 'z = {}, sigma = {}'.format(z,sigma)
                 # Blurring.
@@ -83,14 +85,14 @@ class BlurAugment(data_augmentation.DataAugment):
                     img = sample[key][...,z,:,:]
                     img = gaussian_filter(img, sigma=sigma)
                     # Full or partial?
-                    if self.mode == 'mix' and np.random.rand() > 0.5:
+                    if self.mode == 'mix' and self.rng.rand() > 0.5:
                         # Full image blurring.
                         sample[key][...,z,:,:] = img
                     else:
                         # Draw a random xy-coordinate.
-                        x = np.random.randint(0, xdim)
-                        y = np.random.randint(0, ydim)
-                        rule = np.random.rand(4) > 0.5
+                        x = self.rng.randint(0, xdim)
+                        y = self.rng.randint(0, ydim)
+                        rule = self.rng.rand(4) > 0.5
                         # 1st quadrant.
                         if rule[0]:
                             sample[key][...,z,:y,:x] = img[...,:y,:x]
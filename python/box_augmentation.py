@@ -10,6 +10,7 @@ from box import *
 import data_augmentation
 import math
 import numpy as np
+from utils import writable
 
 class BoxAugment(data_augmentation.DataAugment):
     """
@@ -37,7 +38,7 @@ class BoxAugment(data_augmentation.DataAugment):
 
     def augment(self, sample, **kwargs):
         """Apply box data augmentation."""
-        if np.random.rand() > self.skip_ratio:
+        if self.rng.rand() > self.skip_ratio:
             sample = self._do_augment(sample, **kwargs)
         return sample
 
@@ -58,18 +59,19 @@ class BoxAugment(data_augmentation.DataAugment):
         self.dim    = bbox.size()
 
         for key in imgs:
+            sample[key] = writable(sample[key])
             # Random box augmentation.
             count = 0
-            goal  = bbox.volume()*self.density*np.random.rand()
+            goal  = bbox.volume()*self.density*self.rng.rand()
             while True:
                 # Random location.
                 m = self.min_dim  # Margin.
-                z = np.random.randint(0, self.dim[0])
-                y = np.random.randint(0, self.dim[1])
-                x = np.random.randint(0, self.dim[2])
+                z = self.rng.randint(0, self.dim[0])
+                y = self.rng.randint(0, self.dim[1])
+                x = self.rng.randint(0, self.dim[2])
                 loc = Vec3d(z,y,x) + self.offset
                 # Random box size.
-                dim = np.random.randint(self.min_dim, self.max_dim + 1, 3)
+                dim = self.rng.randint(self.min_dim, self.max_dim + 1, 3)
                 # Anisotropy.
                 dim[0] /= int(self.aspect_ratio)
                 # Box.
@@ -78,7 +80,7 @@ class BoxAugment(data_augmentation.DataAugment):
                 box.translate(-self.offset)
                 vmin = box.min()
                 vmax = box.max()
-                val = np.random.rand() if self.random_color else 0  # Fill-out value.
+                val = self.rng.rand() if self.random_color else 0  # Fill-out value.
                 sample[key][...,vmin[0]:vmax[0],vmin[1]:vmax[1],vmin[2]:vmax[2]] = val
                 # Stop condition.
                 count += box.volume()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Pool of reusable sample buffers.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+from collections import defaultdict, Mapping
+import threading
+import weakref
+
+import numpy as np
+
+class BufferPool(object):
+    """
+    Pool of numpy arrays keyed by (shape, dtype).
+
+    Sampling stages draw output arrays with empty or zeros, and arrays are
+    returned to the pool with release once the consumer is done with them.
+    Only arrays drawn from this pool are ever taken back, so that releasing
+    a view or someone else's array is harmless.
+
+    Attributes:
+        max_per_key: Maximum number of free arrays kept per (shape, dtype).
+    """
+
+    def __init__(self, max_per_key=4):
+        self.max_per_key = max_per_key
+        self._free = defaultdict(list)
+        self._out  = weakref.WeakValueDictionary()  # Arrays drawn, by id.
+        self._lock = threading.Lock()
+        self._hits   = 0
+        self._misses = 0
+
+    def empty(self, shape, dtype='float32'):
+        """Return an uninitialized array of shape and dtype."""
+        shape = tuple(int(x) for x in shape)
+        key = (shape, np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key, None)
+            if free:
+                ret = free.pop()
+                self._hits += 1
+            else:
+                ret = None
+                self._misses += 1
+        if ret is None:
+            ret = np.empty(shape, dtype=dtype)
+        with self._lock:
+            self._out[id(ret)] = ret
+        return ret
+
+    def zeros(self, shape, dtype='float32'):
+        """Return a zero-filled array of shape and dtype."""
+        ret = self.empty(shape, dtype)
+        ret.fill(0)
+        return ret
+
+    def release(self, data):
+        """
+        Return an array, or every array in a sample (dictionary), to the pool.
+        The caller must not use them, or any view of them, afterwards.
+        """
+        if isinstance(data, Mapping):
+            for v in data.values():
+                self.release(v)
+            return
+        if not isinstance(data, np.ndarray):
+            return
+        with self._lock:
+            if self._out.get(id(data), None) is not data:
+                return
+            del self._out[id(data)]
+            free = self._free[(data.shape, data.dtype.str)]
+            if len(free) < self.max_per_key:
+                free.append(data)
+
+    def recycle(self, old, new):
+        """
+        Release the arrays of sample old that are no longer referenced by
+        sample new, either directly or through a view.
+        """
+        arrs = [v for v in new.values() if isinstance(v, np.ndarray)]
+        for v in old.values():
+            if not isinstance(v, np.ndarray):
+                continue
+            if any(v is a or np.may_share_memory(v, a) for a in arrs):
+                continue
+            self.release(v)
+
+    def hit_rate(self):
+        """Return the fraction of requests served from the pool."""
+        total = self._hits + self._misses
+        return self._hits / float(total) if total > 0 else 0.0
+
+    def stats(self):
+        """Return pool statistics."""
+        with self._lock:
+            free = sum(len(v) for v in self._free.itervalues())
+            return dict(hits=self._hits, misses=self._misses, free=free,
+                        hit_rate=self.hit_rate())
+
+
+####################################################################
+## Process-wide pool, used by sampling stages if set.
+####################################################################
+
+_pool = None
+
+def set_pool(pool):
+    """Set the process-wide BufferPool (None to disable pooling)."""
+    global _pool
+    _pool = pool
+
+def get_pool():
+    return _pool
+
+def empty(shape, dtype='float32'):
+    if _pool is None:
+        return np.empty(shape, dtype=dtype)
+    return _pool.empty(shape, dtype)
+
+def zeros(shape, dtype='float32'):
+    if _pool is None:
+        return np.zeros(shape, dtype=dtype)
+    return _pool.zeros(shape, dtype)
+
+def release(data):
+    if _pool is not None:
+        _pool.release(data)
+
+def recycle(old, new):
+    if _pool is not None:
+        _pool.recycle(old, new)
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    ####################################################################
+    class UnitTestBufferPool(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testReuse(self):
+            pool = BufferPool(max_per_key=2)
+            a = pool.empty((2,3), 'float32')
+            pool.release(a)
+            # Same shape and dtype are served from the pool.
+            self.assertTrue(pool.empty((2,3), 'float32') is a)
+            self.assertFalse(pool.empty((2,3), 'float32') is a)
+            self.assertFalse(pool.empty((2,3), 'uint8') is a)
+            z = pool.zeros((2,3))
+            self.assertTrue(np.all(z == 0))
+            self.assertEqual(pool.stats()['hits'], 1)
+            self.assertEqual(pool.stats()['misses'], 4)
+
+        def testMaxPerKey(self):
+            pool = BufferPool(max_per_key=2)
+            arrs = [pool.empty((4,)) for _ in xrange(3)]
+            pool.release(dict(a=arrs[0], b=arrs[1], c=arrs[2]))
+            self.assertEqual(pool.stats()['free'], 2)
+
+        def testGuard(self):
+            pool = BufferPool()
+            a = pool.empty((4,4))
+            # Views, foreign arrays, and non-arrays are never taken.
+            pool.release(a[1:])
+            pool.release(np.empty((4,4), dtype='float32'))
+            pool.release(None)
+            self.assertEqual(pool.stats()['free'], 0)
+            # Released once, however many times released.
+            pool.release(a)
+            pool.release(a)
+            self.assertEqual(pool.stats()['free'], 1)
+            self.assertTrue(pool.empty((4,4)) is a)
+            self.assertFalse(pool.empty((4,4)) is a)
+
+        def testRecycle(self):
+            pool = BufferPool()
+            a, b, c = [pool.empty((4,4)) for _ in xrange(3)]
+            old = dict(x=a, y=b, z=c)
+            new = dict(x=a, y=b[:2])  # a kept, b viewed, c dropped.
+            pool.recycle(old, new)
+            self.assertEqual(pool.stats()['free'], 1)
+            self.assertTrue(pool.empty((4,4)) is c)
+
+        def testProcessPool(self):
+            self.assertTrue(get_pool() is None)
+            a = empty((2,2))
+            release(a)  # No pool.
+            pool = BufferPool()
+            set_pool(pool)
+            try:
+                a = empty((2,2))
+                release(a)
+                self.assertTrue(zeros((2,2)) is a)
+                self.assertTrue(np.all(a == 0))
+            finally:
+                set_pool(None)
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+__doc__ = """
+
+On-disk cache of preprocessed volumes.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+class VolumeCache(object):
+    """
+    Content-addressed cache of preprocessed volumes.
+
+    Each entry is a numpy (.npy) file named by a hash of the source file path,
+    its modification time, the preprocessing spec, and the source data type.
+    Entries are memory-mapped read-only when reused. Least recently used
+    entries are evicted when the total size exceeds the size cap.
+
+    Attributes:
+        cache_dir: Cache directory.
+        max_size:  Maximum total size of the cache in bytes (None: no cap).
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """Initialize VolumeCache."""
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created concurrently by another process.
+                assert os.path.isdir(cache_dir)
+
+    def key(self, fname, preprocess, dtype, zrange=None):
+        """
+        Return a cache key for preprocessing fname with preprocess, or its
+        z-slices in zrange if given.
+        """
+        fname = os.path.abspath(fname)
+        mtime = os.path.getmtime(fname)
+        spec  = [sorted(pp.items()) for pp in preprocess]
+        dtype = np.dtype(dtype).str
+        ident = (fname, mtime, spec, dtype)
+        if zrange is not None:
+            ident += (tuple(zrange),)
+        return hashlib.sha1(repr(ident)).hexdigest()
+
+    def get(self, key):
+        """Return the cached volume (numpy.memmap), or None if missing."""
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except IOError:
+            return None
+        # Mark as recently used.
+        os.utime(path, None)
+        return data
+
+    def put(self, key, data):
+        """Store data, and return its memory-mapped copy."""
+        path = self._path(key)
+        # Write to a temporary file first, then rename atomically, so that
+        # concurrent readers never see a partially written entry.
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.rename(tmp, path)
+        self._evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until under the size cap."""
+        if self.max_size is None:
+            return
+        entries = list()
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Evicted concurrently.
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+if __name__ == "__main__":
+
+    import shutil
+    import tempfile
+    import time
+    import unittest
+
+    ####################################################################
+    class UnitTestVolumeCache(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.src = os.path.join(self.dir, 'src.npy')
+            np.save(self.src, np.zeros((4,4,4)))
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def testPutGet(self):
+            cache = VolumeCache(os.path.join(self.dir, 'cache'))
+            key = cache.key(self.src, [{'type':'standardize'}], 'float32')
+            self.assertTrue(cache.get(key) is None)
+            data = np.random.rand(2,3,4)
+            cached = cache.put(key, data)
+            self.assertTrue(np.array_equal(data, cached))
+            cached = cache.get(key)
+            self.assertTrue(isinstance(cached, np.memmap))
+            self.assertTrue(np.array_equal(data, cached))
+            self.assertFalse(cached.flags.writeable)
+
+        def testKey(self):
+            cache = VolumeCache(os.path.join(self.dir, 'cache'))
+            pp = [{'type':'standardize','mode':'2D'}]
+            key = cache.key(self.src, pp, 'float32')
+            # Independent of the order of preprocessing options.
+            pp2 = [{'mode':'2D','type':'standardize'}]
+            self.assertEqual(key, cache.key(self.src, pp2, 'float32'))
+            self.assertNotEqual(key, cache.key(self.src, pp, 'uint8'))
+            self.assertNotEqual(key, cache.key(self.src, pp + pp, 'float32'))
+            # Modifying the source invalidates the key.
+            mtime = os.path.getmtime(self.src)
+            os.utime(self.src, (mtime + 10, mtime + 10))
+            self.assertNotEqual(key, cache.key(self.src, pp, 'float32'))
+
+        def testEvictLeastRecentlyUsed(self):
+            data = np.zeros((16,16,16), dtype='uint8')
+            nbytes = data.nbytes + 128  # With npy header.
+            cache = VolumeCache(os.path.join(self.dir, 'cache'),
+                                max_size=2*nbytes)
+            now = time.time()
+            for i, key in enumerate(['a','b']):
+                cache.put(key, data)
+                path = cache._path(key)
+                os.utime(path, (now - 100 + i, now - 100 + i))
+            # Using 'a' makes 'b' the least recently used.
+            self.assertTrue(cache.get('a') is not None)
+            cache.put('c', data)
+            self.assertTrue(cache.get('a') is not None)
+            self.assertTrue(cache.get('b') is None)
+            self.assertTrue(cache.get('c') is not None)
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -6,9 +6,10 @@ ConfigData classes.
 Kisuk Lee <kisuklee@mit.edu>, 2016
 """
 
-import copy
 import numpy as np
 
+from cache import VolumeCache
+from sample import FrozenDict
 import emio
 from tensor import TensorData
 from transform import *
@@ -38,10 +39,37 @@ class ConfigData(TensorData):
         """Prepare data from config."""
         assert config.has_section(section)
 
+        # Offset.
+        if config.has_option(section, 'offset'):
+            offset = config.get(section, 'offset')
+            # Ensure that offset is tuple.
+            offset = tuple(eval(str(offset)))
+        else:
+            offset = (0,0,0)
+
         # Either read data from the specified file, or generate data with the
         # specified shape and filler.
+        zrange = None
         if config.has_option(section, 'file'):
-            data = emio.imread(config.get(section, 'file'))
+            fname = config.get(section, 'file')
+            # Lazy data is read patch by patch on demand. Data whose
+            # preprocessing result may be cached is opened first, and read
+            # only on a cache miss. Data cropped to a z-range is read at once.
+            lazy = config.has_option(section, 'lazy') and \
+                   config.getboolean(section, 'lazy')
+            cached = config.has_option(section, 'cache_dir') and \
+                     config.has_option(section, 'preprocess')
+            if lazy:
+                data = emio.imopen(fname)
+            elif config.has_option(section, 'zrange'):
+                zrange = self._zrange(config, section, emio.imshape(fname),
+                                      offset)
+                data = emio.imread(fname, zrange=zrange)
+                offset = (offset[0] + zrange[0],) + offset[1:]
+            elif cached:
+                data = emio.imopen(fname)
+            else:
+                data = emio.imread(fname)
         elif config.has_option(section, 'shape'):
             shape = config.get(section, 'shape')
             # Ensure that shape is tuple.
@@ -62,14 +90,6 @@ class ConfigData(TensorData):
         else:
             fov = (0,0,0)
 
-        # Offset.
-        if config.has_option(section, 'offset'):
-            offset = config.get(section, 'offset')
-            # Ensure that offset is tuple.
-            offset = tuple(eval(str(offset)))
-        else:
-            offset = (0,0,0)
-
         # List of global preprocessing.
         if config.has_option(section, 'preprocess'):
             preprocess = config.get(section, 'preprocess').split('\n')
@@ -82,13 +102,63 @@ class ConfigData(TensorData):
             assert isinstance(pp, dict)
             assert 'type' in pp
 
-        # Perform preprocessing seequentially.
-        data = check_tensor(data)
+        # Reuse the cached result of preprocessing, if any.
+        cache, key = self._get_cache(config, section, data, preprocess,
+                                     zrange)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                print 'reusing cached [%s] (%s)' % (section, key)
+                return cached, fov, offset
+
+        # Perform preprocessing seequentially. Lazy data is kept on disk,
+        # unless preprocessing requires the whole volume.
+        if isinstance(data, np.ndarray) or len(preprocess) > 0:
+            data = check_tensor(np.asarray(data))
         for pp in preprocess:
             data = tensor_func.evaluate(data, pp)
 
+        # Cache the result of preprocessing.
+        if cache is not None:
+            data = cache.put(key, data)
+
         return data, fov, offset
 
+    def _zrange(self, config, section, shape, offset):
+        """
+        Return the z-slices [z0,z1) of a file of shape within the zrange
+        option of section, given in the global coordinate system.
+        Preprocessing is then applied to the slices only, so that zrange is
+        set only for data of slice-local preprocessing (see shard.crop).
+        """
+        z0, z1 = eval(str(config.get(section, 'zrange')))
+        dim = shape[-3]
+        z0 = min(max(z0 - offset[0], 0), dim)
+        z1 = min(max(z1 - offset[0], z0), dim)
+        if z1 <= z0:
+            raise RuntimeError('[%s] has no slice in zrange.' % section)
+        return z0, z1
+
+    def _get_cache(self, config, section, data, preprocess, zrange=None):
+        """
+        Return the preprocessing cache and the cache key for data, or
+        (None, None) if caching is not applicable.
+        """
+        if not config.has_option(section, 'cache_dir'):
+            return None, None
+        # Only preprocessed data read from file is cached.
+        if not config.has_option(section, 'file') or len(preprocess) == 0:
+            return None, None
+        cache_dir = config.get(section, 'cache_dir')
+        if config.has_option(section, 'cache_size'):
+            max_size = eval(str(config.get(section, 'cache_size')))
+        else:
+            max_size = None
+        cache = VolumeCache(cache_dir, max_size=max_size)
+        key = cache.key(config.get(section, 'file'), preprocess, data.dtype,
+                        zrange=zrange)
+        return cache, key
+
 
 class ConfigLabel(ConfigData):
     """
@@ -104,7 +174,8 @@ class ConfigLabel(ConfigData):
         self._transformation(config, section)
 
     def get_transform(self):
-        return copy.deepcopy(self._transform)
+        """Return transform (immutable FrozenDict), or None."""
+        return self._transform
 
     ####################################################################
     ## Private Helper Methods
@@ -124,5 +195,6 @@ class ConfigLabel(ConfigData):
         if transform is not None:
             assert isinstance(transform, dict)
             assert 'type' in transform
+            transform = FrozenDict(sorted(transform.items()))
 
         self._transform = transform
@@ -6,9 +6,12 @@ DataAugmentor
 Kisuk Lee <kisuklee@mit.edu>, 2016
 """
 
-from collections import OrderedDict
 import numpy as np
+import buffer_pool
+import replay
 from transform import *
+from utils import writable
+from vector import Vec3d, maximum
 
 """
 Data augmentaion pool.
@@ -23,16 +26,39 @@ class DataAugmentor(object):
     """
     Data augmentation.
 
+    Augmentation parameters enlarging sample size (e.g. warp, misalignment)
+    are drawn within the slack of the valid range of each dataset, so that
+    the prepared spec is feasible. Whenever it is not, the whole chain is
+    redrawn at most max_retries times.
+
+    With a replay buffer (see replay.py), random samples are either read in
+    the largest size required so far and buffered, or replayed from the
+    buffer, and then cropped to the prepared spec before augmentation.
+
     Attributes:
-        _aug_list: List of data augmentation. Will be executed sequentially.
+        _aug_list:   List of data augmentation. Will be executed sequentially.
+        max_retries: Maximum number of redraws of an infeasible chain.
+        stats:       Dictionary counting samples and retries.
+        rng:         Random number source, numpy.random by default.
     """
 
-    def __init__(self, spec):
+    # Class attribute, so that the default need not be copied or pickled.
+    rng = np.random
+
+    def __init__(self, spec, rng=None, max_retries=10, replay=None):
         """
         TODO(kisuk): Documentation.
+
+        Args:
+            spec: List of data augmentation specs.
+            rng:  Random number source (numpy.random if None, or
+                  RandomContext) shared by every data augmentation.
+            max_retries: Maximum number of redraws of an infeasible chain.
+            replay: Optional ReplayBuffer for random samples.
         """
         aug_list = []
         for s in spec:
+            s = dict(s)  # Keep the user's spec intact.
             t = s['type']
             del s['type']
             t = t.lower()
@@ -42,43 +68,165 @@ class DataAugmentor(object):
             aug = eval(t + '(**s)')
             aug_list.append(aug)
         self._aug_list = aug_list
+        self.max_retries = max_retries
+        self.stats = dict(samples=0, retries=0)
+        self.replay = replay
+        if rng is not None:
+            self.set_rng(rng)
+
+    def set_rng(self, rng):
+        """Set random number source of every data augmentation."""
+        self.rng = rng
+        for aug in self._aug_list:
+            aug.set_rng(rng)
 
-    def next_sample(self, dataset):
-        raise NotImplementedError
+    def next_sample(self, dataset, index=None):
+        """
+        Fetch next sample in a sample sequence, and apply data augmentation.
+        Augmentation is prepared within the slack around the lattice point,
+        so that the point stays within the valid range.
 
-    def random_sample(self, dataset):
+        Args:
+            dataset: VolumeDataset.
+            index:   Optional lattice index (see VolumeDataset.next_sample).
+        """
+        pos = dataset.next_location(index)
+        spec = self._prepare(dataset, dataset.slack(pos))
+        self.stats['samples'] += 1
+        sample, transform = dataset.next_sample(spec=spec, pos=pos)
+        return self.augment(dataset, sample), transform
+
+    def random_sample(self, dataset, loc=None, center=False):
         """
         TODO(kisuk): Documentation.
+
+        Args:
+            dataset: VolumeDataset.
+            loc:     Optional 3 uniform random numbers in [0,1), from which
+                     sample location is determined (see VolumeDataset).
+                     A replayed sample ignores loc.
+            center:  Whether to return the sample center as well.
+
+        Returns:
+            (sample, transform), or (sample, transform, center) if center.
         """
-        # Tolerant to failure due to data augmentation.
-        while True:
-            try:
-                spec = self._prepare(dataset)
-                sample, transform = dataset.random_sample(spec=spec)
-                break
-            except:
-                pass
+        ret = self.read(dataset, loc=loc, center=center)
+        return (self.augment(dataset, ret[0]),) + ret[1:]
 
-        # Apply data augmentation.
+    def read(self, dataset, loc=None, center=False):
+        """
+        Prepare data augmentation, and read a raw random sample of the
+        prepared spec, which is to be passed to augment before the next read.
+
+        Args:
+            dataset: VolumeDataset.
+            loc:     Optional 3 uniform random numbers in [0,1) (see
+                     random_sample).
+            center:  Whether to return the sample center as well.
+
+        Returns:
+            sample:    Raw sample.
+            transform: Label transform of sample.
+            center:    Sample center (global coordinate system), if center.
+        """
+        # Locations are drawn from the random stream of this augmentor, so
+        # that copies in several threads never share one.
+        fetch = lambda spec: dataset.random_sample(spec=spec, loc=loc,
+                                                   center=True, rng=self.rng)
+        if self.replay is None:
+            ret = fetch(self._feasible_spec(dataset))
+        else:
+            ret = self._replay_read(dataset, fetch)
+        return ret if center else ret[:2]
+
+    def augment(self, dataset, sample):
+        """Apply data augmentation prepared by the last read."""
         for aug in self._aug_list:
+            old = dict(sample)
             sample = aug.augment(sample, imgs=dataset.get_imgs())
+            buffer_pool.recycle(old, sample)
 
-        # Ensure that sample is ordered by key.
-        sample = OrderedDict(sorted(sample.items(), key=lambda x: x[0]))
-        return sample, transform
+        # Sample is ordered by key (see sample.Sample).
+        return sample
+
+    def retry_rate(self):
+        """Return the average number of retries per sample."""
+        return self.stats['retries'] / float(max(self.stats['samples'], 1))
+
+    def _replay_read(self, dataset, fetch):
+        """Replay a buffered raw sample, or fetch one with fetch(spec)."""
+        rng = self.rng
+        entry = self.replay.draw(dataset, rng.rand(), rng.rand())
+        if entry is not None:
+            raw, transform, slack, pos = entry
+            spec = self._prepare(dataset, slack)
+            self.stats['samples'] += 1
+        else:
+            spec = self._feasible_spec(dataset)
+            base = dataset.get_spec()
+            big  = self.replay.enlarge(dataset, base, spec)
+            if dataset.valid_range(big) is None:
+                big = spec
+            raw, transform, pos = fetch(big)
+            self.replay.put(dataset, base, raw, transform, rng.rand(), pos)
+        # Center-cropping keeps the sample center.
+        return replay.crop(raw, spec), transform, pos
+
+    def _feasible_spec(self, dataset):
+        """Prepare a spec feasible for dataset, redrawing if necessary."""
+        for i in xrange(self.max_retries + 1):
+            spec = self._prepare(dataset)
+            if dataset.valid_range(spec) is not None:
+                break
+            self.stats['retries'] += 1
+        else:
+            raise RuntimeError('infeasible data augmentation after %d '
+                               'retries' % self.max_retries)
+        self.stats['samples'] += 1
+        return spec
+
+    def _prepare(self, dataset, slack=None):
+        """
+        Prepare spec by every data augmentation in the reverse order.
 
-    def _prepare(self, dataset):
-        ret = dict(dataset.get_spec())
+        Args:
+            dataset: VolumeDataset.
+            slack:   Maximum enlargement of sample size. Defaults to what the
+                     valid range allows.
+        """
+        ret = dataset.get_spec()  # Immutable, never modified by prepare.
+        # Maximum enlargement of sample size.
+        if slack is None:
+            slack = dataset.get_range().size() - (1,1,1)
         for aug in reversed(self._aug_list):
-            ret = aug.prepare(ret, imgs=dataset.get_imgs(), **dataset.params)
+            old = ret
+            ret = aug.prepare(ret, imgs=dataset.get_imgs(), slack=slack,
+                              **dataset.params)
+            # Subtract the largest enlargement by aug from the slack.
+            e = Vec3d(0,0,0)
+            for k, v in ret.iteritems():
+                e = maximum(e, Vec3d(v[-3:]) - Vec3d(old[k][-3:]))
+            slack = slack - e
         return ret
 
 
 class DataAugment(object):
     """
     DataAugment interface.
+
+    prepare receives the remaining slack (Vec3d) in kwargs['slack'], i.e.
+    the maximum enlargement of sample size that keeps the spec feasible.
+
+    Attributes:
+        rng: Random number source, numpy.random by default (see rng.py).
     """
 
+    # Class attribute, so that the default need not be copied or pickled.
+    rng = np.random
+
+    def set_rng(self, rng):
+        self.rng = rng
+
     def prepare(self, spec, **kwargs):
         raise NotImplementedError
 
@@ -95,7 +243,7 @@ class FlipAugment(DataAugment):
         return dict(spec)
 
     def augment(self, sample, **kwargs):
-        rule = np.random.rand(4) > 0.5
+        rule = self.rng.rand(4) > 0.5
         return sample_func.flip(sample, rule=rule)
 
 
@@ -125,9 +273,9 @@ class GreyAugment(DataAugment):
     def augment(self, sample, **kwargs):
         #print '\n[GreyAugment]'  # DEBUG
         ret = sample
-        if np.random.rand() > self.ratio:
+        if self.rng.rand() > self.ratio:
             if self.mode == 'mix':
-                mode = '3D' if np.random.rand() > 0.5 else '2D'
+                mode = '3D' if self.rng.rand() > 0.5 else '2D'
             else:
                 mode = self.mode
             ret = eval('self.augment{}(sample, **kwargs)'.format(mode))
@@ -142,12 +290,16 @@ class GreyAugment(DataAugment):
         # Greyscale augmentation.
         imgs = kwargs['imgs']
         for key in imgs:
-            for z in xrange(sample[key].shape[-3]):
+            sample[key] = writable(sample[key])
+            # Draw random numbers for every section at once.
+            zdim = sample[key].shape[-3]
+            r = self.rng.rand(zdim, 3)
+            for z in xrange(zdim):
                 img = sample[key][...,z,:,:]
-                img *= 1 + (np.random.rand() - 0.5)*self.CONTRAST_FACTOR
-                img += (np.random.rand() - 0.5)*self.BRIGHTNESS_FACTOR
+                img *= 1 + (r[z,0] - 0.5)*self.CONTRAST_FACTOR
+                img += (r[z,1] - 0.5)*self.BRIGHTNESS_FACTOR
                 img = np.clip(img, 0, 1)
-                img **= 2.0**(np.random.rand()*2 - 1)
+                img **= 2.0**(r[z,2]*2 - 1)
                 sample[key][...,z,:,:] = img
 
         return sample
@@ -161,10 +313,11 @@ class GreyAugment(DataAugment):
         # Greyscale augmentation.
         imgs = kwargs['imgs']
         for key in imgs:
-            sample[key] *= 1 + (np.random.rand() - 0.5)*self.CONTRAST_FACTOR
-            sample[key] += (np.random.rand() - 0.5)*self.BRIGHTNESS_FACTOR
+            sample[key] = writable(sample[key])
+            sample[key] *= 1 + (self.rng.rand() - 0.5)*self.CONTRAST_FACTOR
+            sample[key] += (self.rng.rand() - 0.5)*self.BRIGHTNESS_FACTOR
             sample[key] = np.clip(sample[key], 0, 1)
-            sample[key] **= 2.0**(np.random.rand()*2 - 1)
+            sample[key] **= 2.0**(self.rng.rand()*2 - 1)
 
         return sample
 
@@ -6,13 +6,34 @@ DaraProvider classes.
 Kisuk Lee <kisuklee@mit.edu>, 2015-2016
 """
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import shutil
+import tempfile
+import threading
 import numpy as np
+import buffer_pool
+import emio
 import parser
+import shard
+from config_data import ConfigData
 from dataset import VolumeDataset
 from data_augmentation import DataAugmentor
 from transform import *
 from label_transform import *
+from location_index import FeistelPermutation
+from replay import ReplayBuffer
+from rng import RandomContext
+from stream import LookAhead, Pipeline
+
+# Guards the lazy start of executors (see random_sample_async).
+_executor_lock = threading.Lock()
+
 
 class DataProvider(object):
     """
@@ -25,6 +46,10 @@ class DataProvider(object):
     def random_sample(self):
         raise NotImplementedError
 
+    def release(self, sample):
+        """Release a sample no longer in use. Nothing to do by default."""
+        pass
+
 
 class VolumeDataProvider(DataProvider):
     """
@@ -32,11 +57,15 @@ class VolumeDataProvider(DataProvider):
 
     Attributes:
         datasets: List of datasets.
+        rng: Random number source (numpy.random or RandomContext).
         _sampling_weights: Probability of each dataset being chosen at each
                             iteration.
         _net_spec: Dictionary mapping layers' name to their input dimension.
     """
 
+    # Class attribute, numpy.random unless set_rng is called.
+    rng = np.random
+
     def __init__(self, dspec_path, net_spec, params, auto_mask=True):
         """
         Initialize DataProvider.
@@ -47,6 +76,57 @@ class VolumeDataProvider(DataProvider):
             params:     Various options.
             auto_mask:  Whether to automatically generate mask from
                         corresponding label.
+
+        Datasets are built concurrently if params['build_workers'] > 1, on a
+        thread pool (params['build_mode']='thread', default). With
+        params['build_mode']='process', preprocessing runs on a process pool
+        first, and writes to the preprocessing cache (params['cache'], or a
+        temporary directory removed after building), from which datasets
+        are then built on a thread pool as memory-mapped volumes.
+
+        params['class_sampling'], if given as dict(key=..., mixture=...),
+        makes every dataset draw sample locations from a label class mixture
+        (see VolumeDataset.build_class_index). An optional 'max_count' caps
+        the number of voxels indexed per class.
+
+        params['min_coverage'], if given, makes every dataset draw sample
+        locations only where every mask covers at least that fraction of the
+        patch (see VolumeDataset.build_coverage_index).
+
+        params['view'], if True, makes every dataset extract patches as
+        read-only views instead of copies (see VolumeDataset.set_view).
+
+        params['buffer_pool'], if given as the maximum number of free arrays
+        per (shape, dtype), sets a process-wide buffer pool, from which
+        sampling stages draw their output arrays (see buffer_pool.py). Call
+        release on each sample when done with it.
+
+        params['replay'], if given as dict(capacity=..., reuse=...), keeps a
+        replay buffer of raw samples per dataset, from which random samples
+        are re-augmented with probability reuse (see replay.py).
+
+        params['async_workers'] (default 2) and params['async_window']
+        (default twice the workers) set the executor of random_sample_async.
+
+        params['stride'], if given, sets the stride of the lattice traversed
+        by next_sample (see VolumeDataset.set_lattice). Default is (1,1,1).
+
+        Random numbers are drawn from numpy.random, unless params['seed'] is
+        given. Then a RandomContext seeded with params['seed'] (and
+        params['worker_id'], if any) is shared by the whole sampling stack.
+
+        params['world_size'] > 1 shards drange across ranks, and only the
+        share of params['rank'] is built (see shard.py). Every dataset is
+        split into params['shard_blocks'] blocks along z (by default, only if
+        there are fewer datasets than ranks), and each block is assigned to
+        params['shard_replicas'] ranks (default 1, i.e. disjoint shares),
+        balancing the number of samples estimated without reading volumes.
+        Every rank computes the same assignment. A rank reads only the
+        z-slices around its blocks, plus params['shard_margin'] slices on
+        both sides (default 0) for data augmentation enlarging samples (see
+        shard.crop). Blocks of a dataset are restricted views of one dataset
+        built once (see VolumeDataset.restrict). dprior, if given, is for
+        the whole drange.
         """
         # Params.
         drange = params['drange']            # Required.
@@ -55,19 +135,49 @@ class VolumeDataProvider(DataProvider):
         # Build Datasets.
         print '\n[VolumeDataProvider]'
         p = parser.Parser(dspec_path, net_spec, params, auto_mask=auto_mask)
-        self.datasets = list()
-        for d in drange:
-            print 'constructing dataset %d...' % d
-            config, dparams = p.parse_dataset(d)
-            dataset = VolumeDataset(config, **dparams)
-            self.datasets.append(dataset)
+        args = [(d,) + p.parse_dataset(d) + (params, None) for d in drange]
+        if params.get('world_size', 1) > 1:
+            args, dprior = self._shard(args, dprior, params)
+        datasets = self._build_datasets(args, params)
+        self.datasets = [x for ds in datasets for x in ds]
 
         # Sampling weight.
         self.set_sampling_weights(dprior)
 
         # Setup data augmentation.
         aug_spec = params.get('augment', [])  # Default is an empty list.
-        self._data_aug = DataAugmentor(aug_spec)
+        rb = params.get('replay', None)
+        rb = None if rb is None else ReplayBuffer(**rb)
+        self._data_aug = DataAugmentor(aug_spec, replay=rb)
+
+        # Shuffled order of next_sample, drawn at first use.
+        self._order = None
+
+        # Executor of random_sample_async, started at first use.
+        self._async_workers = params.get('async_workers', 2)
+        self._async_window  = params.get('async_window',
+                                         2*self._async_workers)
+        self._executor = None
+
+        # Buffer pool.
+        max_per_key = params.get('buffer_pool', None)
+        if max_per_key is not None and buffer_pool.get_pool() is None:
+            buffer_pool.set_pool(buffer_pool.BufferPool(max_per_key))
+
+        # Random number source.
+        seed = params.get('seed', None)
+        if seed is not None:
+            self.set_rng(RandomContext(seed, params.get('worker_id', None)))
+
+    def set_rng(self, rng):
+        """
+        Set random number source (numpy.random or RandomContext) of the
+        provider, datasets, and data augmentation.
+        """
+        self.rng = rng
+        for dataset in self.datasets:
+            dataset.set_rng(rng)
+        self._data_aug.set_rng(rng)
 
     def set_sampling_weights(self, dprior=None):
         """
@@ -83,25 +193,357 @@ class VolumeDataProvider(DataProvider):
         self._sampling_weights = dprior
 
     def next_sample(self):
-        """Fetch next sample in a sample sequence."""
-        return self.random_sample()  # TODO(kisuk): Temporary.
+        """
+        Fetch next sample in a sample sequence.
+
+        The stride lattices of all datasets (see VolumeDataset.set_lattice) are
+        traversed as a whole, in a shuffled order without replacement, so that
+        every lattice point is visited once per epoch.
+        """
+        if self._order is None:
+            sizes = [d.lattice_size() for d in self.datasets]
+            self._lattice_end = np.cumsum(sizes)
+            self._order = FeistelPermutation(int(self._lattice_end[-1]))
+        j = self._order.next(self.rng)
+        i = int(np.searchsorted(self._lattice_end, j, side='right'))
+        k = j - (self._lattice_end[i-1] if i > 0 else 0)
+        dataset = self.datasets[i]
+        sample, transform = self._data_aug.next_sample(dataset, index=int(k))
+        # Sample is ordered by key (see sample.Sample).
+        return self._transform(sample, transform)
+
+    def release(self, sample):
+        """
+        Return the arrays of a sample no longer in use to the buffer pool, if
+        any (see buffer_pool.py).
+        """
+        buffer_pool.release(sample)
+
+    def augment_stats(self):
+        """
+        Return data augmentation statistics, i.e. the number of samples, and
+        the number of redraws of infeasible augmentation (see DataAugmentor),
+        and the number of reads and replays of the replay buffer, if any.
+        """
+        ret = dict(self._data_aug.stats)
+        if self._executor is not None:
+            for aug in self._async_augs:
+                for k, v in aug.stats.iteritems():
+                    ret[k] += v
+        if self._data_aug.replay is not None:
+            ret.update(self._data_aug.replay.stats)
+        return ret
+
+    def random_datasets(self, n, rng=None):
+        """
+        Pick n datasets randomly at once, according to the given sampling
+        weights.
+
+        Args:
+            n:   Number of datasets.
+            rng: Optional random number source, e.g. of a thread. Provider's
+                 if None.
+
+        Returns:
+            Array of n dataset indices.
+        """
+        if rng is None:
+            rng = self.rng
+        cdf = np.cumsum(self._sampling_weights, dtype='float64')
+        u = rng.rand(n) * cdf[-1]
+        idx = np.searchsorted(cdf, u, side='right')
+        return np.minimum(idx, len(self.datasets) - 1)
+
+    def copy_augmentor(self, rng):
+        """
+        Return a copy of DataAugmentor drawing from rng, with zero stats, for
+        use in another thread. Replay buffer is shared.
+
+        Args:
+            rng: Random number source of the copy, e.g. a RandomContext.
+        """
+        replay = self._data_aug.replay
+        memo = {id(np.random): np.random, id(replay): replay}
+        aug = copy.deepcopy(self._data_aug, memo)
+        aug.stats = dict((k, 0) for k in aug.stats)
+        aug.set_rng(rng)
+        return aug
+
+    def epoch(self):
+        """Return the number of completed epochs of next_sample."""
+        return 0 if self._order is None else self._order.epoch
 
     def random_sample(self):
         """Fetch random sample."""
         # Pick one dataset randomly.
         dataset = self._get_random_dataset()
-        # Draw a random sample and apply data augmenation.
-        sample, transform = self._data_aug.random_sample(dataset)
-        # Transform sample.
-        sample = self._transform(sample, transform)
-        # Ensure that sample is ordered by key.
-        return OrderedDict(sorted(sample.items(), key=lambda x: x[0]))
+        # Sample is ordered by key (see sample.Sample).
+        return self._sample(dataset)
+
+    def random_sample_from(self, i, loc=None, center=False):
+        """
+        Fetch random sample from the i-th dataset.
+
+        Args:
+            i:      Dataset index.
+            loc:    Optional 3 uniform random numbers in [0,1), which
+                    determine sample location within the valid range (see
+                    VolumeDataset). Ignored by class sampling and replay,
+                    and only loc[0] is used by coverage sampling.
+            center: Whether to return the actual sample center as well.
+
+        Returns:
+            sample, or (sample, center) if center.
+        """
+        # Sample is ordered by key (see sample.Sample).
+        return self._sample(self.datasets[i], loc=loc, center=center)
+
+    def __iter__(self):
+        """Iterate over random samples indefinitely."""
+        while True:
+            yield self.random_sample()
+
+    def stream(self, depth=2, n=None, f=None):
+        """
+        Return an iterator over random samples, or batches of n random
+        samples, computed ahead in a background thread (see LookAhead).
+        The provider must not be used otherwise until the iterator is closed.
+
+        Args:
+            depth: Maximum number of samples (or batches) computed ahead.
+            n:     Optional batch size.
+            f:     Optional function applied to each sample.
+        """
+        def produce():
+            while True:
+                if n is not None:
+                    yield self.random_batch(n, f=f)
+                elif f is not None:
+                    yield f(self.random_sample())
+                else:
+                    yield self.random_sample()
+        return LookAhead(produce(), depth)
+
+    def random_sample_async(self, i=None, loc=None, f=None):
+        """
+        Fetch random sample in an executor thread, without blocking unless
+        the in-flight window is full.
+
+        Dataset and location are drawn in the caller's thread, and data
+        augmentation in the executor by a per-thread copy of DataAugmentor,
+        so that samples from several datasets are read concurrently.
+
+        Args:
+            i:   Optional dataset index. Drawn by sampling weights if None.
+            loc: Optional 3 uniform random numbers in [0,1) (see
+                 random_sample_from).
+            f:   Optional function applied to the sample in the executor.
+
+        Returns:
+            concurrent.futures.Future, whose result() returns the sample, or
+            raises the error of sampling.
+        """
+        if self._executor is None:
+            with _executor_lock:
+                if self._executor is None:
+                    self._start_executor()
+        if i is None:
+            i = int(self.random_datasets(1)[0])
+        if loc is None:
+            loc = self.rng.rand(3)
+        self._async_slots.acquire()  # Backpressure.
+        try:
+            future = self._executor.submit(self._async_sample, i, loc, f)
+        except:
+            self._async_slots.release()
+            raise
+        # Released also when cancelled before running.
+        future.add_done_callback(lambda _: self._async_slots.release())
+        return future
+
+    def aiter(self, window=None):
+        """
+        Iterate over futures of random samples indefinitely, in the order of
+        submission, keeping up to window samples submitted (see
+        random_sample_async). Iteration waits only for room in the in-flight
+        window, not for sampling, so that the caller may wait for each
+        future as it likes, e.g. with concurrent.futures.wait.
+        """
+        if window is None:
+            window = self._async_window
+        pending = deque()
+        while True:
+            while len(pending) < window:
+                pending.append(self.random_sample_async())
+            yield pending.popleft()
+
+    def close(self):
+        """Stop the executor of random_sample_async, if any."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def random_batch(self, n, f=None):
+        """
+        Fetch a batch of n random samples.
+
+        Datasets and locations for the whole batch are drawn at once. Each
+        sample is built as by random_sample, and then copied into batch
+        arrays allocated from the first sample (see fill_batch), after which
+        its arrays are returned to the buffer pool, if any. Locations are
+        honoured only as far as random_sample_from does.
+
+        Args:
+            n: Batch size.
+            f: Optional function applied to each sample before batching.
+
+        Returns:
+            batch: OrderedDict mapping key to (N,C,Z,Y,X) array.
+        """
+        idx = self.random_datasets(n)
+        loc = self.rng.rand(n, 3)
+        batch = None
+        for i in xrange(n):
+            sample = self._sample(self.datasets[idx[i]], loc=loc[i])
+            if f is not None:
+                sample = f(sample)
+            batch = fill_batch(batch, i, n, sample)
+            buffer_pool.release(sample)  # Copied into batch.
+        return batch
 
 
     ####################################################################
     ## Private Helper Methods
     ####################################################################
 
+    def _build_datasets(self, args, params):
+        """
+        Build datasets, either serially or concurrently.
+
+        Args:
+            args:   List of (dataset_id, config, dparams, params, blocks).
+            params: Various options.
+
+        Returns:
+            List of lists of datasets (see _build_dataset), in the same order
+            as args.
+        """
+        num_workers = params.get('build_workers', 1)
+        if num_workers <= 1 or len(args) <= 1:
+            return map(_build_dataset, args)
+
+        mode = params.get('build_mode', 'thread')
+        if mode not in ['thread','process']:
+            raise RuntimeError('unknown build mode [%s]' % mode)
+
+        # Datasets are never sent between processes, which would read lazy
+        # and memory-mapped volumes into memory. Instead, worker processes
+        # preprocess volumes into the preprocessing cache, from which the
+        # datasets are built in this process.
+        tmp = None
+        if mode == 'process':
+            if params.get('cache', None) is None:
+                tmp = tempfile.mkdtemp(prefix='data_provider_')
+                for a in args:
+                    _set_cache_dir(a[1], tmp)
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                pool.map(_preprocess_dataset, [a[1] for a in args])
+            finally:
+                pool.close()
+                pool.join()
+
+        pool = ThreadPool(num_workers)
+        try:
+            # Pool.map preserves the order of args.
+            datasets = pool.map(_build_dataset, args)
+        finally:
+            pool.close()
+            pool.join()
+            if tmp is not None:
+                # Memory maps of cached volumes outlive their files.
+                shutil.rmtree(tmp)
+        return datasets
+
+    def _shard(self, args, dprior, params):
+        """
+        Keep the share of this rank from args, crop it to its blocks, and
+        attach the boxes of the blocks.
+
+        Returns:
+            args:   List of (dataset_id, config, dparams, params, boxes).
+            dprior: Prior of each block, or None.
+        """
+        rank = params.get('rank', 0)
+        world_size = params['world_size']
+        ranges = [shard.valid_range(a[1]) for a in args]
+        sizes = [0 if rg is None else rg.volume() for rg in ranges]
+        share = shard.shard(sizes, rank, world_size,
+                            blocks=params.get('shard_blocks', None),
+                            replicas=params.get('shard_replicas', 1))
+        if len(share) == 0:
+            raise RuntimeError('rank %d of %d has no share.' % \
+                               (rank, world_size))
+        # Blocks of each dataset, in the order of drange.
+        blocks = OrderedDict()
+        for i, b0, b1, n in share:
+            blocks.setdefault(i, list()).append((b0, b1, n))
+        if dprior is not None:
+            dprior = [dprior[i] * (b1 - b0) / float(n)
+                      for i, bs in blocks.iteritems() for b0, b1, n in bs]
+        # Only the slices around its blocks are read by this rank.
+        margin = params.get('shard_margin', 0)
+        ret = list()
+        for i, bs in blocks.iteritems():
+            if ranges[i] is None:
+                raise RuntimeError('dataset %d has no valid range.' % \
+                                   args[i][0])
+            boxes = [shard.block_box(ranges[i], *b) for b in bs]
+            shard.crop(args[i][1], boxes, margin)
+            ret.append(args[i][:4] + (boxes,))
+        args = ret
+        print 'rank %d of %d: datasets %s' % \
+              (rank, world_size, [a[0] for a in args])
+        return args, dprior
+
+    def _start_executor(self):
+        """Start the executor of random_sample_async."""
+        self._async_slots = threading.BoundedSemaphore(self._async_window)
+        self._async_local = threading.local()
+        self._async_lock  = threading.Lock()
+        self._async_augs  = list()
+        # Random seeds of executor threads, in the order of their first use.
+        self._async_seeds = [self.rng.randint(2**31)
+                             for _ in xrange(self._async_workers)]
+        self._executor = ThreadPoolExecutor(self._async_workers)
+
+    def _async_sample(self, i, loc, f=None):
+        """Executor task of random_sample_async."""
+        aug = getattr(self._async_local, 'aug', None)
+        if aug is None:
+            # DataAugmentor keeps state between prepare and augment, so
+            # every thread has its own copy.
+            with self._async_lock:
+                seed = self._async_seeds[len(self._async_augs)]
+                aug = self.copy_augmentor(RandomContext(seed))
+                self._async_augs.append(aug)
+            self._async_local.aug = aug
+        sample = self._sample(self.datasets[i], loc=loc, aug=aug)
+        return sample if f is None else f(sample)
+
+    def _sample(self, dataset, loc=None, aug=None, center=False):
+        """
+        Draw a sample from dataset, and apply augmentation and transform.
+        Return the sample, or (sample, center) if center.
+        """
+        if aug is None:
+            aug = self._data_aug
+        # Draw a random sample and apply data augmenation.
+        ret = aug.random_sample(dataset, loc=loc, center=center)
+        # Transform sample.
+        sample = self._transform(ret[0], ret[1])
+        return (sample, ret[2]) if center else sample
+
     def _get_random_dataset(self):
         """
         Pick one dataset randomly, according to the given sampling weights.
@@ -116,7 +558,7 @@ class VolumeDataProvider(DataProvider):
         # Take a single experiment with a multinomial distribution, whose
         # probabilities indicate how likely each dataset be selected.
         # Output is an one-hot vector.
-        sq = np.random.multinomial(1, self._sampling_weights, size=1)
+        sq = self.rng.multinomial(1, self._sampling_weights, size=1)
         sq = np.squeeze(sq)
 
         # Get the index of non-zero element.
@@ -128,6 +570,7 @@ class VolumeDataProvider(DataProvider):
         """
         TODO(kisuk): Documentation.
         """
+        old = dict(sample)
         affinitized = False
         for key, spec in transform.iteritems():
             if spec is not None:
@@ -140,9 +583,92 @@ class VolumeDataProvider(DataProvider):
             for key, data in sample.iteritems():
                 sample[key] = tensor_func.crop(data, (1,1,1))
 
+        buffer_pool.recycle(old, sample)
         return sample
 
 
+def _build_dataset(args):
+    """
+    Build a VolumeDataset. Defined at module level, so that it can be sent to
+    worker processes.
+
+    Returns:
+        List of the dataset, or of its blocks if args has any (see shard.py).
+    """
+    d, config, dparams, params, boxes = args
+    print 'constructing dataset %d...' % d
+    dataset = VolumeDataset(config, **dparams)
+    if boxes is None:
+        return [_setup_dataset(dataset, params)]
+    return [_setup_dataset(dataset.restrict(b), params) for b in boxes]
+
+
+def _preprocess_dataset(config):
+    """
+    Preprocess every data of a dataset that is cached (see ConfigData), so
+    that the dataset is built from the cache afterwards. Defined at module
+    level, so that it can be sent to worker processes.
+    """
+    for _, data in config.items('dataset'):
+        if config.has_option(data, 'cache_dir') and \
+           config.has_option(data, 'file') and \
+           config.has_option(data, 'preprocess'):
+            ConfigData(config, data)
+
+
+def _set_cache_dir(config, cache_dir):
+    """Set cache_dir of every data section of config without one."""
+    for _, data in config.items('dataset'):
+        if not config.has_option(data, 'cache_dir'):
+            config.set(data, 'cache_dir', cache_dir)
+
+
+def _setup_dataset(dataset, params):
+    """Set up location sampling of a dataset."""
+    # Class-aware location sampling.
+    cs = params.get('class_sampling', None)
+    if cs is not None:
+        kwargs = dict()
+        if 'max_count' in cs:
+            kwargs['max_count'] = cs['max_count']
+        dataset.build_class_index(cs['key'], cs['mixture'], **kwargs)
+    mc = params.get('min_coverage', None)
+    if mc is not None:
+        dataset.build_coverage_index(mc)
+    dataset.set_view(params.get('view', False))
+    # Sequential sampling lattice.
+    stride = params.get('stride', None)
+    if stride is not None:
+        dataset.set_lattice(stride)
+    return dataset
+
+
+def fill_batch(batch, i, n, sample):
+    """
+    Write sample into the i-th slot of a batch of size n.
+
+    Args:
+        batch:  OrderedDict mapping key to (N,C,Z,Y,X) array, or None to
+                allocate one from the shape of sample.
+        i:      Index within batch.
+        n:      Batch size.
+        sample: Dictionary mapping key to (C,Z,Y,X) array.
+
+    Returns:
+        batch
+    """
+    if batch is None:
+        batch = OrderedDict()
+        for key in sorted(sample.keys()):
+            data = sample[key]
+            batch[key] = np.empty((n,) + data.shape, dtype=data.dtype)
+    assert len(batch) == len(sample)
+    for key, data in batch.iteritems():
+        assert data.shape[1:] == sample[key].shape
+        data[i,...] = sample[key]
+    return batch
+
+
 class Sampler(object):
     """
     Draw samples from the data provider.
@@ -164,6 +690,22 @@ class Sampler(object):
                 sample = f(sample)
         return sample
 
+    def random_batch(self, n):
+        """Draw a batch of n samples, transform if needed."""
+        return self.dp.random_batch(n, f=self._apply_f)
+
+    def stream(self, depth=2, n=None):
+        """
+        Return an iterator over samples, or batches of n samples, transformed
+        if needed and computed ahead (see VolumeDataProvider.stream).
+        """
+        return self.dp.stream(depth, n=n, f=self._apply_f)
+
+    def _apply_f(self, sample):
+        for f in self.f:
+            sample = f(sample)
+        return sample
+
     def set_f(self, f):
         """Reset list, then add a transformer."""
         self.f = list()
@@ -172,3 +714,383 @@ class Sampler(object):
     def add_f(self, f):
         """Add a sample transformer."""
         self.f.append(f)
+
+
+class ThreadedSampler(Sampler):
+    """
+    Sampler running several sampling pipelines (data augmentation, label
+    transformation, and sample transformers) concurrently in the executor
+    threads of the data provider, against one shared set of datasets (see
+    VolumeDataProvider.random_sample_async). Warp kernels and most large
+    NumPy operations release the GIL.
+
+    Every executor thread draws from its own random stream, both for data
+    augmentation and for locations within datasets (e.g. class sampling).
+    Datasets are shared safely, as their valid range memo is locked.
+
+    Attributes:
+        depth: Number of samples in flight ahead of __call__.
+    """
+
+    def __init__(self, dp, depth=4):
+        super(ThreadedSampler, self).__init__(dp)
+        self.depth = depth
+        self._pending = deque()
+
+    def __call__(self):
+        """Draw a sample, transform if needed."""
+        while len(self._pending) < max(self.depth, 1):
+            self._pending.append(self.dp.random_sample_async(f=self._apply_f))
+        return self._pending.popleft().result()
+
+    def random_batch(self, n):
+        """Draw a batch of n samples concurrently, transform if needed."""
+        pending = [self.dp.random_sample_async(f=self._apply_f)
+                   for _ in xrange(n)]
+        batch = None
+        for i, r in enumerate(pending):
+            sample = r.result()
+            batch = fill_batch(batch, i, n, sample)
+            self.dp.release(sample)  # Copied into batch.
+        return batch
+
+
+class StagedSampler(Sampler):
+    """
+    Sampler running the stages of sampling concurrently on consecutive
+    samples (see stream.Pipeline):
+
+        read:      Draw dataset and location, prepare data augmentation, and
+                   read a raw sample.
+        augment:   Apply data augmentation.
+        transform: Apply label transformation.
+        f:         Apply sample transformers.
+
+    Data augmentation keeps state between prepare and augment, so a copy of
+    DataAugmentor travels with each sample from read to augment. Copies are
+    drawn from a bounded pool.
+
+    Every read worker and every copy of DataAugmentor draws from its own
+    stream RandomContext(seed, i), so that the provider's random stream is
+    never touched by the stages. Samples are reproducible given seed with
+    one worker per stage.
+
+    Attributes:
+        workers: Dictionary mapping stage name to the number of workers.
+        depth:   Maximum number of samples waiting between stages.
+        seed:    Base random seed of the stages.
+    """
+
+    stages = ('read', 'augment', 'transform', 'f')
+
+    def __init__(self, dp, workers=None, depth=2, seed=None):
+        """
+        Initialize StagedSampler. Stages start at the first draw.
+
+        Args:
+            dp:      VolumeDataProvider.
+            workers: Optional dictionary mapping stage name to the number of
+                     workers (default 1 each).
+            depth:   Maximum number of samples waiting between stages.
+            seed:    Base random seed of the stages. Drawn from the
+                     provider's random stream if None.
+        """
+        super(StagedSampler, self).__init__(dp)
+        self.workers = dict((name, 1) for name in self.stages)
+        if workers is not None:
+            self.workers.update(workers)
+        self.depth = depth
+        self.seed = dp.rng.randint(2**31) if seed is None else seed
+        self._pipeline = None
+
+    def __call__(self):
+        """Draw a sample, transform if needed."""
+        if self._pipeline is None:
+            self._start()
+        return next(self._pipeline)
+
+    def random_batch(self, n):
+        """Draw a batch of n samples, transform if needed."""
+        batch = None
+        for i in xrange(n):
+            sample = self()
+            batch = fill_batch(batch, i, n, sample)
+            self.dp.release(sample)  # Copied into batch.
+        return batch
+
+    def stats(self):
+        """Return the number of samples and busy time per stage."""
+        return dict() if self._pipeline is None else self._pipeline.stats()
+
+    def close(self):
+        """Stop every stage."""
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _start(self):
+        """Start the pipeline."""
+        dp = self.dp
+        # Every copy is either held by a read or augment worker, or waiting
+        # in between.
+        n = self.workers['read'] + self.depth + self.workers['augment']
+        self._augs = Queue.Queue()
+        for j in xrange(n):
+            rng = RandomContext(self.seed, self.workers['read'] + j)
+            self._augs.put(dp.copy_augmentor(rng))
+        # Streams of read workers, in the order of their first read.
+        self._read_local = threading.local()
+        self._read_lock = threading.Lock()
+        self._num_readers = 0
+        self._pipeline = Pipeline([(name, getattr(self, '_' + name),
+                                    self.workers[name])
+                                   for name in self.stages], self.depth)
+
+    def _read(self):
+        dp = self.dp
+        rng = self._read_rng()
+        i = int(dp.random_datasets(1, rng)[0])
+        loc = rng.rand(3)
+        aug = self._augs.get()
+        try:
+            dataset = dp.datasets[i]
+            sample, transform = aug.read(dataset, loc=loc)
+        except:
+            self._augs.put(aug)
+            raise
+        return aug, dataset, sample, transform
+
+    def _read_rng(self):
+        """Return the random stream of the calling read worker."""
+        rng = getattr(self._read_local, 'rng', None)
+        if rng is None:
+            with self._read_lock:
+                rng = RandomContext(self.seed, self._num_readers)
+                self._num_readers += 1
+            self._read_local.rng = rng
+        return rng
+
+    def _augment(self, args):
+        aug, dataset, sample, transform = args
+        try:
+            sample = aug.augment(dataset, sample)
+        finally:
+            self._augs.put(aug)
+        return sample, transform
+
+    def _transform(self, args):
+        sample, transform = args
+        return self.dp._transform(sample, transform)
+
+    def _f(self, sample):
+        return self._apply_f(sample)
+
+
+def _make_spec(dname, transform=None):
+    """
+    Write a dataset of a random image and label, and its spec, for the unit
+    tests of data providers.
+
+    Args:
+        dname:     Directory to write to.
+        transform: Optional label transform, e.g. "dict(type='affinitize')".
+
+    Returns:
+        Path to the spec.
+    """
+    emio.imsave(np.random.rand(8,16,16).astype('float32'),
+                os.path.join(dname, 'img.npy'))
+    emio.imsave(np.random.randint(0, 4, (8,16,16)).astype('float32'),
+                os.path.join(dname, 'lbl.npy'))
+    spec = os.path.join(dname, 'test.spec')
+    with open(spec, 'w') as f:
+        f.write('[files]\nimg = %s\nlbl = %s\n' % \
+                (os.path.join(dname, 'img.npy'),
+                 os.path.join(dname, 'lbl.npy')))
+        f.write('[image]\nfile = img\n[label]\nfile = lbl\n')
+        if transform is not None:
+            f.write('transform = %s\n' % transform)
+        f.write('[dataset]\ninput = image\nlabel = label\n')
+    return spec
+
+
+if __name__ == "__main__":
+
+    import ConfigParser
+    from concurrent.futures import Future, wait
+    import itertools
+    import unittest
+
+    ####################################################################
+    class UnitTestDataAugmentor(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def _dataset(self):
+            config = ConfigParser.ConfigParser()
+            config.add_section('dataset')
+            config.set('dataset', 'input', 'image')
+            config.add_section('image')
+            config.set('image', 'shape', (12,40,40))
+            config.set('image', 'fov', (4,16,16))
+            config.set('image', 'filler', "{'type':'uniform'}")
+            return VolumeDataset(config)
+
+        def _augmentors(self, replay=False):
+            spec = [dict(type='warp'), dict(type='flip'), dict(type='grey')]
+            ret = list()
+            for _ in xrange(2):
+                rb = ReplayBuffer(capacity=2, reuse=0.5) if replay else None
+                ret.append(DataAugmentor(spec, rng=RandomContext(7),
+                                         replay=rb))
+            return ret
+
+        def _assertSame(self, augs):
+            # read and augment leave the output of random_sample unchanged.
+            dataset = self._dataset()
+            for _ in xrange(10):
+                s1, t1, c1 = augs[0].random_sample(dataset, center=True)
+                raw, t2, c2 = augs[1].read(dataset, center=True)
+                s2 = augs[1].augment(dataset, raw)
+                self.assertEqual(s1.keys(), s2.keys())
+                for k in s1:
+                    self.assertTrue(np.array_equal(s1[k], s2[k]))
+                self.assertEqual(t1, t2)
+                self.assertEqual(tuple(c1), tuple(c2))
+            self.assertEqual(augs[0].stats, augs[1].stats)
+
+        def testReadAugment(self):
+            self._assertSame(self._augmentors())
+
+        def testReadAugmentReplay(self):
+            augs = self._augmentors(replay=True)
+            self._assertSame(augs)
+            self.assertTrue(augs[1].replay.stats['replays'] > 0)
+
+    ####################################################################
+    class UnitTestRandomSampleAsync(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            spec = _make_spec(self.dir)
+            net_spec = {'input':(4,8,8),'label':(4,8,8)}
+            params = dict(drange=[0], seed=3, async_workers=2,
+                          async_window=2)
+            self.dp = VolumeDataProvider(spec, net_spec, params)
+
+        def tearDown(self):
+            self.dp.close()
+            shutil.rmtree(self.dir)
+
+        def testFuture(self):
+            futures = [self.dp.random_sample_async() for _ in xrange(4)]
+            self.assertTrue(all(isinstance(f, Future) for f in futures))
+            done, _ = wait(futures, timeout=60)
+            self.assertEqual(len(done), 4)
+            for f in futures:
+                self.assertEqual(f.result()['input'].shape, (1,4,8,8))
+
+        def testError(self):
+            # Slots of failed samples are released.
+            for _ in xrange(4):
+                self.assertRaises(IndexError,
+                                  self.dp.random_sample_async(i=7).result)
+            sample = self.dp.random_sample_async(i=0).result()
+            self.assertEqual(sample['label'].shape, (1,4,8,8))
+
+        def testAiter(self):
+            futures = list(itertools.islice(self.dp.aiter(), 5))
+            self.assertTrue(all(isinstance(f, Future) for f in futures))
+            for f in futures:
+                self.assertEqual(f.result()['input'].shape, (1,4,8,8))
+
+        def testClose(self):
+            f = self.dp.random_sample_async()
+            self.dp.close()
+            self.assertTrue(f.done())
+            # The executor is restarted on demand.
+            f = self.dp.random_sample_async()
+            self.assertEqual(f.result()['input'].shape, (1,4,8,8))
+
+    ####################################################################
+    class UnitTestThreadedSampler(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.spec = _make_spec(self.dir)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _sampler(self):
+            net_spec = {'input':(4,8,8),'label':(4,8,8)}
+            params = dict(drange=[0], seed=5, async_workers=1,
+                          augment=[dict(type='flip')],
+                          class_sampling=dict(key='label',
+                                              mixture={1:0.5, 2:0.5}))
+            dp = VolumeDataProvider(self.spec, net_spec, params)
+            self.addCleanup(dp.close)
+            return ThreadedSampler(dp, depth=4)
+
+        def testOwnStream(self):
+            dp = self._sampler().dp
+            loc = (0.5,0.5,0.5)
+            dp.random_sample_async(i=0, loc=loc).result()  # Started.
+            rng = copy.deepcopy(dp.rng)
+            for _ in xrange(4):
+                dp.random_sample_async(i=0, loc=loc).result()
+            # Locations of class sampling are drawn from the random stream
+            # of the executor thread, not from the provider's.
+            self.assertEqual(dp.rng.rand(), rng.rand())
+
+        def testReproducible(self):
+            samplers = [self._sampler() for _ in xrange(2)]
+            for _ in xrange(8):
+                s1, s2 = [s() for s in samplers]
+                for k in s1:
+                    self.assertTrue(np.array_equal(s1[k], s2[k]))
+
+    ####################################################################
+    class UnitTestStagedSampler(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.spec = _make_spec(self.dir)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _sampler(self, seed=None):
+            net_spec = {'input':(4,8,8),'label':(4,8,8)}
+            params = dict(drange=[0], seed=5, augment=[dict(type='flip')])
+            dp = VolumeDataProvider(self.spec, net_spec, params)
+            sampler = StagedSampler(dp, seed=seed)
+            self.addCleanup(sampler.close)
+            return sampler
+
+        def testOwnStream(self):
+            sampler = self._sampler()
+            sampler()  # Started.
+            rng = copy.deepcopy(sampler.dp.rng)
+            for _ in xrange(8):
+                sampler()
+            # Datasets and locations are drawn from the random streams of
+            # read workers, not from the provider's.
+            self.assertEqual(sampler.dp.rng.rand(), rng.rand())
+
+        def testReproducible(self):
+            samplers = [self._sampler(seed=11) for _ in xrange(2)]
+            for _ in xrange(8):
+                s1, s2 = [s() for s in samplers]
+                for k in s1:
+                    self.assertTrue(np.array_equal(s1[k], s2[k]))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -8,11 +8,15 @@ Kisuk Lee <kisuklee@mit.edu>, 2016
 
 from collections import OrderedDict
 import copy
+import threading
 import numpy as np
 
 from box import Box
 from config_data import ConfigData, ConfigLabel
-from vector import Vec3d
+from location_index import ClassLocationIndex, CoverageIndex
+from location_index import StrideLattice, FeistelPermutation
+from sample import FrozenDict, Sample
+from vector import Vec3d, minimum
 
 class Dataset(object):
     """
@@ -43,8 +47,20 @@ class VolumeDataset(Dataset):
                 It depends both on data and net specs.
 
         params: Dataset-specific parameters.
+
+        rng:    Random number source (numpy.random or RandomContext).
     """
 
+    # Class attribute, so that a dataset with the default can be pickled.
+    rng = np.random
+
+    # Maximum number of memoized valid ranges per spec, least recently used
+    # first out.
+    max_ranges = 1024
+
+    # Whether to extract patches as read-only views (see set_view).
+    view = False
+
     def __init__(self, config, **kwargs):
         """Initialize VolumeDataset."""
         self.build_from_config(config)
@@ -53,6 +69,16 @@ class VolumeDataset(Dataset):
         for k, v in kwargs.iteritems():
             self.params[k] = v
 
+    # Locks cannot be pickled nor copied, so create a new one.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_ranges_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ranges_lock = threading.Lock()
+
     def build_from_config(self, config):
         """
         Build dataset from a ConfiParser object generated by Parser's
@@ -81,31 +107,143 @@ class VolumeDataset(Dataset):
                     # Lazy filling of mask shape. Since the shape of mask should
                     # be the same as the shape of corresponding label, it can be
                     # known only after having processed label in the first pass.
+                    # So is the offset of a label cropped to a z-range.
                     label, _ = name.split('_mask')
                     shape = self._data[label].shape()
                     config.set(data, 'shape', shape)
+                    offset = tuple(self._data[label].offset())
+                    config.set(data, 'offset', offset)
                 self._data[name] = ConfigData(config, data)
 
+        # Immutable image list and label transforms, shared by every sample.
+        self._imgs = tuple(self._image)
+        self._transform = FrozenDict((name, self._data[name].get_transform())
+                                     for name in sorted(self._label))
+
         # Set dataset spec.
         spec = dict()
         for name, data in self._data.iteritems():
             spec[name] = tuple(data.fov())
         self.set_spec(spec)
 
+    def set_rng(self, rng):
+        """Set random number source (numpy.random or RandomContext)."""
+        self.rng = rng
+
+    def build_class_index(self, key, mixture, max_count=2**22):
+        """
+        Build a location index of label classes over the current valid range,
+        and draw sample locations from a class mixture. Locations outside a
+        valid range shrunk by augmentation are redrawn.
+
+        Args:
+            key:       Label layer name.
+            mixture:   Dictionary mapping class to its probability. Class is
+                       either a label value (int), 'fg' for any nonzero
+                       label, or 'any' for uniform over the valid range.
+                       Classes absent in this dataset are ignored.
+            max_count: Maximum number of voxels indexed per class (see
+                       ClassLocationIndex).
+        """
+        assert key in self._label
+        classes = [c for c in mixture.keys() if c != 'any']
+        index = ClassLocationIndex(self._data[key], self._range, classes,
+                                   max_count=max_count)
+        # Ignore absent classes.
+        mixture = [(c, w) for c, w in sorted(mixture.items())
+                   if c == 'any' or index.count(c) > 0]
+        self._class_index = index
+        if len(mixture) > 0:
+            self._class_mixture = ([c for c, _ in mixture],
+                                   np.cumsum([w for _, w in mixture]))
+        else:
+            self._class_mixture = None
+
+    def build_coverage_index(self, min_coverage):
+        """
+        Build summed-volume tables of masks, and draw sample locations only
+        from the centers of patches whose mask coverage (fraction of nonzero
+        mask voxels) is at least min_coverage for every mask.
+
+        Args:
+            min_coverage: Minimum mask coverage in [0,1].
+        """
+        masks = dict()
+        for name, dim in self._spec.iteritems():
+            if name.endswith('_mask'):
+                masks[name] = (self._data[name], dim[-3:])
+        if len(masks) == 0:
+            self._coverage_index = None
+            return
+        index = CoverageIndex(masks, self._range, min_coverage)
+        if index.count() == 0:
+            raise RuntimeError('no patch meets minimum mask coverage %s.' % \
+                               min_coverage)
+        self._coverage_index = index
+
+    def set_view(self, view):
+        """
+        Set whether to extract patches as read-only views instead of copies.
+        Data augmentation and label transformation copy a patch only when they
+        write to it.
+        """
+        self.view = view
+
+    def set_lattice(self, stride=(1,1,1)):
+        """
+        Set a stride lattice over the current valid range, which is traversed
+        by next_sample in a shuffled order without replacement.
+
+        Args:
+            stride: Lattice stride (3-tuple).
+        """
+        self._lattice = StrideLattice(self._range, stride)
+        self._order = FeistelPermutation(len(self._lattice))
+
+    def lattice_size(self):
+        """Return the number of lattice points (see set_lattice)."""
+        if self._lattice is None:
+            self.set_lattice()
+        return len(self._lattice)
+
+    def epoch(self):
+        """Return the number of completed traversals of the lattice."""
+        return 0 if self._order is None else self._order.epoch
+
+    def restrict(self, box):
+        """
+        Return a dataset sharing data with this one, whose valid ranges are
+        restricted to box, e.g. a spatial block of a dataset sharded across
+        ranks. Location indices and the lattice are not carried over.
+
+        Args:
+            box: Box in the global coordinate system.
+        """
+        ret = copy.copy(self)
+        ret._bounds = Box(box)
+        ret._class_index    = None
+        ret._class_mixture  = None
+        ret._coverage_index = None
+        ret._lattice = None
+        ret._order   = None
+        ret._ranges  = OrderedDict()
+        ret._update_range()
+        if ret._range is None:
+            raise RuntimeError('%s does not overlap valid range.' % box)
+        return ret
+
     def get_spec(self):
-        """Return dataset spec."""
-        # TODO(kisuk):
-        #   spec's value type is tuple, which is immutable. Do we still need to
-        #   deepcopy it?
-        return copy.deepcopy(self._spec)
+        """Return dataset spec (immutable FrozenDict, ordered by key)."""
+        return self._spec
 
     def get_imgs(self):
-        return copy.deepcopy(self._image)
+        """Return image layer's names (immutable tuple)."""
+        return self._imgs
 
     def set_spec(self, spec):
         """Set spec and update valid range."""
         # Order by key
-        self._spec = OrderedDict(sorted(spec.items(), key=lambda x: x[0]))
+        self._spec = FrozenDict(sorted(spec.items(), key=lambda x: x[0]))
         self._update_range()
 
     def num_sample(self):
@@ -117,57 +255,110 @@ class VolumeDataset(Dataset):
         """Return valid range."""
         return Box(self._range)
 
-    def get_sample(self, pos):
+    def valid_range(self, spec):
+        """
+        Return the valid range given spec without changing the current spec,
+        or None if spec is infeasible for this dataset.
+        """
+        rg = self._lookup(spec)[1]
+        return None if rg is None else Box(rg)
+
+    def get_sample(self, pos, spec=None):
         """Extract a sample centered on pos.
 
         Every data in the sample is guaranteed to be center-aligned.
 
         Args:
-            pos: Center coordinate of the sample.
+            pos:  Center coordinate of the sample.
+            spec: Optional spec, which overrides dataset spec. Patch sizes are
+                  passed to each TensorData, whose state is never changed.
 
         Returns:
-            sample:     Dictionary mapping input layer's name to data.
-            transform:  Dictionary mapping label layer's name to the type of
+            sample:     Sample mapping input layer's name to data.
+            transform:  FrozenDict mapping label layer's name to the type of
                         label transformation specified by user.
 
         """
-        # self._spec is guaranteed to be ordered by key, so using OrderedDict
-        # and iterating over already-sorted self._spec together guarantee the
-        # sample is sorted.
-        sample = OrderedDict()
-        for name in self._spec.keys():
-            sample[name] = self._data[name].get_patch(pos)
+        # spec is guaranteed to be ordered by key, so the sample is sorted.
+        if spec is None:
+            spec = self._spec
+        else:
+            spec = self._lookup(spec)[0]
+        view = self.view
+        sample = Sample(((name, self._data[name].get_patch(pos, fov=dim[-3:],
+                                                           view=view))
+                         for name, dim in spec.iteritems()), presorted=True)
+        return sample, self._transform
+
+    def next_location(self, index=None):
+        """
+        Return a point of the stride lattice (see set_lattice).
 
-        transform = dict()
-        for name in self._label:
-            transform[name] = self._data[name].get_transform()
+        Args:
+            index: Optional lattice index. The next index of the shuffled
+                   order if None.
+        """
+        if self._lattice is None:
+            self.set_lattice()  # Over the valid range of dataset spec.
+        i = self._order.next(self.rng) if index is None else index
+        return self._lattice.location(i)
 
-        return sample, transform
+    def slack(self, pos):
+        """
+        Return the largest enlargement of sample size (Vec3d), which keeps
+        pos within the valid range.
+        """
+        # Each side of the valid range shrinks by at most half the
+        # enlargement, rounded up.
+        pos = Vec3d(pos)
+        rg = self._range
+        return minimum(pos - rg.min(), rg.max() - (1,1,1) - pos) * 2
 
-    def next_sample(self, spec=None):
-        """Fetch next sample in a sample sequence."""
-        return self.random_sample(spec)  # Currently just pick randomly.
+    def next_sample(self, spec=None, index=None, pos=None):
+        """Fetch next sample in a sample sequence.
 
-    def random_sample(self, spec=None):
-        """Fetch sample randomly"""
-        # Dynamically change spec.
-        if spec is not None:
-            original_spec = self._spec
-            try:
-                self.set_spec(spec)
-            except:
-                self.set_spec(original_spec)
-                raise
+        Every point of the stride lattice (see set_lattice) is visited once per
+        epoch, in a shuffled order. A spec overriding dataset spec must keep
+        the point within its valid range (see slack), as the point is never
+        moved.
 
-        pos = self._random_location()
-        ret = self.get_sample(pos)
+        Args:
+            spec:  Optional spec, which overrides dataset spec temporarily.
+            index: Optional lattice index. The next index of the shuffled
+                   order if None.
+            pos:   Optional lattice point from next_location, which
+                   overrides index.
+        """
+        if pos is None:
+            pos = self.next_location(index)
+        def locate(rg):
+            if not rg.contains(pos):
+                raise RuntimeError('lattice point %s is outside the valid '
+                                   'range %s.' % (pos, rg))
+            return pos
+        return self._sample(spec, locate)
+
+    def random_sample(self, spec=None, loc=None, center=False, rng=None):
+        """Fetch sample randomly.
 
-        # Return to original spec.
-        if spec is not None:
-            self.set_spec(original_spec)
+        Args:
+            spec: Optional spec, which overrides dataset spec temporarily.
+            loc:  Optional 3 uniform random numbers in [0,1), which determine
+                  sample location within the valid range. Drawn if None.
+                  Ignored by class sampling (see build_class_index), and
+                  only loc[0] is used by coverage sampling (see
+                  build_coverage_index).
+            center: Whether to return the sample center as well.
+            rng:  Optional random number source of this draw, e.g. of the
+                  calling thread. Dataset's if None.
 
-        # ret is a 2-tuple (sample, transform).
-        return ret
+        Returns:
+            (sample, transform), or (sample, transform, center) if center.
+        """
+        if rng is None:
+            rng = self.rng
+        locate = lambda rg: self._random_location(rg, loc, rng)
+        return self._sample(spec, locate, center=center)
 
     ####################################################################
     ## Private Helper Methods
@@ -180,18 +371,113 @@ class VolumeDataset(Dataset):
         self._label = list()
         self._spec  = None
         self._range = None
+        self._bounds = None
+        self._class_index   = None
+        self._class_mixture = None
+        self._coverage_index = None
+        self._lattice = None
+        self._order   = None
+        self._ranges  = OrderedDict()
+        self._ranges_lock = threading.Lock()
+
+    def _lookup(self, spec):
+        """
+        Return spec ordered by key and its valid range (None if infeasible),
+        memoized by spec. Safe to call from several threads.
+        """
+        key = tuple(sorted(spec.items()))
+        with self._ranges_lock:
+            ret = self._ranges.pop(key, None)
+            if ret is not None:
+                self._ranges[key] = ret  # Most recently used.
+                return ret
+        rg = None
+        for name, dim in key:
+            r = self._data[name].range(dim[-3:])
+            rg = r if rg is None or r is None else rg.intersect(r)
+            if rg is None:
+                break
+        if rg is not None and self._bounds is not None:
+            rg = rg.intersect(self._bounds)
+        ret = (FrozenDict(key), rg)
+        # Bounded memo, as augmentation may draw many distinct specs.
+        with self._ranges_lock:
+            if key not in self._ranges and \
+               len(self._ranges) >= self.max_ranges:
+                self._ranges.popitem(last=False)
+            self._ranges[key] = ret
+        return ret
 
-    def _random_location(self):
-        """Return one of the valid locations randomly."""
-        s = self._range.size()
-        z = np.random.randint(0, s[0])
-        y = np.random.randint(0, s[1])
-        x = np.random.randint(0, s[2])
+    def _sample(self, spec, locate, center=False):
+        """
+        Fetch sample at the location returned by locate(range), and return
+        (sample, transform), or (sample, transform, location) if center.
+        """
+        if spec is None:
+            rg = self._range
+        else:
+            # Override spec without changing any state, so that a dataset
+            # can be shared across threads.
+            spec, rg = self._lookup(spec)
+            if rg is None:
+                raise RuntimeError('spec is infeasible for this dataset.')
+        pos = locate(rg)
+        # ret is a 2-tuple (sample, transform).
+        ret = self.get_sample(pos, spec)
+        return ret + (pos,) if center else ret
+
+    def _random_location(self, rg, loc=None, rng=None):
+        """Return one of the valid locations within rg randomly."""
+        if rng is None:
+            rng = self.rng
+        # Draw from the class mixture, if any.
+        if self._class_mixture is not None:
+            classes, cdf = self._class_mixture
+            i = np.searchsorted(cdf, rng.rand()*cdf[-1], side='right')
+            c = classes[min(i, len(classes) - 1)]
+            if c != 'any':
+                pos = self._draw_class(c, rg, rng)
+                if pos is not None:
+                    return pos
+                # Falling back to any valid center.
+
+        # Draw from the valid centers of mask coverage, if any.
+        if self._coverage_index is not None:
+            u = rng.rand() if loc is None else loc[0]
+            pos = self._coverage_index.draw(u, rg)
+            if pos is None:
+                raise RuntimeError('no patch meeting minimum mask coverage '
+                                   'lies within valid range %s.' % rg)
+            return pos
+
+        s = rg.size()
+        if loc is None:
+            z = rng.randint(0, s[0])
+            y = rng.randint(0, s[1])
+            x = rng.randint(0, s[2])
+        else:
+            # Scale uniform random numbers to the valid range.
+            z, y, x = [int(u*d) for u, d in zip(loc, s)]
         # Global coordinate system.
-        return Vec3d(z,y,x) + self._range.min()
+        return Vec3d(z,y,x) + rg.min()
         # DEBUG
         #return self._range.min()
 
+    def _draw_class(self, c, rg, rng):
+        """
+        Draw a location of class c within rg, where every mask coverage is
+        above the minimum, if any. Return None if none is found.
+        """
+        # Bounded rejection.
+        for _ in xrange(10):
+            pos = self._class_index.draw(c, rng, rg)
+            if pos is None:
+                return None
+            if self._coverage_index is None or \
+               self._coverage_index.is_valid(pos):
+                return pos
+        return None
+
     def _update_range(self):
         """
         Update valid range. It's computed by intersecting the valid range of
@@ -207,3 +493,119 @@ class VolumeDataset(Dataset):
                 self._range = r
             else:
                 self._range = self._range.intersect(r)
+        # Restriction (see restrict).
+        if self._range is not None and self._bounds is not None:
+            self._range = self._range.intersect(self._bounds)
+
+
+if __name__ == "__main__":
+
+    import ConfigParser
+    import unittest
+
+    from tensor import TensorData
+
+    def _make_dataset(shape=(10,20,20), fov=(4,8,8), filler=None):
+        """Return a dataset of an image and label, generated in memory."""
+        config = ConfigParser.ConfigParser()
+        config.add_section('dataset')
+        for name, section in [('input','image'), ('label','label')]:
+            config.set('dataset', name, section)
+            config.add_section(section)
+            config.set(section, 'shape', str(shape))
+            config.set(section, 'fov', str(fov))
+            if filler is not None:
+                config.set(section, 'filler', str(filler))
+        return VolumeDataset(config)
+
+    ####################################################################
+    class UnitTestVolumeDataset(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testLookupLRU(self):
+            dataset = _make_dataset()
+            dataset.max_ranges = 2
+            specs = [dict(input=(4,8,8+i), label=(4,8,8+i)) for i in xrange(3)]
+            dataset.valid_range(specs[0])
+            dataset.valid_range(specs[1])
+            dataset.valid_range(specs[0])  # Most recently used.
+            dataset.valid_range(specs[2])  # Evicts specs[1].
+            keys = [tuple(sorted(x.items())) for x in specs]
+            self.assertEqual(dataset._ranges.keys(), [keys[0], keys[2]])
+
+        def testLookupThreads(self):
+            import threading
+            dataset = _make_dataset()
+            dataset.max_ranges = 8
+            specs = [dict(input=(4,8,8+i), label=(4,8,8+i)) for i in xrange(32)]
+            expected = [dataset.valid_range(x) for x in specs]
+            errors = list()
+            def work(k):
+                try:
+                    for j in xrange(500):
+                        i = (j*7 + k) % len(specs)
+                        if dataset.valid_range(specs[i]) != expected[i]:
+                            errors.append(i)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=work, args=(k,))
+                       for k in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertTrue(len(dataset._ranges) <= dataset.max_ranges)
+
+        def testRandomSampleCenter(self):
+            dataset = _make_dataset(filler={'type':'randint','high':3})
+            dataset.build_class_index('label', {1:1.0})
+            spec = dict(input=(6,10,12), label=(6,10,12))
+            label = dataset._data['label'].get_data()
+            for _ in xrange(20):
+                sample, _, pos = dataset.random_sample(spec=spec,
+                                                       loc=(0.1,0.5,0.9),
+                                                       center=True)
+                self.assertTrue(dataset.valid_range(spec).contains(pos))
+                self.assertEqual(label[0,pos[0],pos[1],pos[2]], 1)
+                expected, _ = dataset.get_sample(pos, spec)
+                for k in expected:
+                    self.assertTrue(np.array_equal(sample[k], expected[k]))
+
+        def testCoverageWithinRange(self):
+            dataset = _make_dataset()
+            # Mask of two opposite quadrants in (y,x).
+            mask = np.zeros((1,10,20,20), dtype='float32')
+            mask[0,:,:11,:11] = 1
+            mask[0,:,11:,11:] = 1
+            dataset._data['label_mask'] = TensorData(mask, fov=(4,8,8))
+            dataset.set_spec(dict(input=(4,8,8), label=(4,8,8),
+                                  label_mask=(4,8,8)))
+            dataset.build_coverage_index(0.9)
+            index = dataset._coverage_index
+            # Valid centers under an enlarged spec are drawn, never moved.
+            spec = dict(input=(4,12,12), label=(4,12,12),
+                        label_mask=(4,12,12))
+            rg = dataset.valid_range(spec)
+            for _ in xrange(50):
+                _, _, pos = dataset.random_sample(spec=spec, center=True)
+                self.assertTrue(rg.contains(pos))
+                self.assertTrue(index.is_valid(pos))
+            # No valid center within the valid range.
+            spec = dict(input=(4,16,4), label=(4,16,4), label_mask=(4,16,4))
+            self.assertRaises(RuntimeError, dataset.random_sample, spec=spec)
+
+        def testCopy(self):
+            dataset = _make_dataset()
+            ret = dataset.restrict(Box((3,5,5), (6,12,12)))
+            self.assertTrue(ret._ranges_lock is not dataset._ranges_lock)
+            self.assertEqual(ret.get_range(), Box((3,5,5), (6,12,12)))
+            ret = copy.deepcopy(dataset)
+            self.assertEqual(ret.get_range(), dataset.get_range())
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
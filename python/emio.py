@@ -6,28 +6,113 @@ Created on Wed Jan 28 14:27:31 2015
 @author: jingpeng
 """
 
+import json
+import os
+import zlib
+
 import numpy as np
 import h5py
 import tifffile
 
-def imread(fname):
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+def imread(fname, zrange=None):
     """
     Read volumetirc data.
 
+    Numpy (.npy) and raw (.raw) files are memory-mapped read-only, so that
+    only the pages actually accessed are read, and processes reading the same
+    file share the page cache. A raw file requires a sidecar metadata file
+    (fname + '.json') with 'shape', 'dtype', and optionally 'order' and
+    'offset'.
+
     Args:
-        fname: Name of the file to read (hdf5 or tiff).
+        fname:  Name of the file to read (hdf5, tiff, npy, raw, or chunks).
+        zrange: Range [z0,z1) of z-slices to read, or None for all. Only the
+                slices in range are read, unless a tiff file is not stored
+                as a page per z-slice.
 
     Returns:
-        data: Numpy 3D or 4D array.
+        data: Numpy 3D or 4D array (numpy.memmap for npy and raw).
     """
+    z = slice(None) if zrange is None else slice(*zrange)
     if '.hdf5' in fname or '.h5' in fname:
-        f = h5py.File(fname)
-        data = np.asarray(f['/main'])
+        f = h5py.File(fname, 'r')
+        dset = f['/main']
+        data = dset[(slice(None),)*(dset.ndim - 3) + (z,)]
         f.close()
     elif '.tif' in fname:
-        data = tifffile.imread(fname)
+        with tifffile.TiffFile(fname) as f:
+            shape = tuple(f.series[0].shape)
+            paged = len(shape) == 3 and len(f.pages) == shape[0]
+        if paged and zrange is not None:
+            # A page per z-slice.
+            data = tifffile.imread(fname, key=range(*z.indices(shape[0])))
+            data = data.reshape((-1,) + shape[1:])
+        else:
+            data = tifffile.imread(fname)
+            data = data[(slice(None),)*(data.ndim - 3) + (z,)]
+    elif '.npy' in fname:
+        data = np.load(fname, mmap_mode='r')
+        data = data[(slice(None),)*(data.ndim - 3) + (z,)]
+    elif '.raw' in fname:
+        meta = _read_raw_meta(fname)
+        data = np.memmap(fname, dtype=meta['dtype'], mode='r',
+                         offset=meta.get('offset', 0),
+                         shape=tuple(meta['shape']),
+                         order=meta.get('order', 'C'))
+        data = data[(slice(None),)*(data.ndim - 3) + (z,)]
+    elif '.chunks' in fname:
+        data = ChunkedVolume(fname)[(slice(None), z, slice(None), slice(None))]
+    else:
+        raise RuntimeError('unsupported file format [%s]' % fname)
+
+    return data
+
+
+def imshape(fname):
+    """
+    Return the shape of volumetric data, reading only its header.
+
+    Args:
+        fname: Name of the file (hdf5, tiff, npy, raw, or chunks).
+    """
+    if '.hdf5' in fname or '.h5' in fname:
+        with h5py.File(fname, 'r') as f:
+            return tuple(f['/main'].shape)
+    elif '.tif' in fname:
+        with tifffile.TiffFile(fname) as f:
+            return tuple(f.series[0].shape)
+    elif '.npy' in fname:
+        return tuple(np.load(fname, mmap_mode='r').shape)
+    elif '.raw' in fname:
+        return tuple(_read_raw_meta(fname)['shape'])
+    elif '.chunks' in fname:
+        return ChunkedVolume(fname).shape
+    raise RuntimeError('unsupported file format [%s]' % fname)
+
+
+def imopen(fname):
+    """
+    Open volumetric data without reading it into memory.
+
+    Args:
+        fname: Name of the file to open (hdf5 or chunks). Other formats are
+               read by imread, which memory-maps npy and raw files.
+
+    Returns:
+        data: H5Volume for hdf5, ChunkedVolume for chunks, numpy 3D or 4D
+              array otherwise.
+    """
+    if '.hdf5' in fname or '.h5' in fname:
+        data = H5Volume(fname)
+    elif '.chunks' in fname:
+        data = ChunkedVolume(fname)
     else:
-        raise RuntimeError('only hdf5 and tiff formats are supported')
+        data = imread(fname)
 
     return data
 
@@ -38,7 +123,7 @@ def imsave(data, fname):
 
     Args:
         data: Numpy array to save.
-        fname: Name of the file to save (hdf5 or tiff).
+        fname: Name of the file to save (hdf5, tiff, npy, raw, or chunks).
     """
     if '.hdf5' in fname or '.h5' in fname:
         f = h5py.File(fname)
@@ -46,5 +131,292 @@ def imsave(data, fname):
         f.close()
     elif '.tif' in fname:
         tifffile.imsave(fname, data)
+    elif '.npy' in fname:
+        np.save(fname, data)
+    elif '.raw' in fname:
+        data = np.ascontiguousarray(data)
+        data.tofile(fname)
+        meta = dict(shape=data.shape, dtype=data.dtype.str, order='C')
+        with open(fname + '.json', 'w') as f:
+            json.dump(meta, f)
+    elif '.chunks' in fname:
+        write_chunked(data, fname)
     else:
-        raise RuntimeError('only hdf5 and tiff formats are supported')
+        raise RuntimeError('unsupported file format [%s]' % fname)
+
+
+def write_chunked(data, dname, chunks=(16,128,128), compression='zlib',
+                  level=6):
+    """
+    Save volumetric data as a directory of independently compressed chunks.
+
+    The volume is split along (z,y,x) by a fixed chunk grid. Every chunk
+    contains all channels, and is stored in its own file named by its grid
+    index (e.g. '0_1_2'). The header ('header.json') records shape, dtype,
+    chunk size, and compression.
+
+    Args:
+        data:        Numpy 3D or 4D array to save.
+        dname:       Name of the directory to save.
+        chunks:      Chunk size (z,y,x).
+        compression: 'zlib', 'lzma', or None.
+        level:       Compression level.
+    """
+    assert data.ndim==3 or data.ndim==4
+    assert len(chunks)==3
+    _check_compression(compression)
+    if not os.path.isdir(dname):
+        os.makedirs(dname)
+
+    # Header.
+    header = dict(shape=data.shape, dtype=data.dtype.str, chunks=chunks,
+                  compression=compression)
+    with open(os.path.join(dname, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    # Chunks.
+    vol = data[np.newaxis,...] if data.ndim==3 else data
+    dim = vol.shape[-3:]
+    for z in xrange(0, dim[0], chunks[0]):
+        for y in xrange(0, dim[1], chunks[1]):
+            for x in xrange(0, dim[2], chunks[2]):
+                chunk = vol[:,z:z+chunks[0],y:y+chunks[1],x:x+chunks[2]]
+                buf = np.ascontiguousarray(chunk).tostring()
+                if compression == 'zlib':
+                    buf = zlib.compress(buf, level)
+                elif compression == 'lzma':
+                    buf = lzma.compress(buf, preset=level)
+                idx = (z/chunks[0], y/chunks[1], x/chunks[2])
+                with open(os.path.join(dname, '%d_%d_%d' % idx), 'wb') as f:
+                    f.write(buf)
+
+
+def _check_compression(compression):
+    if compression not in ['zlib','lzma',None]:
+        raise RuntimeError('unknown compression [%s]' % compression)
+    if compression == 'lzma' and lzma is None:
+        raise RuntimeError('lzma compression requires the lzma module')
+
+
+def _read_raw_meta(fname):
+    """Read the sidecar metadata of a raw file."""
+    with open(fname + '.json', 'r') as f:
+        meta = json.load(f)
+    assert 'shape' in meta and 'dtype' in meta
+    return meta
+
+
+class H5Volume(object):
+    """
+    Read-only HDF5 volume read on demand.
+
+    The dataset handle is kept open, and every access reads only the requested
+    hyperslab from the file. A 3D dataset is presented as a 4D volume with a
+    single channel, so that it can be sliced like TensorData's 4D array.
+
+    Attributes:
+        shape: 4-tuple (channel,z,y,x).
+        ndim:  Always 4.
+        dtype: Data type of the dataset.
+    """
+
+    def __init__(self, fname, dset='/main'):
+        self._fname = fname
+        self._dset_name = dset
+        self._open()
+
+    def close(self):
+        self._file.close()
+
+    def __getitem__(self, key):
+        """Read a hyperslab specified by four slices (channel,z,y,x)."""
+        assert isinstance(key, tuple) and len(key)==4
+        if self._squeeze:
+            data = self._dset[key[1:]][np.newaxis,...]
+            return data[key[0]]
+        return self._dset[key]
+
+    def __array__(self, dtype=None):
+        """Read the whole volume."""
+        data = self._dset[...]
+        if self._squeeze:
+            data = data[np.newaxis,...]
+        return data if dtype is None else data.astype(dtype)
+
+    # h5py handles cannot be pickled, so reopen the file after unpickling.
+    def __getstate__(self):
+        return (self._fname, self._dset_name)
+
+    def __setstate__(self, state):
+        self._fname, self._dset_name = state
+        self._open()
+
+    def _open(self):
+        self._file = h5py.File(self._fname, 'r')
+        self._dset = self._file[self._dset_name]
+        assert self._dset.ndim==3 or self._dset.ndim==4
+        self._squeeze = self._dset.ndim==3
+        if self._squeeze:
+            self.shape = (1,) + self._dset.shape
+        else:
+            self.shape = self._dset.shape
+        self.ndim  = 4
+        self.dtype = self._dset.dtype
+
+
+class ChunkedVolume(object):
+    """
+    Read-only chunked volume read on demand (see write_chunked).
+
+    Every access decodes only the chunks intersecting the requested box. Chunk
+    files are independent, so that many processes can read concurrently
+    without contention. A 3D volume is presented as a 4D volume with a single
+    channel, so that it can be sliced like TensorData's 4D array.
+
+    Attributes:
+        shape: 4-tuple (channel,z,y,x).
+        ndim:  Always 4.
+        dtype: Data type of the volume.
+    """
+
+    def __init__(self, dname):
+        with open(os.path.join(dname, 'header.json'), 'r') as f:
+            header = json.load(f)
+        assert len(header['shape'])==3 or len(header['shape'])==4
+        _check_compression(header['compression'])
+        self._dname = dname
+        self._chunks = tuple(header['chunks'])
+        self._compression = header['compression']
+        if len(header['shape']) == 3:
+            self.shape = (1,) + tuple(header['shape'])
+        else:
+            self.shape = tuple(header['shape'])
+        self.ndim  = 4
+        self.dtype = np.dtype(header['dtype'])
+
+    def __getitem__(self, key):
+        """Read a box specified by four slices (channel,z,y,x)."""
+        assert isinstance(key, tuple) and len(key)==4
+        bounds = list()
+        for s, dim in zip(key[1:], self.shape[1:]):
+            start, stop, step = s.indices(dim)
+            assert step == 1
+            bounds.append((start, max(start, stop)))
+        shape = (self.shape[0],) + tuple(b - a for a, b in bounds)
+        ret = np.empty(shape, dtype=self.dtype)
+        # Decode only the intersecting chunks.
+        ranges = [xrange(a/c, (b + c - 1)/c) for (a, b), c in
+                  zip(bounds, self._chunks)]
+        for z in ranges[0]:
+            for y in ranges[1]:
+                for x in ranges[2]:
+                    chunk = self._read_chunk((z,y,x))
+                    src, dst = list(), list()
+                    for i, (a, b), c in zip((z,y,x), bounds, self._chunks):
+                        lo = max(a, i*c)
+                        hi = min(b, (i+1)*c)
+                        src.append(slice(lo - i*c, hi - i*c))
+                        dst.append(slice(lo - a, hi - a))
+                    ret[(slice(None),) + tuple(dst)] = \
+                        chunk[(slice(None),) + tuple(src)]
+        return ret[key[0]]
+
+    def __array__(self, dtype=None):
+        """Read the whole volume."""
+        data = self[(slice(None),)*4]
+        return data if dtype is None else data.astype(dtype)
+
+    def _read_chunk(self, idx):
+        """Decode a chunk at grid index idx."""
+        with open(os.path.join(self._dname, '%d_%d_%d' % idx), 'rb') as f:
+            buf = f.read()
+        if self._compression == 'zlib':
+            buf = zlib.decompress(buf)
+        elif self._compression == 'lzma':
+            buf = lzma.decompress(buf)
+        shape = [self.shape[0]]
+        for i, c, dim in zip(idx, self._chunks, self.shape[1:]):
+            shape.append(min(c, dim - i*c))
+        return np.frombuffer(buf, dtype=self.dtype).reshape(shape)
+
+
+if __name__ == "__main__":
+
+    import shutil
+    import tempfile
+    import unittest
+
+    ####################################################################
+    class UnitTestChunkedVolume(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def testRoundTrip(self):
+            compressions = ['zlib', None] + (['lzma'] if lzma else [])
+            for compression in compressions:
+                data = np.random.rand(2,10,11,12).astype('float32')
+                dname = os.path.join(self.dir, '%s.chunks' % compression)
+                write_chunked(data, dname, chunks=(4,5,6),
+                              compression=compression)
+                vol = imopen(dname)
+                self.assertTrue(isinstance(vol, ChunkedVolume))
+                self.assertTrue(vol.shape==data.shape)
+                self.assertTrue(vol.dtype==data.dtype)
+                self.assertTrue(np.array_equal(data, np.asarray(vol)))
+                self.assertTrue(np.array_equal(data, imread(dname)))
+
+        def testReadBox(self):
+            data = np.arange(10*11*12, dtype='int32').reshape(10,11,12)
+            dname = os.path.join(self.dir, 'data.chunks')
+            write_chunked(data, dname, chunks=(4,5,6))
+            vol = ChunkedVolume(dname)
+            self.assertTrue(vol.shape==(1,10,11,12))
+            # A box across chunk boundaries, and a box within one chunk.
+            for z, y, x in [((3,9),(2,11),(5,7)), ((0,1),(0,1),(0,1))]:
+                key = (slice(0,1), slice(*z), slice(*y), slice(*x))
+                expected = data[np.newaxis,...][key]
+                self.assertTrue(np.array_equal(expected, vol[key]))
+
+        def testUnknownCompression(self):
+            dname = os.path.join(self.dir, 'data.chunks')
+            self.assertRaises(RuntimeError, write_chunked,
+                              np.zeros((2,2,2)), dname, compression='gzip')
+
+
+    ####################################################################
+    class UnitTestReadSlab(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def testZRange(self):
+            data = np.arange(6*5*4, dtype='float32').reshape(6,5,4)
+            # A page per z-slice.
+            fname = os.path.join(self.dir, 'pages.tif')
+            with tifffile.TiffWriter(fname) as f:
+                for img in data:
+                    f.save(img)
+            self.assertTrue(imshape(fname)==data.shape)
+            self.assertTrue(np.array_equal(imread(fname, zrange=(1,3)),
+                                           data[1:3]))
+            for ext in ['h5','tif','npy','raw','chunks']:
+                fname = os.path.join(self.dir, 'data.' + ext)
+                imsave(data, fname)
+                shape = imshape(fname)
+                self.assertTrue(shape[-3:]==data.shape)
+                slab = imread(fname, zrange=(2,5))
+                self.assertTrue(slab.ndim==len(shape))
+                self.assertTrue(np.array_equal(slab.reshape(-1,5,4),
+                                               data[2:5]))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
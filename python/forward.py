@@ -11,6 +11,7 @@ import math
 
 import blend
 from box import Box, centered_box
+from stream import LookAhead
 from tensor import WritableTensorData as WTD, WritableTensorDataWithMask as WTDM
 import time
 from vector import *
@@ -52,18 +53,44 @@ class ForwardScanner(object):
             self.counter += 1
         return ret
 
-    def push(self, sample):
+    def push(self, sample, loc=None):
         """
         TODO(kisuk): Documentation
 
         Args:
             sample:
-            kwargs:
+            loc:    Location of sample, if it is from stream (current pulled
+                    location if None).
         """
+        if loc is not None:
+            self.outputs.push(loc, sample)
+            return
         assert self.current is not None
         self.outputs.push(self.current, sample)
         self.current = None
 
+    def __iter__(self):
+        """Iterate over (loc, sample) of the remaining scan locations."""
+        return self.stream(depth=0)
+
+    def stream(self, depth=2):
+        """
+        Return an iterator over (loc, sample) of the remaining scan locations,
+        whose samples are read ahead in a background thread (see LookAhead).
+        Outputs are pushed with push(output, loc), in any order.
+
+        Args:
+            depth: Maximum number of samples read ahead.
+        """
+        assert self.current is None
+        locs = self.locs[self.counter:]
+        self.counter = len(self.locs)
+        def produce():
+            for loc in locs:
+                sample, _ = self.dataset.get_sample(loc)
+                yield loc, sample
+        return LookAhead(produce(), depth)
+
     ####################################################################
     ## Private Methods.
     ####################################################################
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Hard example sampling driven by loss feedback.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from data_provider import Sampler, fill_batch
+from vector import Vec3d, minimum
+
+class PriorityTable(object):
+    """
+    Bounded table of decaying priorities.
+
+    Priority of a key is an exponential moving average of the values
+    reported for it, and decays by a factor every time any value is reported,
+    so that stale priorities fade. When the table is full, the key of the
+    lowest priority is evicted for a new key of higher priority.
+    """
+
+    def __init__(self, capacity=1024, decay=0.999, alpha=0.5):
+        """
+        Initialize PriorityTable.
+
+        Args:
+            capacity: Maximum number of keys.
+            decay:    Decay factor per report.
+            alpha:    Weight of a newly reported value in the moving average.
+        """
+        assert capacity > 0
+        assert 0 < decay <= 1
+        assert 0 < alpha <= 1
+        self.capacity = capacity
+        self.decay = decay
+        self.alpha = alpha
+        self._slot  = dict()
+        self._keys  = list()
+        self._value = np.zeros(capacity, dtype='float64')
+        self._time  = np.zeros(capacity, dtype='float64')
+        self._t = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, key, x):
+        """Report value x for key."""
+        self._t += 1
+        i = self._slot.get(key, None)
+        if i is not None:
+            old = self._value[i] * self.decay**(self._t - self._time[i])
+            self._value[i] = self.alpha*x + (1 - self.alpha)*old
+        else:
+            if len(self._keys) < self.capacity:
+                i = len(self._keys)
+                self._keys.append(key)
+            else:
+                p = self.priorities()
+                i = int(np.argmin(p))
+                if p[i] >= x:
+                    return
+                del self._slot[self._keys[i]]
+                self._keys[i] = key
+            self._slot[key] = i
+            self._value[i] = x
+        self._time[i] = self._t
+
+    def priorities(self):
+        """Return current priorities, in the order of keys()."""
+        n = len(self._keys)
+        return self._value[:n] * self.decay**(self._t - self._time[:n])
+
+    def keys(self):
+        return list(self._keys)
+
+    def draw(self, u):
+        """
+        Draw a key with probability proportional to its priority.
+
+        Args:
+            u: Uniform random number in [0,1).
+        """
+        assert len(self._keys) > 0
+        cdf = np.cumsum(self.priorities())
+        if cdf[-1] <= 0:
+            return self._keys[int(u*len(self._keys))]
+        i = np.searchsorted(cdf, u*cdf[-1], side='right')
+        return self._keys[min(i, len(self._keys) - 1)]
+
+
+class HardExampleSampler(Sampler):
+    """
+    Sampler biased toward high-loss regions and datasets.
+
+    The valid range of each dataset is divided into spatial blocks. The
+    trainer reports the loss of each sample back by its sample ID, which is
+    attributed to the dataset and the block of the actual sample center.
+    The center may differ from the location requested, e.g. when data
+    augmentation shrinks the valid range, or under class sampling or
+    replay (see VolumeDataProvider.random_sample_from). With
+    probability 1 - explore, a block is drawn in proportion to its priority
+    (see PriorityTable), and a location is drawn uniformly within the block.
+    Otherwise, a dataset is drawn in proportion to its prior reweighted by
+    its average loss, and a location uniformly within its valid range.
+
+    Unlike Sampler, samples and batches are returned with their sample IDs.
+
+    Attributes:
+        block:   Block size (z,y,x).
+        explore: Probability of drawing uniformly instead of by priority.
+        power:   Exponent of the average loss in dataset reweighting.
+    """
+
+    def __init__(self, dp, block=(8,64,64), explore=0.5, capacity=1024,
+                 decay=0.999, alpha=0.5, power=1.0, dprior=None,
+                 max_pending=16384):
+        """
+        Initialize HardExampleSampler.
+
+        Args:
+            dp:          VolumeDataProvider.
+            block:       Block size (z,y,x).
+            explore:     Probability of drawing uniformly.
+            capacity:    Maximum number of blocks with priority.
+            decay:       Decay factor of priorities per reported loss.
+            alpha:       Weight of a new loss in moving averages.
+            power:       Exponent of the average loss in dataset reweighting.
+            dprior:      Prior dataset sampling weights (number of samples in
+                         valid range if None).
+            max_pending: Maximum number of samples awaiting their loss.
+        """
+        super(HardExampleSampler, self).__init__(dp)
+        self.block = Vec3d(block)
+        self.explore = explore
+        self.power = power
+        self.alpha = alpha
+        self._table = PriorityTable(capacity, decay, alpha)
+        self._ranges = [d.get_range() for d in dp.datasets]
+        if dprior is None:
+            dprior = [d.num_sample() for d in dp.datasets]
+        self._prior = np.asarray(dprior, dtype='float64')
+        self._dloss = np.ones(len(dp.datasets), dtype='float64')
+        self._pending = OrderedDict()
+        self._max_pending = max_pending
+        self._next_id = 0
+        self._update_weights()
+
+    def __call__(self):
+        """Draw a sample, transform if needed. Returns (sample_id, sample)."""
+        sid, sample = self._draw()
+        return sid, self._apply_f(sample)
+
+    def random_batch(self, n):
+        """
+        Draw a batch of n samples, transform if needed.
+
+        Returns:
+            ids:   List of n sample IDs.
+            batch: OrderedDict mapping key to (N,C,Z,Y,X) array.
+        """
+        ids, batch = list(), None
+        for i in xrange(n):
+            sid, sample = self()
+            ids.append(sid)
+            batch = fill_batch(batch, i, n, sample)
+            self.dp.release(sample)  # Copied into batch.
+        return ids, batch
+
+    def report_loss(self, ids, losses):
+        """
+        Report per-sample loss.
+
+        Args:
+            ids:    Sample ID, or list of sample IDs.
+            losses: Loss, or list of losses, of the samples.
+        """
+        if np.isscalar(ids):
+            ids, losses = [ids], [losses]
+        for sid, loss in zip(ids, losses):
+            key = self._pending.pop(sid, None)
+            if key is None:
+                continue  # Unknown, or expired.
+            loss = float(loss)
+            self._table.update(key, loss)
+            d = key[0]
+            self._dloss[d] = self.alpha*loss + (1 - self.alpha)*self._dloss[d]
+        self._update_weights()
+
+    def dataset_weights(self):
+        """Return current dataset sampling weights."""
+        return np.copy(self._weights)
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _draw(self):
+        """Draw a sample, either by priority or uniformly."""
+        rng = self.dp.rng
+        if len(self._table) > 0 and rng.rand() >= self.explore:
+            d, b = self._table.draw(rng.rand())
+            rg = self._ranges[d]
+            # Uniformly within the block, clipped by the valid range.
+            vmin = rg.min() + Vec3d(b)*self.block
+            vmax = minimum(vmin + self.block, rg.max())
+            pos = [lo + rng.rand()*(hi - lo) for lo, hi in zip(vmin, vmax)]
+        else:
+            i = np.searchsorted(self._cdf, rng.rand()*self._cdf[-1],
+                                side='right')
+            d = min(i, len(self._ranges) - 1)
+            rg = self._ranges[d]
+            pos = [lo + rng.rand()*s for lo, s in zip(rg.min(), rg.size())]
+        # Location relative to the valid range (see VolumeDataset).
+        loc = [(p - lo)/float(s) for p, lo, s in zip(pos, rg.min(), rg.size())]
+        sample, center = self.dp.random_sample_from(d, loc=loc, center=True)
+        sid = self._next_id
+        self._next_id += 1
+        self._pending[sid] = (d, self._block(d, center))
+        if len(self._pending) > self._max_pending:
+            self._pending.popitem(last=False)
+        return sid, sample
+
+    def _block(self, d, pos):
+        """Return the block of the d-th dataset containing pos."""
+        rg = self._ranges[d]
+        ret = list()
+        for p, lo, n, s in zip(pos, rg.min(), rg.size(), self.block):
+            last = (n - 1)//s
+            ret.append(min(max(int(p - lo)//s, 0), last))
+        return tuple(ret)
+
+    def _update_weights(self):
+        """Reweight dataset prior by average loss."""
+        dloss = np.maximum(self._dloss, 1e-8)
+        w = self._prior * (dloss / np.mean(dloss))**self.power
+        self._weights = w / np.sum(w)
+        self._cdf = np.cumsum(self._weights)
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    from box import Box
+    from rng import RandomContext
+
+    class _Dataset(object):
+        def __init__(self, box):
+            self._box = Box(*box)
+        def get_range(self):
+            return Box(self._box)
+        def num_sample(self):
+            return self._box.volume()
+
+    class _Provider(object):
+        """Provider whose samples are centered on a fixed location."""
+        def __init__(self, centers):
+            self.datasets = [_Dataset(b) for b, _ in centers]
+            self.centers = [Vec3d(c) for _, c in centers]
+            self.rng = RandomContext(0)
+        def random_sample_from(self, i, loc=None, center=False):
+            sample = {'input': np.zeros((1,1,1,1))}
+            return (sample, self.centers[i]) if center else sample
+        def release(self, sample):
+            pass
+
+    ####################################################################
+    class UnitTestPriorityTable(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testMovingAverage(self):
+            t = PriorityTable(4, decay=1.0, alpha=0.5)
+            t.update('a', 4.0)
+            t.update('a', 2.0)
+            self.assertEqual(t.keys(), ['a'])
+            self.assertAlmostEqual(t.priorities()[0], 3.0)
+
+        def testDecayAndEvict(self):
+            t = PriorityTable(2, decay=0.5, alpha=1.0)
+            t.update('a', 8.0)
+            t.update('b', 1.0)
+            # a decays to 8*0.5 = 4, b is kept over a new key of less.
+            self.assertTrue(np.allclose(t.priorities(), [4.0, 1.0]))
+            t.update('c', 0.5)
+            self.assertEqual(sorted(t.keys()), ['a','b'])
+            # A new key of more evicts the lowest.
+            t.update('d', 3.0)
+            self.assertEqual(sorted(t.keys()), ['a','d'])
+
+        def testDraw(self):
+            t = PriorityTable(4, decay=1.0, alpha=1.0)
+            t.update('a', 1.0)
+            t.update('b', 3.0)
+            draws = [t.draw(u) for u in np.linspace(0, 1, 400, endpoint=False)]
+            self.assertEqual(draws.count('a'), 100)
+            self.assertEqual(draws.count('b'), 300)
+
+
+    ####################################################################
+    class UnitTestHardExampleSampler(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testAttributeToActualCenter(self):
+            # Samples are centered on (5,40,70), wherever they are requested.
+            dp = _Provider([(((0,0,0), (8,64,64)), (0,0,0)),
+                            (((2,10,20), (12,90,120)), (5,40,70))])
+            hs = HardExampleSampler(dp, block=(4,16,16), explore=1.0)
+            for _ in xrange(20):
+                sid, _ = hs()
+                hs.report_loss(sid, 1.0)
+            self.assertEqual(sorted(hs._table.keys()),
+                             [(0,(0,0,0)), (1,(0,1,3))])
+
+        def testBlockClipped(self):
+            dp = _Provider([(((0,0,0), (9,33,33)), (0,0,0))])
+            hs = HardExampleSampler(dp, block=(4,16,16))
+            self.assertEqual(hs._block(0, (8,32,32)), (2,2,2))
+            self.assertEqual(hs._block(0, (9,40,40)), (2,2,2))
+            self.assertEqual(hs._block(0, (-1,0,17)), (0,0,1))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -7,6 +7,7 @@ Kisuk Lee <kisuklee@mit.edu>, 2015-2016
 """
 
 import numpy as np
+import buffer_pool
 import transform
 import utils
 
@@ -33,7 +34,9 @@ def binarize(sample, key, rebalancing=True):
     # Rebalancing.
     if rebalancing:
         wmsk = transform.rebalance_class(sample[key])
+        sample[key+'_mask'] = utils.writable(sample[key+'_mask'])
         sample[key+'_mask'] *= wmsk
+        buffer_pool.release(wmsk)
 
 
 def binary_class(sample, key, rebalancing=True):
@@ -52,12 +55,13 @@ def affinitize(sample, key, rebalancing=True):
     if rebalancing:
         wmsk = transform.tensor_func.rebalance_class(affs)
         sample[key+'_mask'] *= wmsk
+        buffer_pool.release(wmsk)
 
 
 def multiclass_expansion(sample, key, ids, rebalancing=True):
     """For semantic segmentation."""
     lbl  = sample[key]
-    msk  = utils.check_volume(sample[key+'_mask'])
+    msk  = utils.check_volume(utils.writable(sample[key+'_mask']))
     lbls, msk2 = transform.multiclass_expansion(lbl, ids)
     msk *= msk2
     msks = np.tile(msk, (len(ids),1,1,1))
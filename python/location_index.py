@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Location index classes.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import numpy as np
+
+from box import Box
+from vector import Vec3d
+
+class ClassLocationIndex(object):
+    """
+    Compact index of voxel locations per label class.
+
+    For each class, sorted flat indices of the voxels of that class within a
+    box (typically the valid range of a dataset) are stored, so that a
+    location of a given class can be drawn in O(1). At most max_count
+    voxels are stored per class: a class with more voxels (e.g. 'fg' of a
+    dense label) is subsampled systematically, keeping every k-th voxel in
+    the flat order for the smallest power of two k that fits.
+
+    Classes are either label values (int), or 'fg' for any nonzero label.
+    """
+
+    # Number of rejected draws before filtering the whole class (see draw).
+    max_redraws = 10
+
+    def __init__(self, label, box, classes, max_count=2**22):
+        """
+        Build index.
+
+        Args:
+            label:     TensorData containing label.
+            box:       Box in the global coordinate system to index.
+            classes:   List of classes to index.
+            max_count: Maximum number of voxels stored per class.
+        """
+        assert max_count > 0
+        self._box = Box(box)
+        size = self._box.size()
+        self._shape = (size[0], size[1], size[2])
+        dtype = 'uint32' if self._box.volume() < 2**32 else 'int64'
+
+        # Local coordinate system.
+        vmin = self._box.min() - label.offset()
+        vmax = self._box.max() - label.offset()
+        data = label.get_data()
+
+        # Scan section by section, so that a lazy label is never read at once.
+        found  = dict((c, list()) for c in classes)
+        kept   = dict((c, 0) for c in classes)  # Number of voxels stored.
+        seen   = dict((c, 0) for c in classes)  # Number of voxels scanned.
+        stride = dict((c, 1) for c in classes)  # Subsampling stride.
+        area   = self._shape[1] * self._shape[2]
+        for i, z in enumerate(xrange(vmin[0], vmax[0])):
+            sec = data[0:1,z:z+1,vmin[1]:vmax[1],vmin[2]:vmax[2]]
+            sec = np.asarray(sec).ravel()
+            for c in classes:
+                if c == 'fg':
+                    idx = np.flatnonzero(sec)
+                else:
+                    idx = np.flatnonzero(sec == c)
+                if len(idx) == 0:
+                    continue
+                # Keep every stride-th voxel of the class in the flat order.
+                k = stride[c]
+                n = len(idx)
+                idx = idx[(-seen[c]) % k::k]
+                seen[c] += n
+                found[c].append((idx + i*area).astype(dtype))
+                kept[c] += len(idx)
+                # Double the stride, keeping every other voxel stored.
+                while kept[c] > max_count:
+                    idx = np.concatenate(found[c])[::2]
+                    found[c] = [idx]
+                    kept[c] = len(idx)
+                    stride[c] *= 2
+
+        self._index = dict()
+        for c, idx in found.iteritems():
+            if len(idx) > 0:
+                self._index[c] = np.concatenate(idx)
+            else:
+                self._index[c] = np.zeros(0, dtype=dtype)
+
+    def classes(self):
+        return self._index.keys()
+
+    def count(self, c):
+        """Return the number of indexed voxels of class c."""
+        return len(self._index[c])
+
+    def draw(self, c, rng=np.random, box=None):
+        """
+        Draw a location of class c randomly (global coordinate system).
+
+        Args:
+            c:   Class.
+            rng: Random number source.
+            box: Optional box (e.g. a valid range shrunk by augmentation) the
+                 location must lie within. Locations outside are redrawn,
+                 never moved.
+
+        Returns:
+            Location, or None if no location of class c lies within box.
+        """
+        idx = self._index[c]
+        assert len(idx) > 0
+        for _ in xrange(self.max_redraws):
+            pos = self._location(idx[rng.randint(0, len(idx))])
+            if box is None or box.contains(pos):
+                return pos
+        # Rarely reached, unless box excludes most of the class.
+        idx = self._within(idx, box)
+        if len(idx) == 0:
+            return None
+        return self._location(idx[rng.randint(0, len(idx))])
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _location(self, flat):
+        z, y, x = np.unravel_index(flat, self._shape)
+        return Vec3d(int(z), int(y), int(x)) + self._box.min()
+
+    def _within(self, idx, box):
+        """Return the flat indices in idx lying within box."""
+        return _within(idx, self._box, box)
+
+
+class SummedVolumeTable(object):
+    """
+    Summed-volume table (3D integral image) for O(1) box-sum queries.
+
+    Table entry (z,y,x) holds the sum of data[:z,:y,:x], so that the table
+    has one more element than data along each dimension.
+    """
+
+    def __init__(self, data):
+        """
+        Build table.
+
+        Args:
+            data: 3D array-like, or 4D with a single channel. Lazy data is
+                  read section by section.
+        """
+        shape = data.shape[-3:]
+        dtype = 'uint32' if np.prod(shape) < 2**32 else 'int64'
+        table = np.zeros((shape[0]+1, shape[1]+1, shape[2]+1), dtype=dtype)
+        for z in xrange(shape[0]):
+            if len(data.shape) == 4:
+                sec = data[0:1,z:z+1,:,:]
+            else:
+                sec = data[z:z+1,:,:]
+            sec = np.asarray(sec).reshape(shape[1:]) > 0
+            area = np.cumsum(np.cumsum(sec, axis=0), axis=1)
+            table[z+1,1:,1:] = table[z,1:,1:] + area
+        self._table = table
+
+    def box_sum(self, vmin, vmax):
+        """Return the sum over box [vmin,vmax) (local coordinate system)."""
+        t = self._table
+        z0, y0, x0 = vmin
+        z1, y1, x1 = vmax
+        # Python integers, so that sums never wrap.
+        c = [int(t[z,y,x]) for z in (z0,z1) for y in (y0,y1) for x in (x0,x1)]
+        return (c[7] - c[3] - c[5] - c[6] + c[1] + c[2] + c[4] - c[0])
+
+    def box_sums(self, vmin, size, shape):
+        """
+        Return the sums over boxes of size, whose min corners form a dense
+        grid of shape starting from vmin (local coordinate system).
+        """
+        t = self._table
+        def s(dz, dy, dx):
+            z = vmin[0] + dz
+            y = vmin[1] + dy
+            x = vmin[2] + dx
+            # Cast only the gathered corners, so that sums never wrap.
+            return t[z:z+shape[0],y:y+shape[1],x:x+shape[2]].astype('int64')
+        fz, fy, fx = size
+        return (s(fz,fy,fx) - s(0,fy,fx) - s(fz,0,fx) - s(fz,fy,0)
+                + s(0,0,fx) + s(0,fy,0) + s(fz,0,0) - s(0,0,0))
+
+
+class CoverageIndex(object):
+    """
+    Index of patch centers meeting a minimum mask coverage.
+
+    Mask coverage of a patch is the fraction of nonzero mask voxels within
+    the patch. Summed-volume tables of masks make each query O(1), and the
+    sorted flat indices of valid centers within a box make each draw O(1).
+    """
+
+    def __init__(self, masks, box, min_coverage):
+        """
+        Build index.
+
+        Args:
+            masks:        Dictionary mapping mask name to (TensorData, fov).
+            box:          Box of centers in the global coordinate system.
+            min_coverage: Minimum mask coverage in [0,1] of every mask.
+        """
+        self._box = Box(box)
+        size = self._box.size()
+        self._shape = (size[0], size[1], size[2])
+        self._min_coverage = min_coverage
+        self._tables = dict()
+        valid = np.ones(self._shape, dtype='bool')
+        for name, (mask, fov) in masks.iteritems():
+            svt = SummedVolumeTable(mask.get_data())
+            fov = Vec3d(fov)
+            self._tables[name] = (svt, fov, mask.offset())
+            # Min corners of the patches centered on every center in box.
+            vmin = self._box.min() - mask.offset() - fov/2
+            sums = svt.box_sums(vmin, fov, self._shape)
+            valid &= sums >= min_coverage * (fov[0]*fov[1]*fov[2])
+        dtype = 'uint32' if self._box.volume() < 2**32 else 'int64'
+        self._valid = np.flatnonzero(valid).astype(dtype)
+        self._last = None  # Box of the last draw, and valid centers within.
+
+    def count(self):
+        """Return the number of valid centers."""
+        return len(self._valid)
+
+    def coverage(self, name, pos):
+        """Return mask coverage of the patch centered on pos."""
+        svt, fov, offset = self._tables[name]
+        vmin = Vec3d(pos) - offset - fov/2
+        vmax = vmin + fov
+        return svt.box_sum(vmin, vmax) / float(fov[0]*fov[1]*fov[2])
+
+    def is_valid(self, pos):
+        """Return true if every mask coverage is above the minimum."""
+        for name in self._tables.iterkeys():
+            if self.coverage(name, pos) < self._min_coverage:
+                return False
+        return True
+
+    def draw(self, u, box=None):
+        """
+        Return a valid center (global coordinate system).
+
+        Args:
+            u:   Uniform random number in [0,1).
+            box: Optional box (e.g. a valid range shrunk by augmentation) the
+                 center must lie within. Only the valid centers within box
+                 are drawn, never moved.
+
+        Returns:
+            Valid center, or None if no valid center lies within box.
+        """
+        idx = self._valid
+        if box is not None and not _contains(box, self._box):
+            key = (tuple(box.min()), tuple(box.max()))
+            last = self._last
+            if last is not None and last[0] == key:
+                idx = last[1]
+            else:
+                idx = _within(idx, self._box, box)
+                self._last = (key, idx)
+        if len(idx) == 0:
+            return None
+        flat = idx[int(u*len(idx))]
+        z, y, x = np.unravel_index(flat, self._shape)
+        return Vec3d(int(z), int(y), int(x)) + self._box.min()
+
+
+class StrideLattice(object):
+    """
+    Lattice of locations with a stride within a box.
+
+    Lattice points are box.min() + k*stride for every k such that the point
+    lies within the box. They are enumerated in the C order, so that any
+    point is computed from its index without storing the lattice.
+    """
+
+    def __init__(self, box, stride=(1,1,1)):
+        """
+        Initialize lattice.
+
+        Args:
+            box:    Box in the global coordinate system.
+            stride: Lattice stride (3-tuple).
+        """
+        self._box = Box(box)
+        self._stride = Vec3d(stride)
+        assert all(s > 0 for s in self._stride)
+        size = self._box.size()
+        self._shape = tuple((size[i] + self._stride[i] - 1) // self._stride[i]
+                            for i in range(3))
+
+    def __len__(self):
+        return self._shape[0] * self._shape[1] * self._shape[2]
+
+    def location(self, i):
+        """Return the i-th lattice point (global coordinate system)."""
+        z, y, x = np.unravel_index(i, self._shape)
+        return Vec3d(int(z), int(y), int(x))*self._stride + self._box.min()
+
+
+class FeistelPermutation(object):
+    """
+    Random permutation of range(n), reshuffled every epoch.
+
+    The i-th element of an epoch is computed by a keyed Feistel network
+    over the smallest domain of 2^(2h) >= n elements, cycle-walking (i.e.
+    re-encrypting) until the result falls within range(n). The result is
+    a bijection of range(n). Fewer than four encryptions are needed on
+    average. Only the round keys and the cursor are stored, so that memory
+    does not depend on n.
+
+    Attributes:
+        epoch: Number of completed epochs.
+    """
+
+    # Number of Feistel rounds.
+    rounds = 4
+
+    def __init__(self, n):
+        assert n > 0
+        self.epoch = 0
+        self._n = n
+        # Half width h in bits.
+        self._half = max((int(n - 1).bit_length() + 1) // 2, 1)
+        self._mask = (1 << self._half) - 1
+        self._keys = None
+        self._i = 0
+
+    def __len__(self):
+        return self._n
+
+    def next(self, rng=np.random):
+        """Return the next index, drawing a new permutation if necessary."""
+        if self._keys is None:
+            self._shuffle(rng)
+        ret = self._permute(self._i)
+        self._i += 1
+        if self._i == self._n:
+            self.epoch += 1
+            self._keys = None
+            self._i = 0
+        return ret
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _shuffle(self, rng):
+        self._keys = [(int(rng.randint(2**31)) << 31) | int(rng.randint(2**31))
+                      for _ in xrange(self.rounds)]
+
+    def _permute(self, i):
+        x = self._encrypt(i)
+        while x >= self._n:  # Cycle-walking.
+            x = self._encrypt(x)
+        return x
+
+    def _encrypt(self, x):
+        h, mask = self._half, self._mask
+        left, right = x >> h, x & mask
+        for k in self._keys:
+            left, right = right, left ^ _round(right, k, mask)
+        return (left << h) | right
+
+
+def _contains(outer, inner):
+    """Return true if box outer contains box inner."""
+    return all(a <= b for a, b in zip(outer.min(), inner.min())) and \
+           all(a >= b for a, b in zip(outer.max(), inner.max()))
+
+
+def _within(idx, indexed, box):
+    """
+    Return the flat indices in idx, of locations within box indexed, lying
+    within box.
+    """
+    size = indexed.size()
+    z, y, x = np.unravel_index(idx, (size[0], size[1], size[2]))
+    vmin = Vec3d(box.min()) - indexed.min()
+    vmax = Vec3d(box.max()) - indexed.min()
+    keep = ((z >= vmin[0]) & (z < vmax[0]) &
+            (y >= vmin[1]) & (y < vmax[1]) &
+            (x >= vmin[2]) & (x < vmax[2]))
+    return idx[keep]
+
+
+def _round(x, k, mask):
+    """Feistel round function, a keyed 64-bit integer hash."""
+    x = ((x ^ k) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 29
+    x = (x * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 32
+    return x & mask
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    from tensor import TensorData
+
+    ####################################################################
+    class UnitTestClassLocationIndex(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testDraw(self):
+            label = np.zeros((1,6,7,8), dtype='uint32')
+            label[0,1,2,3] = 1
+            label[0,4,5,6] = 1
+            label[0,2:4,1:3,1:3] = 2
+            box = Box((1,1,1), (5,6,7))
+            index = ClassLocationIndex(TensorData(label), box, [1,2,'fg'])
+            self.assertTrue(index.count(1)==2)
+            self.assertTrue(index.count(2)==8)
+            self.assertTrue(index.count('fg')==10)
+            rng = np.random.RandomState(0)
+            for c in [1,2,'fg']:
+                for _ in xrange(50):
+                    pos = index.draw(c, rng)
+                    self.assertTrue(box.contains(pos))
+                    v = label[0,pos[0],pos[1],pos[2]]
+                    self.assertTrue(v==c if c != 'fg' else v > 0)
+
+        def testDrawWithinBox(self):
+            label = np.zeros((1,6,6,6), dtype='uint32')
+            label[0,0,0,0] = 1
+            label[0,3,3,3] = 1
+            index = ClassLocationIndex(TensorData(label),
+                                       Box((0,0,0), (6,6,6)), [1])
+            # A shrunk range excluding (0,0,0) never yields a moved location.
+            box = Box((1,1,1), (5,5,5))
+            rng = np.random.RandomState(0)
+            for _ in xrange(50):
+                self.assertTrue(index.draw(1, rng, box)==Vec3d(3,3,3))
+            self.assertTrue(index.draw(1, rng, Box((4,4,4), (6,6,6))) is None)
+
+        def testMaxCount(self):
+            label = np.ones((1,4,5,6), dtype='uint32')
+            for max_count in [120, 50, 7, 1]:
+                index = ClassLocationIndex(TensorData(label),
+                                           Box((0,0,0), (4,5,6)), ['fg'],
+                                           max_count=max_count)
+                # Every k-th voxel, for the smallest power of two k.
+                k = 1
+                while 120/k + (120 % k > 0) > max_count:
+                    k *= 2
+                expected = np.arange(0, 120, k)
+                self.assertTrue(np.array_equal(index._index['fg'], expected))
+
+    ####################################################################
+    class UnitTestSummedVolumeTable(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testBoxSum(self):
+            rng = np.random.RandomState(0)
+            data = rng.rand(6,7,8) > 0.5
+            svt = SummedVolumeTable(data)
+            for _ in xrange(100):
+                vmin = [rng.randint(0, d) for d in data.shape]
+                vmax = [rng.randint(a, d + 1) for a, d in zip(vmin, data.shape)]
+                expected = data[vmin[0]:vmax[0],vmin[1]:vmax[1],vmin[2]:vmax[2]]
+                self.assertEqual(svt.box_sum(vmin, vmax), expected.sum())
+
+        def testBoxSums(self):
+            rng = np.random.RandomState(0)
+            data = (rng.rand(1,6,7,8) > 0.5).astype('uint8')
+            svt = SummedVolumeTable(data)
+            vmin, size, shape = (1,0,2), (2,3,4), (3,5,3)
+            sums = svt.box_sums(vmin, size, shape)
+            self.assertTrue(sums.shape==shape)
+            for z in xrange(shape[0]):
+                for y in xrange(shape[1]):
+                    for x in xrange(shape[2]):
+                        z0, y0, x0 = vmin[0] + z, vmin[1] + y, vmin[2] + x
+                        expected = data[0,z0:z0+size[0],y0:y0+size[1],
+                                        x0:x0+size[2]].sum()
+                        self.assertEqual(sums[z,y,x], expected)
+
+
+    ####################################################################
+    class UnitTestCoverageIndex(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testValidCenters(self):
+            mask = np.zeros((1,8,8,8), dtype='uint8')
+            mask[0,:,:4,:] = 1
+            box = Box((1,1,1), (7,7,7))
+            fov = (3,3,3)
+            index = CoverageIndex({'mask': (TensorData(mask), fov)}, box, 0.5)
+            # Brute force.
+            expected = list()
+            for z in xrange(1,7):
+                for y in xrange(1,7):
+                    for x in xrange(1,7):
+                        patch = mask[0,z-1:z+2,y-1:y+2,x-1:x+2]
+                        if patch.mean() >= 0.5:
+                            expected.append(Vec3d(z,y,x))
+            self.assertEqual(index.count(), len(expected))
+            n = index.count()
+            drawn = [tuple(index.draw((i + 0.5)/n)) for i in xrange(n)]
+            self.assertEqual(sorted(drawn), sorted(tuple(v) for v in expected))
+            for pos in expected:
+                self.assertTrue(index.is_valid(pos))
+            self.assertFalse(index.is_valid((3,6,3)))
+
+        def testDrawWithinBox(self):
+            mask = np.zeros((1,8,8,8), dtype='uint8')
+            mask[0,:,:4,:] = 1
+            box = Box((1,1,1), (7,7,7))
+            index = CoverageIndex({'mask': (TensorData(mask), (3,3,3))}, box,
+                                  0.9)
+            # Only the valid centers within a smaller box are drawn.
+            inner = Box((2,2,2), (6,6,6))
+            for u in np.linspace(0, 1, 50, endpoint=False):
+                pos = index.draw(u, inner)
+                self.assertTrue(inner.contains(pos))
+                self.assertTrue(index.is_valid(pos))
+            # No valid center within the box.
+            self.assertTrue(index.draw(0.5, Box((1,5,1), (7,7,7))) is None)
+
+    ####################################################################
+    class UnitTestStrideLattice(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testLocation(self):
+            lattice = StrideLattice(Box((1,2,3), (6,7,9)), (2,3,4))
+            self.assertEqual(len(lattice), 3*2*2)
+            expected = [(z,y,x) for z in (1,3,5) for y in (2,5) for x in (3,7)]
+            locs = [tuple(lattice.location(i)) for i in xrange(len(lattice))]
+            self.assertEqual(locs, expected)
+
+
+    ####################################################################
+    class UnitTestFeistelPermutation(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testBijection(self):
+            rng = np.random.RandomState(0)
+            for n in [1, 2, 3, 7, 64, 100, 1000, 4097]:
+                p = FeistelPermutation(n)
+                for epoch in xrange(2):
+                    order = [p.next(rng) for _ in xrange(n)]
+                    self.assertEqual(sorted(order), range(n))
+                    self.assertEqual(p.epoch, epoch + 1)
+
+        def testReshuffle(self):
+            rng = np.random.RandomState(0)
+            n = 1000
+            p = FeistelPermutation(n)
+            first  = [p.next(rng) for _ in xrange(n)]
+            second = [p.next(rng) for _ in xrange(n)]
+            self.assertNotEqual(first, second)
+            # Reproducible given the random stream.
+            rng = np.random.RandomState(0)
+            p = FeistelPermutation(n)
+            self.assertEqual(first, [p.next(rng) for _ in xrange(n)])
+
+        def testShuffled(self):
+            rng = np.random.RandomState(0)
+            n = 10000
+            p = FeistelPermutation(n)
+            order = np.array([p.next(rng) for _ in xrange(n)])
+            # Consecutive elements are not a fixed offset apart.
+            steps = np.diff(order) % n
+            self.assertTrue(len(np.unique(steps)) > n/2)
+            # Positions and values are uncorrelated.
+            corr = np.corrcoef(np.arange(n), order)[0,1]
+            self.assertTrue(abs(corr) < 0.05)
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -5,6 +5,7 @@ Karan Kathpalia <karank@cs.princeton.edu>
 Kisuk Lee <kisuklee@mit.edu>, 2016-2017
 """
 
+import buffer_pool
 import data_augmentation
 import numpy as np
 from utils import check_tensor
@@ -21,7 +22,7 @@ class MisalignAugment(data_augmentation.DataAugment):
 
     def prepare(self, spec, **kwargs):
         self.spec = dict(spec)
-        self.skip = np.random.rand() < self.skip_ratio
+        self.skip = self.rng.rand() < self.skip_ratio
 
         if self.skip:
             ret = spec
@@ -31,11 +32,15 @@ class MisalignAugment(data_augmentation.DataAugment):
                 max_trans = kwargs['max_trans']
             else:
                 max_trans = self.max_trans
+            # Translation should fit in the slack.
+            if kwargs.get('slack', None) is not None:
+                slack = kwargs['slack']
+                max_trans = max(min(max_trans, slack[1], slack[2]), 0)
 
             # Random translation.
             # Always lower box is translated.
-            self.x_t = int(round(max_trans * np.random.rand(1)))
-            self.y_t = int(round(max_trans * np.random.rand(1)))
+            self.x_t = int(round(max_trans * self.rng.rand()))
+            self.y_t = int(round(max_trans * self.rng.rand()))
 
             # Randomly draw x/y translation independently.
             ret, pvt, zs = dict(), dict(), list()
@@ -49,8 +54,8 @@ class MisalignAugment(data_augmentation.DataAugment):
                 zs.append(z)
 
             # Random direction of translation.
-            x_sign = np.random.choice(['+','-'])
-            y_sign = np.random.choice(['+','-'])
+            x_sign = self.rng.choice(['+','-'])
+            y_sign = self.rng.choice(['+','-'])
             self.x_t = int(eval(x_sign + str(self.x_t)))
             self.y_t = int(eval(y_sign + str(self.y_t)))
 
@@ -63,14 +68,14 @@ class MisalignAugment(data_augmentation.DataAugment):
             else:
                 self.do_augment = True
                 # Introduce misalignment at pivot.
-                pivot = np.random.randint(1, zmin - 1)
+                pivot = self.rng.randint(1, zmin - 1)
                 for k, v in pvt.iteritems():
                     offset = int(v - zmin)/2  # Compute offset.
                     pvt[k] = offset + pivot
                 self.pivot = pvt
 
             # Slip?
-            self.slip = np.random.rand() < self.slip_ratio
+            self.slip = self.rng.rand() < self.slip_ratio
 
         return ret
 
@@ -86,13 +91,13 @@ class MisalignAugment(data_augmentation.DataAugment):
         #     print "Slip = {}".format(self.slip)
         #     print "{} at {}".format(k, self.pivot[k])
 
-        ret = dict()
-
         if self.do_augment:
-            for k, v in sample.iteritems():
+            # Replace data in place, so that the key order is kept.
+            ret = sample
+            for k, v in sample.items():
                 # Ensure data is a 4D tensor.
                 data = check_tensor(v)
-                new_data = np.zeros(self.spec[k], dtype=data.dtype)
+                new_data = buffer_pool.zeros(self.spec[k], dtype=data.dtype)
                 new_data = check_tensor(new_data)
                 # Dimension.
                 z, y, x = v.shape[-3:]
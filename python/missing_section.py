@@ -8,6 +8,7 @@ Kisuk Lee <kisuklee@mit.edu>, 2017
 
 import data_augmentation
 import numpy as np
+from utils import writable
 
 class MissingAugment(data_augmentation.DataAugment):
     """
@@ -53,7 +54,7 @@ class MissingAugment(data_augmentation.DataAugment):
 
     def augment(self, sample, **kwargs):
         """Apply missing section data augmentation."""
-        if np.random.rand() > self.skip_ratio:
+        if self.rng.rand() > self.skip_ratio:
             sample = self._do_augment(sample, **kwargs)
 
         # DEBUG(kisuk): Record keeping.
@@ -75,7 +76,7 @@ class MissingAugment(data_augmentation.DataAugment):
     def _do_augment(self, sample, **kwargs):
         """Apply missing section data augmentation."""
         # Randomly draw the number of sections to introduce.
-        num_sec = np.random.randint(1, self.MAX_SEC + 1)
+        num_sec = self.rng.randint(1, self.MAX_SEC + 1)
 
         # DEBUG(kisuk)
         # print "num_sec = %d" % num_sec
@@ -85,6 +86,7 @@ class MissingAugment(data_augmentation.DataAugment):
         imgs = kwargs['imgs']
         dims = set([])
         for key in imgs:
+            sample[key] = writable(sample[key])
             dim = self.spec[key][-3:]
             assert num_sec < dim[-3]
             dims.add(dim)
@@ -96,13 +98,13 @@ class MissingAugment(data_augmentation.DataAugment):
 
         # Randomly draw z-slices to black out.
         if self.consecutive:
-            zloc  = np.random.randint(0, zdim - num_sec + 1)
+            zloc  = self.rng.randint(0, zdim - num_sec + 1)
             zlocs = range(zloc, zloc + num_sec)
         else:
-            zlocs = np.random.choice(zdim, num_sec, replace=False)
+            zlocs = self.rng.choice(zdim, num_sec, replace=False)
 
         # Fill-out value.
-        val = np.random.rand() if self.random_color else 0
+        val = self.rng.rand() if self.random_color else 0
 
         # Apply full or partial missing sections according to the mode.
         if self.mode == 'full':
@@ -110,21 +112,21 @@ class MissingAugment(data_augmentation.DataAugment):
                 sample[key][...,zlocs,:,:] = val
         else:
             # Draw a random xy-coordinate.
-            x = np.random.randint(0, xdim)
-            y = np.random.randint(0, ydim)
-            rule = np.random.rand(4) > 0.5
+            x = self.rng.randint(0, xdim)
+            y = self.rng.randint(0, ydim)
+            rule = self.rng.rand(4) > 0.5
 
             for z in zlocs:
-                val = np.random.rand() if self.random_color else 0
-                if self.mode == 'mix' and np.random.rand() > 0.5:
+                val = self.rng.rand() if self.random_color else 0
+                if self.mode == 'mix' and self.rng.rand() > 0.5:
                     for key in imgs:
                         sample[key][...,z,:,:] = val
                 else:
                     # Independent coordinates across sections.
                     if not self.consecutive:
-                        x = np.random.randint(0, xdim)
-                        y = np.random.randint(0, ydim)
-                        rule = np.random.rand(4) > 0.5
+                        x = self.rng.randint(0, xdim)
+                        y = self.rng.randint(0, ydim)
+                        rule = self.rng.rand(4) > 0.5
                     # 1st quadrant.
                     if rule[0]:
                         for key in imgs:
@@ -64,6 +64,8 @@ class Parser(object):
         self._treat_affinity(config)
         # Treat border.
         self._treat_border(config)
+        # Treat preprocessing cache.
+        self._treat_cache(config)
 
         # Dataset-specific params.
         dparams = dict()
@@ -225,3 +227,19 @@ class Parser(object):
             else:
                 msg = 'unknown border mode [%s].' % border_func['type']
                 raise RuntimeError(msg)
+
+    def _treat_cache(self, config):
+        """
+        Cache preprocessed data on disk, if params['cache'] is given as a
+        dictionary with 'dir' and optional 'max_size' (in bytes).
+        """
+        cache = self.params.get('cache', None)
+        if cache is not None:
+            for _, data in config.items('dataset'):
+                assert config.has_section(data)
+                # Data section-specific options take precedence.
+                if config.has_option(data, 'cache_dir'):
+                    continue
+                config.set(data, 'cache_dir', cache['dir'])
+                if cache.get('max_size', None) is not None:
+                    config.set(data, 'cache_size', str(cache['max_size']))
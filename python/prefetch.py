@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+__doc__ = """
+
+PrefetchDataProvider class.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import multiprocessing
+import Queue
+import traceback
+
+import numpy as np
+
+from data_provider import DataProvider, VolumeDataProvider, Sampler
+from data_provider import fill_batch
+from rng import RandomContext
+from sample import Sample
+from shared_ring import SharedRing
+
+class PrefetchDataProvider(DataProvider):
+    """
+    DataProvider prefetching samples in background worker processes.
+
+    Each worker builds its own VolumeDataProvider and Sampler, and pushes
+    finished (augmented and transformed) samples into a bounded queue, which
+    is drained by random_sample. Workers block when the queue is full.
+
+    With shared memory, workers write samples into the slots of a SharedRing
+    instead, and only slot indices are queued. random_sample copies a sample
+    out of its slot, and releases the slot at once. random_sample_view
+    returns zero-copy views of a slot instead, with a handle to release it.
+
+    Attributes:
+        num_workers: Number of worker processes.
+        queue_depth: Maximum number of samples waiting in the queue.
+        ring:        SharedRing, if shared memory is used.
+    """
+
+    def __init__(self, dspec_path, net_spec, params, auto_mask=True,
+                 transformers=None, num_workers=1, queue_depth=8, seed=None,
+                 shared_memory=False, layout=None):
+        """
+        Initialize PrefetchDataProvider, and start workers.
+
+        Args:
+            dspec_path:   Path to the dataset specification file.
+            net_spec:     Net specification.
+            params:       Various options (see VolumeDataProvider).
+            auto_mask:    Whether to automatically generate mask from
+                          corresponding label.
+            transformers: List of sample transformers (see Sampler).
+            num_workers:  Number of worker processes.
+            queue_depth:  Maximum number of samples waiting in the queue.
+            seed:         Base random seed. Worker i draws from an independent
+                          stream RandomContext(seed, i). Seeded randomly if
+                          None.
+            shared_memory: Whether to pass samples through shared memory.
+            layout:       Dictionary mapping key to (shape, dtype) of samples
+                          in shared memory. Taken from a sample drawn in the
+                          parent if None, after label transform and
+                          transformers.
+        """
+        assert num_workers > 0
+        assert queue_depth > 0
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+
+        if seed is None:
+            seed = RandomContext().seed
+        args = (dspec_path, net_spec, params, auto_mask)
+        transformers = list() if transformers is None else list(transformers)
+
+        # Shared memory, allocated before forking workers. Every worker may
+        # hold a slot while writing.
+        self.ring = None
+        self._held = 0  # Slots held by random_sample_view callers.
+        if shared_memory:
+            if layout is None:
+                layout = _layout(args, transformers, seed)
+            self.ring = SharedRing(layout, queue_depth + num_workers)
+
+        # Start workers.
+        self._queue = multiprocessing.Queue(queue_depth)
+        self._stop  = multiprocessing.Event()
+        self._workers = list()
+        for i in range(num_workers):
+            w = multiprocessing.Process(target=_worker,
+                    args=(i, args, transformers, seed, self._queue,
+                          self._stop, self.ring))
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+
+    def next_sample(self):
+        """Fetch next sample in a sample sequence."""
+        return self.random_sample()
+
+    def random_sample(self):
+        """
+        Fetch a prefetched sample. Blocks until a sample is ready, and raises
+        RuntimeError if a worker failed. With shared memory, the sample is
+        copied out of its slot.
+        """
+        sample, handle = self.random_sample_view()
+        if handle is not None:
+            with handle:
+                sample = Sample(((k, v.copy()) for k, v in sample.iteritems()),
+                                presorted=True)
+        return sample
+
+    def random_sample_view(self):
+        """
+        Fetch a prefetched sample, and a SlotHandle releasing it. With shared
+        memory, the sample is a zero-copy view of a slot, which must not be
+        used after release. Otherwise, handle is None. Raises RuntimeError
+        if every slot is held by the caller, which would block forever.
+        """
+        if self._stop.is_set():
+            raise RuntimeError('PrefetchDataProvider is closed.')
+        if self.ring is not None and self._held >= self.ring.num_slots:
+            raise RuntimeError('every slot of shared memory is held. '
+                               'Release samples of random_sample_view.')
+        dead = False
+        while True:
+            try:
+                msg, wid, payload = self._queue.get(timeout=1.0)
+            except Queue.Empty:
+                # A dead worker has flushed its error, if any, before exiting.
+                # Give it one more chance to be received.
+                if dead:
+                    self._check_workers()
+                dead = any(not w.is_alive() for w in self._workers)
+                continue
+            if msg == 'error':
+                self.close()
+                raise RuntimeError('worker %d failed:\n%s' % (wid, payload))
+            if msg == 'slot':
+                sample, handle = self.ring.read(payload)
+                self._held += 1
+                handle.on_release = self._on_release
+                return sample, handle
+            return payload, None
+
+    def random_batch(self, n):
+        """Fetch a batch of n prefetched samples."""
+        batch = None
+        for i in xrange(n):
+            sample, handle = self.random_sample_view()
+            batch = fill_batch(batch, i, n, sample)
+            if handle is not None:
+                handle.release()  # Copied into batch.
+        return batch
+
+    def close(self):
+        """Stop and join workers."""
+        if not hasattr(self, '_stop') or self._stop.is_set():
+            return
+        self._stop.set()
+        # Drain the queue, so that no worker blocks on putting a sample.
+        for w in self._workers:
+            while w.is_alive():
+                self._drain()
+                w.join(0.1)
+        self._drain()
+
+    def __del__(self):
+        self.close()
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _on_release(self):
+        self._held -= 1
+
+    def _check_workers(self):
+        """Raise RuntimeError if a worker died without reporting an error."""
+        for i, w in enumerate(self._workers):
+            if not w.is_alive():
+                self._drain()
+                self.close()
+                raise RuntimeError('worker %d died (exitcode %s).' % \
+                                   (i, w.exitcode))
+
+    def _drain(self):
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+def _layout(args, transformers, seed):
+    """
+    Return the layout of samples (see SharedRing) from the shapes and dtypes
+    of a sample drawn in the parent, so that any label transform or
+    transformer changing them (e.g. affinitize) is accounted for.
+    """
+    dp = VolumeDataProvider(*args)
+    dp.set_rng(RandomContext(seed))
+    sampler = Sampler(dp)
+    for f in transformers:
+        sampler.add_f(f)
+    sample = sampler()
+    layout = dict((k, (v.shape, v.dtype)) for k, v in sample.iteritems())
+    dp.release(sample)
+    dp.close()
+    return layout
+
+
+def _worker(wid, args, transformers, seed, queue, stop, ring=None):
+    """Worker process loop. Failures are reported through queue."""
+    try:
+        # Each worker has its own data provider, and its own random stream.
+        # Forked workers would otherwise share the parent's random state.
+        rng = RandomContext(seed, wid)
+        np.random.seed(rng.randint(2**31))  # For any other random draws.
+        dp = VolumeDataProvider(*args)
+        dp.set_rng(rng)
+        sampler = Sampler(dp)
+        for f in transformers:
+            sampler.add_f(f)
+
+        while not stop.is_set():
+            sample = sampler()
+            msg = ('sample', wid, sample)
+            if ring is not None:
+                # Wait for a free slot, and write sample into it.
+                slot = None
+                while slot is None and not stop.is_set():
+                    slot = ring.acquire(timeout=0.1)
+                if slot is None:
+                    break
+                ring.write(slot, sample)
+                dp.release(sample)
+                msg = ('slot', wid, slot)
+            while not stop.is_set():
+                try:
+                    queue.put(msg, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+    except:
+        # The error is flushed to the queue before the worker exits.
+        queue.put(('error', wid, traceback.format_exc()))
+
+    # Samples still buffered are flushed on exit, while close drains the queue.
+    # Cancelling the flush could leave a partially written sample behind.
+
+
+if __name__ == "__main__":
+
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    from data_provider import _make_spec
+
+    def _fail(sample):
+        raise ValueError('transformer failed')
+
+    def _die(sample):
+        os._exit(3)
+
+    ####################################################################
+    class UnitTestPrefetchDataProvider(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.spec = _make_spec(self.dir)
+            self.net_spec = {'input':(4,8,8),'label':(4,8,8)}
+            self.params = dict(drange=[0])
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def testReproducible(self):
+            dps = [PrefetchDataProvider(self.spec, self.net_spec, self.params,
+                                        num_workers=1, seed=7)
+                   for _ in xrange(2)]
+            for _ in xrange(4):
+                s1, s2 = [dp.random_sample() for dp in dps]
+                self.assertTrue(sorted(s1.keys())==sorted(s2.keys()))
+                for k in s1:
+                    self.assertTrue(np.array_equal(s1[k], s2[k]))
+            for dp in dps:
+                dp.close()
+
+        def testWorkerError(self):
+            dp = PrefetchDataProvider(self.spec, self.net_spec, self.params,
+                                      transformers=[_fail], num_workers=2)
+            with self.assertRaises(RuntimeError) as cm:
+                dp.random_sample()
+            self.assertTrue('transformer failed' in str(cm.exception))
+            # Workers are stopped, and the provider is closed.
+            self.assertTrue(all(not w.is_alive() for w in dp._workers))
+            self.assertRaises(RuntimeError, dp.random_sample)
+
+        def testSharedMemory(self):
+            dps = [PrefetchDataProvider(self.spec, self.net_spec, self.params,
+                                        num_workers=1, queue_depth=2, seed=7,
+                                        shared_memory=shm)
+                   for shm in [False, True]]
+            # Samples are copied out of their slots, so that they outlive
+            # the slots reused by later samples.
+            samples = [[dp.random_sample() for _ in xrange(6)] for dp in dps]
+            for s1, s2 in zip(*samples):
+                self.assertTrue(sorted(s1.keys())==sorted(s2.keys()))
+                for k in s1:
+                    self.assertTrue(np.array_equal(s1[k], s2[k]))
+            for dp in dps:
+                dp.close()
+
+        def testHoldEverySlot(self):
+            dp = PrefetchDataProvider(self.spec, self.net_spec, self.params,
+                                      num_workers=1, queue_depth=1,
+                                      shared_memory=True)
+            handles = [dp.random_sample_view()[1]
+                       for _ in xrange(dp.ring.num_slots)]
+            self.assertRaises(RuntimeError, dp.random_sample_view)
+            handles[0].release()
+            sample, handle = dp.random_sample_view()
+            self.assertEqual(sample['input'].shape, (1,4,8,8))
+            for h in handles + [handle]:
+                h.release()
+            dp.close()
+
+        def testSharedMemoryTransform(self):
+            # Affinitize changes the number of channels of label.
+            spec = _make_spec(self.dir, transform="dict(type='affinitize')")
+            dp = PrefetchDataProvider(spec, self.net_spec, self.params,
+                                      num_workers=1, shared_memory=True)
+            self.assertEqual(dict((k, s) for k, s, _ in dp.ring.layout),
+                             dict(input=(1,4,8,8), label=(3,4,8,8),
+                                  label_mask=(3,4,8,8)))
+            sample = dp.random_sample()
+            self.assertEqual(sample['label'].shape, (3,4,8,8))
+            dp.close()
+
+        def testWorkerDeath(self):
+            dp = PrefetchDataProvider(self.spec, self.net_spec, self.params,
+                                      transformers=[_die], num_workers=1)
+            with self.assertRaises(RuntimeError) as cm:
+                dp.random_sample()
+            self.assertTrue('died' in str(cm.exception))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Replay buffer of raw patches.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import threading
+
+from vector import Vec3d, maximum
+
+class ReplayBuffer(object):
+    """
+    In-memory buffer of raw (pre-augmentation) samples, per dataset.
+
+    Raw samples are read in the largest size required by data augmentation
+    so far, so that a buffered sample can be cropped to any later draw of
+    augmentation parameters and re-augmented (see DataAugmentor). Buffered
+    data are read-only, and copied by whoever writes to them.
+
+    Once the buffer of a dataset is full, a sample is replayed from it with
+    probability reuse, and read otherwise. A newly read sample replaces a
+    uniformly random entry, so that every raw sample is augmented about
+    1/(1 - reuse) times on average, and is kept for about capacity reads.
+
+    A buffer may be shared by several copies of DataAugmentor, e.g. the
+    executor threads of VolumeDataProvider, and is safe to use from several
+    threads.
+
+    Attributes:
+        capacity: Maximum number of raw samples per dataset.
+        reuse:    Probability of replaying a buffered sample, in [0,1).
+        stats:    Dictionary counting reads and replays.
+    """
+
+    def __init__(self, capacity=64, reuse=0.5):
+        assert capacity > 0
+        assert 0 <= reuse < 1
+        self.capacity = capacity
+        self.reuse = reuse
+        self.stats = dict(reads=0, replays=0)
+        self._entries = dict()  # Dataset ID to list of entries.
+        self._margin  = dict()  # Dataset ID to the largest enlargement.
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def draw(self, dataset, u, v):
+        """
+        Return a buffered entry (sample, transform, slack, center) of
+        dataset to replay, or None if a new sample should be read.
+
+        Args:
+            dataset: VolumeDataset.
+            u, v:    Uniform random numbers in [0,1).
+        """
+        with self._lock:
+            entries = self._entries.get(id(dataset), None)
+            if entries is None or len(entries) < self.capacity or \
+               u >= self.reuse:
+                return None
+            self.stats['replays'] += 1
+            return entries[int(v*len(entries))]
+
+    def enlarge(self, dataset, base, spec):
+        """
+        Return spec enlarged to the largest size required so far, given the
+        dataset spec base and a prepared spec.
+        """
+        e = _enlargement(base, spec)
+        with self._lock:
+            m = self._margin.get(id(dataset), Vec3d(0,0,0))
+            m = maximum(m, e)
+            self._margin[id(dataset)] = m
+        ret = dict()
+        for k, v in spec.iteritems():
+            ret[k] = v[:-3] + tuple(Vec3d(base[k][-3:]) + m)
+        return ret
+
+    def put(self, dataset, base, sample, transform, u, center=None):
+        """
+        Buffer a newly read sample of dataset, and return its entry.
+
+        Args:
+            dataset:   VolumeDataset.
+            base:      Dataset spec.
+            sample:    Raw sample, read-only afterwards.
+            transform: Label transform of sample.
+            u:         Uniform random number in [0,1).
+            center:    Sample center.
+        """
+        for data in sample.values():
+            data.flags.writeable = False
+        # Slack of replay, i.e. the enlargement common to every data.
+        spec = dict((k, v.shape) for k, v in sample.iteritems())
+        slack = _enlargement(base, spec, reduce=min)
+        entry = (sample, transform, slack, center)
+        with self._lock:
+            self.stats['reads'] += 1
+            entries = self._entries.setdefault(id(dataset), list())
+            if len(entries) < self.capacity:
+                entries.append(entry)
+            else:
+                entries[int(u*len(entries))] = entry
+        return entry
+
+    def replay_rate(self):
+        """Return the fraction of samples replayed."""
+        total = self.stats['reads'] + self.stats['replays']
+        return self.stats['replays'] / float(max(total, 1))
+
+
+def crop(sample, spec):
+    """
+    Return a sample whose every data is center-cropped to the size in spec,
+    as a view (see TensorData.get_patch for center alignment).
+    """
+    ret = sample.copy()
+    for k, v in sample.iteritems():
+        s = Vec3d(v.shape[-3:])
+        d = Vec3d(spec[k][-3:])
+        vmin = s/2 - d/2
+        vmax = vmin + d
+        assert vmin == maximum(vmin, (0,0,0))
+        ret[k] = v[...,vmin[0]:vmax[0],vmin[1]:vmax[1],vmin[2]:vmax[2]]
+    return ret
+
+
+def _enlargement(base, spec, reduce=max):
+    """Return the largest (or smallest) enlargement from base to spec."""
+    e = None
+    for k, v in spec.iteritems():
+        d = Vec3d(v[-3:]) - Vec3d(base[k][-3:])
+        e = d if e is None else Vec3d([reduce(x, y) for x, y in zip(e, d)])
+    return e
+
+
+if __name__ == "__main__":
+
+    import pickle
+    import threading
+    import unittest
+
+    import numpy as np
+
+    ####################################################################
+    class UnitTestReplayBuffer(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testReplay(self):
+            rb = ReplayBuffer(capacity=2, reuse=0.5)
+            base = dict(input=(4,4,4))
+            sample = dict(input=np.zeros((1,6,8,8)))
+            self.assertTrue(rb.draw('d', 0.0, 0.0) is None)
+            entry = rb.put('d', base, sample, None, 0.0, (1,2,3))
+            self.assertEqual(entry[2:], ((2,4,4), (1,2,3)))
+            self.assertFalse(sample['input'].flags.writeable)
+            # Replayed only once full, with probability reuse.
+            self.assertTrue(rb.draw('d', 0.0, 0.0) is None)
+            rb.put('d', base, dict(input=np.ones((1,4,4,4))), None, 0.0)
+            self.assertTrue(rb.draw('d', 0.5, 0.0) is None)
+            self.assertTrue(rb.draw('d', 0.4, 0.0) is entry)
+            self.assertEqual(rb.stats, dict(reads=2, replays=1))
+
+        def testThreads(self):
+            rb = ReplayBuffer(capacity=8, reuse=0.5)
+            base = dict(input=(4,4,4))
+            d = object()  # Dataset.
+            def run(seed):
+                rng = np.random.RandomState(seed)
+                for _ in xrange(500):
+                    if rb.draw(d, rng.rand(), rng.rand()) is None:
+                        rb.enlarge(d, base, dict(input=(5,6,7)))
+                        sample = dict(input=np.zeros((1,5,6,7)))
+                        rb.put(d, base, sample, None, rng.rand())
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(rb.stats['reads'] + rb.stats['replays'], 2000)
+            self.assertEqual(len(rb._entries[id(d)]), 8)
+            # The lock is not pickled, but recreated.
+            rb2 = pickle.loads(pickle.dumps(rb))
+            self.assertEqual(rb2.stats, rb.stats)
+            self.assertTrue(rb2.draw(d, 0.0, 0.0) is not None)
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
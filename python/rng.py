@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Random number context for the sampling stack.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import os
+
+import numpy as np
+
+class RandomContext(object):
+    """
+    Independent, seedable random number stream.
+
+    Wraps numpy RandomState. Scalar uniform draws (rand() and randint() without
+    size), which dominate data augmentation, are served from a block of
+    numbers drawn at once. Any other RandomState method (choice, multinomial,
+    normal, ...) is delegated to the underlying RandomState.
+
+    Contexts with the same seed and different worker IDs give independent
+    streams, so that parallel workers need not be reseeded by hand.
+    """
+
+    def __init__(self, seed=None, worker_id=None, block_size=1024):
+        """
+        Initialize RandomContext.
+
+        Args:
+            seed:       Base seed. Drawn from OS entropy if None.
+            worker_id:  Optional worker ID, combined with seed.
+            block_size: Number of scalar uniform numbers drawn at once.
+        """
+        if seed is None:
+            seed = int(np.frombuffer(os.urandom(4), dtype='uint32')[0])
+        self.seed = seed
+        self.worker_id = worker_id
+        if worker_id is None:
+            self._rs = np.random.RandomState(seed)
+        else:
+            self._rs = np.random.RandomState([seed, worker_id])
+        self._block_size = block_size
+        self._block = list()
+
+    def spawn(self, worker_id):
+        """Return an independent context for worker_id."""
+        return RandomContext(self.seed, worker_id, self._block_size)
+
+    def rand(self, *shape):
+        """Uniform random number(s) in [0,1)."""
+        if len(shape) == 0:
+            return self._next()
+        return self._rs.rand(*shape)
+
+    def randint(self, low, high=None, size=None):
+        """Random integer(s) in [low,high), or [0,low) if high is None."""
+        if size is not None:
+            return self._rs.randint(low, high, size)
+        if high is None:
+            low, high = 0, low
+        if high <= low:
+            raise ValueError('low >= high')
+        return low + int(self._next() * (high - low))
+
+    def __getattr__(self, name):
+        # Private attributes are never delegated (e.g. while unpickling).
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._rs, name)
+
+    def _next(self):
+        """Return the next scalar uniform number from the block."""
+        try:
+            return self._block.pop()
+        except IndexError:
+            self._block = self._rs.rand(self._block_size).tolist()
+            return self._block.pop()
+
+
+if __name__ == "__main__":
+
+    import pickle
+    import unittest
+
+    ####################################################################
+    class UnitTestRandomContext(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testReproducible(self):
+            r1 = RandomContext(7, 1)
+            r2 = RandomContext(7, 1)
+            # Mixed scalar, array, and delegated draws.
+            for _ in xrange(3000):
+                self.assertEqual(r1.rand(), r2.rand())
+                self.assertEqual(r1.randint(5, 9), r2.randint(5, 9))
+            self.assertTrue(np.array_equal(r1.rand(2,3), r2.rand(2,3)))
+            self.assertTrue(np.array_equal(r1.normal(size=4),
+                                           r2.normal(size=4)))
+            self.assertEqual(r1.rand(), r2.rand())
+            # Pickled mid-block.
+            r3 = pickle.loads(pickle.dumps(r1))
+            self.assertTrue(np.array_equal([r1.rand() for _ in xrange(2000)],
+                                           [r3.rand() for _ in xrange(2000)]))
+
+        def testIndependentStreams(self):
+            base = RandomContext(7)
+            streams = [base.spawn(i) for i in xrange(4)]
+            draws = np.array([[r.rand() for _ in xrange(4096)]
+                              for r in streams])
+            # Same as constructing directly.
+            r = RandomContext(7, 2)
+            self.assertTrue(np.array_equal(draws[2],
+                                           [r.rand() for _ in xrange(4096)]))
+            # Distinct, and uncorrelated.
+            corr = np.corrcoef(draws)
+            for i in xrange(4):
+                for j in xrange(i + 1, 4):
+                    self.assertFalse(np.array_equal(draws[i], draws[j]))
+                    self.assertTrue(abs(corr[i,j]) < 0.1)
+            # Streams do not depend on the order of draws across them.
+            r1, r2 = base.spawn(0), base.spawn(1)
+            r2.rand(); r2.rand()
+            self.assertTrue(np.array_equal(draws[0][:8],
+                                           [r1.rand() for _ in xrange(8)]))
+
+        def testRange(self):
+            r = RandomContext(3)
+            x = np.array([r.rand() for _ in xrange(5000)])
+            self.assertTrue(np.all(x >= 0) and np.all(x < 1))
+            k = np.array([r.randint(2, 5) for _ in xrange(5000)])
+            self.assertTrue(set(k.tolist()) == set([2,3,4]))
+            k = np.array([r.randint(3) for _ in xrange(5000)])
+            self.assertTrue(set(k.tolist()) == set([0,1,2]))
+            self.assertRaises(ValueError, r.randint, 3, 3)
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Sample containers.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+from collections import Mapping, MutableMapping
+from itertools import izip
+
+class FrozenDict(Mapping):
+    """
+    Immutable mapping with a fixed key order, e.g. for specs and transforms
+    that are precomputed once and shared without copying.
+    """
+
+    __slots__ = ('_keys', '_dict')
+
+    def __init__(self, items=()):
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        self._keys = tuple(k for k, _ in items)
+        self._dict = dict(items)
+        assert len(self._keys) == len(self._dict)
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self):
+        return [(k, self._dict[k]) for k in self._keys]
+
+    def iteritems(self):
+        d = self._dict
+        return ((k, d[k]) for k in self._keys)
+
+    def __reduce__(self):
+        return (FrozenDict, (self.items(),))
+
+    def __repr__(self):
+        return 'FrozenDict(%r)' % self.items()
+
+
+# Key layouts shared by every sample with the same keys.
+_layouts = dict()
+
+def _layout(keys):
+    """Return the shared (keys, key-to-index) layout of sorted keys."""
+    try:
+        return _layouts[keys]
+    except KeyError:
+        layout = (keys, dict((k, i) for i, k in enumerate(keys)))
+        return _layouts.setdefault(keys, layout)
+
+
+class Sample(MutableMapping):
+    """
+    Sample, mapping key to data, iterated in the sorted key order.
+
+    Samples with the same keys share one key layout, so that neither
+    creating nor updating a sample sorts keys. Only adding or deleting a key
+    (e.g. by a transformer) changes the layout.
+    """
+
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, items=(), presorted=False):
+        """
+        Initialize Sample.
+
+        Args:
+            items:     Mapping or (key, data) pairs.
+            presorted: Whether items are already sorted by key.
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        if not presorted:
+            items = sorted(items, key=lambda x: x[0])
+        else:
+            items = list(items)
+        self._layout = _layout(tuple(k for k, _ in items))
+        self._values = [v for _, v in items]
+        assert len(self._layout[0]) == len(self._values)
+
+    def __getitem__(self, key):
+        return self._values[self._layout[1][key]]
+
+    def __setitem__(self, key, value):
+        i = self._layout[1].get(key, None)
+        if i is None:
+            items = self.items() + [(key, value)]
+            self.__init__(items)
+        else:
+            self._values[i] = value
+
+    def __delitem__(self, key):
+        i = self._layout[1][key]
+        items = self.items()
+        del items[i]
+        self.__init__(items, presorted=True)
+
+    def __iter__(self):
+        return iter(self._layout[0])
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._layout[1]
+
+    def keys(self):
+        return list(self._layout[0])
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._layout[0], self._values)
+
+    def iteritems(self):
+        return izip(self._layout[0], self._values)
+
+    def copy(self):
+        """Return a shallow copy."""
+        ret = Sample.__new__(Sample)
+        ret._layout = self._layout
+        ret._values = list(self._values)
+        return ret
+
+    def __reduce__(self):
+        return (Sample, (self.items(), True))
+
+    def __repr__(self):
+        return 'Sample(%r)' % self.items()
+
+
+if __name__ == "__main__":
+
+    import copy
+    import pickle
+    import unittest
+
+    ####################################################################
+    class UnitTestFrozenDict(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testOrderAndImmutability(self):
+            d = FrozenDict([('b',1), ('a',2)])
+            self.assertEqual(d.keys(), ['b','a'])
+            self.assertEqual(d.items(), [('b',1), ('a',2)])
+            self.assertEqual(list(d.iteritems()), [('b',1), ('a',2)])
+            self.assertEqual(d['a'], 2)
+            self.assertTrue('b' in d and 'c' not in d)
+            self.assertEqual(d, {'a':2, 'b':1})
+            def assign():
+                d['c'] = 3
+            self.assertRaises(TypeError, assign)
+            self.assertEqual(d.get('c', 3), 3)
+
+        def testPickle(self):
+            d = FrozenDict([('b',(1,2)), ('a',None)])
+            for x in [pickle.loads(pickle.dumps(d)), copy.deepcopy(d)]:
+                self.assertTrue(isinstance(x, FrozenDict))
+                self.assertEqual(x.items(), d.items())
+
+
+    ####################################################################
+    class UnitTestSample(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testSorted(self):
+            s = Sample({'b':1, 'c':2, 'a':3})
+            self.assertEqual(s.keys(), ['a','b','c'])
+            self.assertEqual(s.values(), [3,1,2])
+            s['d'] = 4
+            s['0'] = 5
+            self.assertEqual(s.keys(), ['0','a','b','c','d'])
+            del s['b']
+            self.assertEqual(s.items(),
+                             [('0',5), ('a',3), ('c',2), ('d',4)])
+            self.assertRaises(KeyError, s.__getitem__, 'b')
+
+        def testSharedLayout(self):
+            s1 = Sample({'b':1, 'a':2})
+            s2 = Sample([('a',3), ('b',4)], presorted=True)
+            self.assertTrue(s1._layout is s2._layout)
+            # Updating a key keeps the layout.
+            s1['a'] = 5
+            self.assertTrue(s1._layout is s2._layout)
+            self.assertEqual(s2['a'], 3)
+
+        def testCopy(self):
+            s = Sample({'a':1, 'b':2})
+            c = s.copy()
+            c['a'] = 3
+            c['c'] = 4
+            self.assertEqual(s.items(), [('a',1), ('b',2)])
+            self.assertEqual(c.items(), [('a',3), ('b',2), ('c',4)])
+            p = pickle.loads(pickle.dumps(s))
+            self.assertTrue(isinstance(p, Sample))
+            self.assertEqual(p.items(), s.items())
+            self.assertEqual(dict(s), {'a':1, 'b':2})
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Sample server and client over a local socket.
+
+A SampleServer hosts one VolumeDataProvider, whose datasets are loaded once,
+and serves samples to any number of SampleClients over a Unix domain socket
+('unix:/path/to/socket') or a localhost TCP socket ('host:port'). Samples
+are augmented concurrently by the executor of the provider (see
+VolumeDataProvider.random_sample_async).
+
+Framing. Every request is a command byte and a uint32 count, 'S' for a
+sample, 'B' for a batch of count samples. Every response is a status byte,
+followed by either an error message ('E'), or named arrays ('O'):
+
+    uint32 number of arrays, then for each array,
+        uint16 key length, key,
+        uint8 dtype length, dtype (numpy dtype string, e.g. '<f4'),
+        uint8 ndim, uint32 dims, and the C-ordered data.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+from collections import OrderedDict
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import traceback
+
+import numpy as np
+
+from data_provider import DataProvider, VolumeDataProvider, fill_batch
+
+def parse_address(address):
+    """Return (socket family, address) from 'unix:path' or 'host:port'."""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def send_arrays(sock, arrays):
+    """
+    Send a mapping of key to array, in the key order. Raises RuntimeError
+    before sending anything if an array holds Python objects.
+    """
+    header = [struct.pack('!cI', 'O', len(arrays))]
+    data = list()
+    for key in sorted(arrays.keys()):
+        # C-ordered, keeping 0-d arrays 0-d.
+        arr = np.require(arrays[key], requirements='C')
+        if arr.dtype.hasobject:
+            raise RuntimeError('[%s] of dtype %s cannot be sent.' % \
+                               (key, arr.dtype))
+        dtype = arr.dtype.str
+        header.append(struct.pack('!H', len(key)) + key)
+        header.append(struct.pack('!B', len(dtype)) + dtype)
+        header.append(struct.pack('!B%dI' % arr.ndim, arr.ndim, *arr.shape))
+        data.append(arr)
+    sock.sendall(''.join(header))
+    for arr in data:
+        if arr.size > 0:
+            sock.sendall(memoryview(arr.reshape(-1).view('uint8')))
+
+
+def send_error(sock, msg):
+    """Send an error message."""
+    sock.sendall(struct.pack('!cI', 'E', len(msg)) + msg)
+
+
+def recv_arrays(sock):
+    """
+    Receive arrays sent by send_arrays, directly into newly allocated arrays.
+    Raises RuntimeError on an error message.
+
+    Returns:
+        OrderedDict mapping key to array, in the key order.
+    """
+    status, n = struct.unpack('!cI', _recv_exact(sock, 5))
+    if status == 'E':
+        raise RuntimeError('sample server failed:\n%s' % _recv_exact(sock, n))
+    assert status == 'O'
+    specs = list()
+    for _ in xrange(n):
+        key = _recv_exact(sock, struct.unpack('!H', _recv_exact(sock, 2))[0])
+        dtype = _recv_exact(sock, struct.unpack('!B', _recv_exact(sock, 1))[0])
+        ndim = struct.unpack('!B', _recv_exact(sock, 1))[0]
+        shape = struct.unpack('!%dI' % ndim, _recv_exact(sock, 4*ndim))
+        specs.append((key, dtype, shape))
+    ret = OrderedDict()
+    for key, dtype, shape in specs:
+        arr = np.empty(shape, dtype=dtype)
+        if arr.size > 0:
+            _recv_into(sock, arr.reshape(-1).view('uint8'))
+        ret[key] = arr
+    return ret
+
+
+class SampleServer(object):
+    """
+    Server of samples from one VolumeDataProvider.
+
+    Attributes:
+        dp:      VolumeDataProvider.
+        address: Address served.
+    """
+
+    def __init__(self, dp, address):
+        """
+        Initialize SampleServer, and bind address.
+
+        Args:
+            dp:      VolumeDataProvider.
+            address: 'unix:path' or 'host:port'.
+        """
+        self.dp = dp
+        self.address = address
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.remove(addr)  # Stale socket.
+            self._server = _UnixServer(addr, _Handler)
+        else:
+            self._server = _TCPServer(addr, _Handler)
+        self._server.dp = dp
+        self._thread = None
+
+    def serve_forever(self):
+        """Serve until shutdown."""
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Stop serving, and close the socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+class _UnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    """Connection handler, serving requests until the client disconnects."""
+
+    def handle(self):
+        sock, dp = self.request, self.server.dp
+        while True:
+            try:
+                cmd, n = struct.unpack('!cI', _recv_exact(sock, 5))
+            except (EOFError, socket.error):
+                return
+            try:
+                if cmd == 'S':
+                    arrays = dp.random_sample_async().result()
+                elif cmd == 'B':
+                    arrays = self._batch(dp, n)
+                else:
+                    raise RuntimeError('unknown command [%s]' % cmd)
+            except:
+                try:
+                    send_error(sock, traceback.format_exc())
+                    continue
+                except socket.error:
+                    return
+            try:
+                send_arrays(sock, arrays)
+            except:
+                # A partially sent frame cannot be followed by an error
+                # message, so the client is left to see the connection close.
+                return
+            finally:
+                if cmd == 'S':
+                    dp.release(arrays)
+
+    def _batch(self, dp, n):
+        """
+        Draw n samples concurrently, and batch them. If any sample fails,
+        the rest are cancelled or released, and the first error is raised.
+        """
+        pending = [dp.random_sample_async() for _ in xrange(n)]
+        batch, error = None, None
+        for i, r in enumerate(pending):
+            if error is not None and r.cancel():
+                continue
+            try:
+                sample = r.result()
+            except:
+                if error is None:
+                    error = sys.exc_info()
+                continue
+            try:
+                if error is None:
+                    batch = fill_batch(batch, i, n, sample)
+            except:
+                error = sys.exc_info()
+            finally:
+                dp.release(sample)  # Copied into batch, or discarded.
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return batch
+
+
+class SampleClient(DataProvider):
+    """
+    DataProvider fetching samples from a SampleServer.
+    """
+
+    def __init__(self, address):
+        family, addr = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(addr)
+
+    def next_sample(self):
+        return self.random_sample()
+
+    def random_sample(self):
+        """Fetch a sample (OrderedDict mapping key to array)."""
+        self._sock.sendall(struct.pack('!cI', 'S', 0))
+        return recv_arrays(self._sock)
+
+    def random_batch(self, n):
+        """Fetch a batch of n samples, drawn concurrently by the server."""
+        self._sock.sendall(struct.pack('!cI', 'B', n))
+        return recv_arrays(self._sock)
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+####################################################################
+## Private Helper Methods
+####################################################################
+
+def _recv_exact(sock, n):
+    """Receive exactly n bytes. Raises EOFError if the peer closed."""
+    chunks = list()
+    while n > 0:
+        chunk = sock.recv(n)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_into(sock, buf):
+    """Receive into a uint8 array, until it is full."""
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        k = sock.recv_into(view[pos:], len(view) - pos)
+        if k == 0:
+            raise EOFError
+        pos += k
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import ast
+    import shutil
+    import tempfile
+    import unittest
+
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    class _Provider(DataProvider):
+        """Provider of samples filled with their index, failing at fail."""
+        def __init__(self, fail=None, bad=False):
+            self.fail = fail
+            self.bad = bad
+            self.drawn = list()
+            self.produced = list()
+            self.released = list()
+            self._lock = threading.Lock()
+            self._executor = ThreadPoolExecutor(2)
+        def random_sample_async(self):
+            with self._lock:
+                i = len(self.drawn)
+                self.drawn.append(i)
+            return self._executor.submit(self._sample, i)
+        def release(self, sample):
+            with self._lock:
+                self.released.append(int(sample['input'].flat[0]))
+        def _sample(self, i):
+            if i == self.fail:
+                raise ValueError('sample %d failed' % i)
+            sample = dict(input=np.full((1,2,3,4), i, dtype='float32'),
+                          label=np.full((3,2,3,4), i, dtype='uint8'))
+            if self.bad:
+                sample['bad'] = object()  # Not sendable.
+            with self._lock:
+                self.produced.append(i)
+            return sample
+
+    ####################################################################
+    class UnitTestFraming(unittest.TestCase):
+
+        def setUp(self):
+            self.socks = socket.socketpair()
+
+        def tearDown(self):
+            for sock in self.socks:
+                sock.close()
+
+        def testRoundTrip(self):
+            arrays = dict(b=np.arange(24, dtype='>i2').reshape(2,3,4),
+                          a=np.random.rand(3,5).astype('float32')[:,::2],
+                          empty=np.zeros((0,4), dtype='uint8'),
+                          scalar=np.array(3.5))
+            send_arrays(self.socks[0], arrays)
+            ret = recv_arrays(self.socks[1])
+            self.assertEqual(ret.keys(), sorted(arrays.keys()))
+            for k, v in arrays.iteritems():
+                self.assertEqual(ret[k].dtype, v.dtype)
+                self.assertTrue(np.array_equal(ret[k], v))
+
+        def testError(self):
+            send_error(self.socks[0], 'worker failed')
+            send_arrays(self.socks[0], dict(a=np.ones(3)))
+            with self.assertRaises(RuntimeError) as cm:
+                recv_arrays(self.socks[1])
+            self.assertTrue('worker failed' in str(cm.exception))
+            # The stream is still in sync.
+            self.assertTrue(np.array_equal(recv_arrays(self.socks[1])['a'],
+                                           np.ones(3)))
+
+    ####################################################################
+    class UnitTestSampleServer(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.address = 'unix:' + os.path.join(self.dir, 'test.sock')
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _serve(self, dp):
+            server = SampleServer(dp, self.address)
+            server.start()
+            self.addCleanup(server.shutdown)
+            client = SampleClient(self.address)
+            self.addCleanup(client.close)
+            return client
+
+        def testSampleAndBatch(self):
+            dp = _Provider()
+            client = self._serve(dp)
+            sample = client.random_sample()
+            self.assertEqual(sample.keys(), ['input','label'])
+            self.assertEqual(sample['label'].dtype, np.uint8)
+            batch = client.random_batch(3)
+            self.assertEqual(batch['input'].shape, (3,1,2,3,4))
+            self.assertEqual(sorted(batch['input'][:,0,0,0,0]), [1,2,3])
+            self.assertEqual(sorted(dp.released), dp.drawn)
+            self.assertEqual(sorted(dp.produced), dp.drawn)
+
+        def testBatchError(self):
+            dp = _Provider(fail=1)
+            client = self._serve(dp)
+            with self.assertRaises(RuntimeError) as cm:
+                client.random_batch(4)
+            self.assertTrue('sample 1 failed' in str(cm.exception))
+            # Samples after the failure are cancelled, or released.
+            self.assertEqual(sorted(dp.released), sorted(dp.produced))
+            self.assertTrue(0 in dp.released)
+            self.assertEqual(client.random_sample()['input'].flat[0], 4)
+
+        def testSendError(self):
+            client = self._serve(_Provider(bad=True))
+            # The connection is closed, as the frame may be partially sent.
+            self.assertRaises(EOFError, client.random_sample)
+
+        def testPartialFrame(self):
+            client = self._serve(_Provider())
+            send = globals()['send_arrays']
+            def fail(sock, arrays):
+                sock.sendall(struct.pack('!cI', 'O', len(arrays)))
+                raise ValueError('failed mid-frame')
+            globals()['send_arrays'] = fail
+            try:
+                # The client sees the connection close, instead of an error
+                # message in the middle of the frame.
+                self.assertRaises(EOFError, client.random_sample)
+            finally:
+                globals()['send_arrays'] = send
+
+    ####################################################################
+
+    # 'python sample_server.py test' runs the unit tests.
+    if sys.argv[1:] == ['test']:
+        del sys.argv[1]
+        unittest.main()
+    else:
+        parser = argparse.ArgumentParser(description='Serve samples.')
+        parser.add_argument('dspec_path',
+                            help='dataset specification file')
+        parser.add_argument('net_spec',
+                            help="net spec, e.g. \"{'input':(18,160,160)}\"")
+        parser.add_argument('params',
+                            help="params, e.g. \"{'drange':[0,1]}\"")
+        parser.add_argument('--address',
+                            default='unix:/tmp/sample_server.sock',
+                            help="'unix:path' or 'host:port'")
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of augmentation threads')
+        parser.add_argument('--no-auto-mask', dest='auto_mask',
+                            action='store_false')
+        args = parser.parse_args()
+
+        # Literals only, so that arguments cannot run code.
+        params = ast.literal_eval(args.params)
+        params.setdefault('async_workers', args.workers)
+        net_spec = ast.literal_eval(args.net_spec)
+        dp = VolumeDataProvider(args.dspec_path, net_spec, params,
+                                auto_mask=args.auto_mask)
+        server = SampleServer(dp, args.address)
+        print 'serving on %s' % args.address
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            dp.close()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Deterministic sharding of datasets across ranks.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import math
+
+import emio
+from box import Box
+from vector import Vec3d
+
+def valid_range(config):
+    """
+    Return the valid range of a dataset from a ConfigParser object generated
+    by Parser's parse_dataset method, reading only file headers, or None if
+    empty. Preprocessing is assumed to preserve shape.
+    """
+    rg = None
+    for name, section in config.items('dataset'):
+        if '_mask' in section:
+            continue  # Same shape as the corresponding label.
+        dim = Vec3d(_shape(config, section)[-3:])
+        top, btm = _margin(config, section, dim)
+        offset = Vec3d(_option(config, section, 'offset', (0,0,0)))
+        # See TensorData._range.
+        r = Box(offset + top, offset + dim - btm)
+        rg = r if rg is None else rg.intersect(r)
+        if rg is None:
+            return None
+    return rg
+
+
+def estimate_num_sample(config):
+    """
+    Estimate the number of samples in the valid range of a dataset (see
+    valid_range), without reading any volume.
+    """
+    rg = valid_range(config)
+    return 0 if rg is None else rg.volume()
+
+
+def crop(config, boxes, margin=0):
+    """
+    Crop every data read from file to the z-slices covered by samples
+    centered in boxes, by setting its zrange option (see ConfigData), so that
+    only those slices are read. Lazy data, which is read on demand, and data
+    of any preprocessing not computed slice by slice (e.g. mirror_border,
+    rescale, or standardize in 3D), whose result depends on the whole volume,
+    are left intact.
+
+    Args:
+        config: ConfigParser object generated by Parser's parse_dataset.
+        boxes:  List of boxes in the global coordinate system.
+        margin: Extra z-slices on both sides, e.g. for data augmentation
+                enlarging samples.
+    """
+    z0 = min(b.min()[0] for b in boxes)
+    z1 = max(b.max()[0] for b in boxes)
+    for _, section in config.items('dataset'):
+        if not config.has_option(section, 'file'):
+            continue
+        if config.has_option(section, 'lazy') and \
+           config.getboolean(section, 'lazy'):
+            continue
+        if not all(_slice_local(pp) for pp in _preprocess(config, section)):
+            continue
+        fov = Vec3d(_option(config, section, 'fov', (0,0,0)))
+        if fov == (0,0,0):
+            continue  # Samples cover the whole volume.
+        top, btm = _margin(config, section, fov)
+        zrange = (z0 - top[0] - margin, z1 + btm[0] + margin)
+        config.set(section, 'zrange', zrange)
+
+
+def assign(weights, world_size, replicas=1):
+    """
+    Assign weighted units to ranks by greedy longest-processing-time: units
+    are taken in the decreasing order of weight, and each goes to the
+    replicas least loaded ranks. Ties are broken by index, so that every
+    rank computes the same assignment.
+
+    Args:
+        weights:    List of unit weights.
+        world_size: Number of ranks.
+        replicas:   Number of ranks each unit is assigned to.
+
+    Returns:
+        List of sorted unit indices, per rank.
+    """
+    assert world_size > 0
+    assert 0 < replicas <= world_size
+    load  = [0] * world_size
+    owned = [list() for _ in xrange(world_size)]
+    order = sorted(xrange(len(weights)), key=lambda i: (-weights[i], i))
+    for i in order:
+        ranks = sorted(xrange(world_size), key=lambda r: (load[r], r))
+        for r in ranks[:replicas]:
+            load[r] += weights[i]
+            owned[r].append(i)
+    return [sorted(x) for x in owned]
+
+
+def shard(sizes, rank, world_size, blocks=None, replicas=1):
+    """
+    Return the share of a rank, when every dataset is split into blocks of
+    equal size along z, and blocks are assigned to ranks (see assign).
+
+    Args:
+        sizes:      Number of samples of each dataset.
+        rank:       Rank in [0,world_size).
+        world_size: Number of ranks.
+        blocks:     Number of blocks per dataset. If None, datasets are split
+                    only if there are fewer datasets than ranks.
+        replicas:   Number of ranks each block is assigned to.
+
+    Returns:
+        List of (i, b0, b1, blocks), meaning that blocks [b0,b1) of the i-th
+        dataset belong to rank. Consecutive blocks are merged.
+    """
+    assert 0 <= rank < world_size
+    n = len(sizes)
+    if blocks is None:
+        blocks = int(math.ceil(world_size * replicas / float(max(n, 1))))
+    units = [(i, b) for i in xrange(n) for b in xrange(blocks)]
+    weights = [sizes[i] / float(blocks) for i, _ in units]
+    owned = assign(weights, world_size, replicas)[rank]
+    ret = list()
+    for i, b in (units[k] for k in owned):
+        if len(ret) > 0 and ret[-1][0] == i and ret[-1][2] == b:
+            ret[-1] = (i, ret[-1][1], b + 1, blocks)
+        else:
+            ret.append((i, b, b + 1, blocks))
+    return ret
+
+
+def block_box(rg, b0, b1, blocks):
+    """Return blocks [b0,b1) of a valid range rg split along z."""
+    z0, z1 = rg.min()[0], rg.max()[0]
+    s = z1 - z0
+    vmin = Vec3d(rg.min())
+    vmax = Vec3d(rg.max())
+    vmin[0] = z0 + (s * b0) // blocks
+    vmax[0] = z0 + (s * b1) // blocks
+    if vmax[0] <= vmin[0]:
+        raise RuntimeError('valid range %s too small for %d blocks.' % \
+                           (rg, blocks))
+    return Box(vmin, vmax)
+
+
+####################################################################
+## Private Helper Methods
+####################################################################
+
+def _option(config, section, option, default):
+    if not config.has_option(section, option):
+        return default
+    # Ensure that value is tuple.
+    return tuple(eval(str(config.get(section, option))))
+
+
+def _preprocess(config, section):
+    """Return the list of preprocessing of a section (see ConfigData)."""
+    if not config.has_option(section, 'preprocess'):
+        return list()
+    return [eval(x) for x in config.get(section, 'preprocess').split('\n')]
+
+
+def _slice_local(pp):
+    """
+    Return true if preprocessing pp is computed slice by slice, so that its
+    result on a z-slab is the same slab of its result on the whole volume.
+    """
+    if pp['type'] == 'standardize':
+        return pp.get('mode', '2D') == '2D'
+    return pp['type'] in ('divideby', 'binarize')
+
+
+def _margin(config, section, dim):
+    """
+    Return the margins (top,btm) of the valid range of a section within data
+    of dimension dim (see TensorData._range).
+    """
+    fov = Vec3d(_option(config, section, 'fov', (0,0,0)))
+    if fov == (0,0,0):
+        fov = Vec3d(dim)
+    top = fov/2
+    btm = fov - top - (1,1,1)
+    return top, btm
+
+
+def _shape(config, section):
+    """Return data shape of a section, reading only the file header."""
+    if config.has_option(section, 'file'):
+        return emio.imshape(config.get(section, 'file'))
+    if config.has_option(section, 'shape'):
+        return _option(config, section, 'shape', None)
+    raise RuntimeError('Invalid data section [%s].' % section)
+
+
+if __name__ == "__main__":
+
+    import ConfigParser
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    import numpy as np
+
+    from config_data import ConfigData
+
+    def _make_config(sections):
+        """Return a dataset config of (name, section, options) triples."""
+        config = ConfigParser.ConfigParser()
+        config.add_section('dataset')
+        for name, section, options in sections:
+            config.set('dataset', name, section)
+            config.add_section(section)
+            for k, v in options.iteritems():
+                config.set(section, k, v)
+        return config
+
+    ####################################################################
+    class UnitTestShard(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testAssign(self):
+            owned = assign([5,4,3,3,3], 2)
+            self.assertEqual(owned, [[0,3],[1,2,4]])
+            # Every unit is assigned to replicas distinct ranks.
+            owned = assign([1]*5, 3, replicas=2)
+            for i in xrange(5):
+                self.assertEqual(sum(i in x for x in owned), 2)
+
+        def testShard(self):
+            sizes = [30, 10, 20]
+            for world_size in xrange(1, 7):
+                units = list()
+                for rank in xrange(world_size):
+                    for i, b0, b1, n in shard(sizes, rank, world_size):
+                        units.extend((i, b, n) for b in xrange(b0, b1))
+                # Every block belongs to exactly one rank.
+                self.assertEqual(len(units), len(set(units)))
+                n = units[0][2]
+                self.assertEqual(sorted(units),
+                                 [(i, b, n) for i in xrange(3)
+                                            for b in xrange(n)])
+
+        def testBlockBox(self):
+            rg = Box((3,0,0), (13,5,5))
+            boxes = [block_box(rg, b, b+1, 3) for b in xrange(3)]
+            self.assertEqual([(b.min()[0], b.max()[0]) for b in boxes],
+                             [(3,6), (6,9), (9,13)])
+            self.assertEqual(block_box(rg, 0, 3, 3), rg)
+            self.assertRaises(RuntimeError, block_box, rg, 0, 1, 20)
+
+    ####################################################################
+    class UnitTestCrop(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.data = np.random.rand(20,8,8).astype('float32')
+            self.fname = os.path.join(self.dir, 'img.tif')
+            with emio.tifffile.TiffWriter(self.fname) as f:
+                for img in self.data:
+                    f.save(img)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _config(self):
+            return _make_config([
+                ('input', 'image', dict(file=self.fname, fov=(5,3,3),
+                                        offset=(2,0,0))),
+                ('label', 'label', dict(shape=(16,8,8), fov=(3,3,3)))])
+
+        def testValidRange(self):
+            config = self._config()
+            # image [4,20), label [1,15).
+            self.assertEqual(valid_range(config), Box((4,1,1), (15,7,7)))
+            self.assertEqual(estimate_num_sample(config), 11*6*6)
+            config.set('label', 'offset', (30,0,0))
+            self.assertEqual(valid_range(config), None)
+            self.assertEqual(estimate_num_sample(config), 0)
+
+        def testCrop(self):
+            config = self._config()
+            box = Box((10,1,1), (12,7,7))
+            crop(config, [box], margin=1)
+            # Only data read from file is cropped.
+            self.assertEqual(eval(str(config.get('image', 'zrange'))), (7,15))
+            self.assertFalse(config.has_option('label', 'zrange'))
+            data = ConfigData(config, 'image')
+            self.assertEqual(tuple(data.offset()), (7,0,0))
+            self.assertTrue(np.array_equal(data.get_data()[0],
+                                           self.data[5:13]))
+            # Patches centered in box are the same as those of uncropped data.
+            full = ConfigData(self._config(), 'image')
+            for pos in [(10,1,1), (11,6,6)]:
+                self.assertTrue(np.array_equal(data.get_patch(pos),
+                                               full.get_patch(pos)))
+
+        def testCropPreprocess(self):
+            box = Box((10,1,1), (12,7,7))
+            for pp, cropped in [("{'type':'standardize','mode':'3D'}", False),
+                                ("{'type':'rescale'}", False),
+                                ("{'type':'mirror_border','fov':(5,3,3)}",
+                                 False),
+                                ("{'type':'divideby','val':2.0}\n"
+                                 "{'type':'standardize'}", True)]:
+                config = self._config()
+                config.set('image', 'preprocess', pp)
+                crop(config, [box], margin=1)
+                self.assertEqual(config.has_option('image', 'zrange'), cropped)
+            # A cropped build is the same as an uncropped one.
+            for pp in ["{'type':'standardize','mode':'3D'}",
+                       "{'type':'standardize','mode':'2D'}"]:
+                config = self._config()
+                config.set('image', 'preprocess', pp)
+                crop(config, [box], margin=1)
+                data = ConfigData(config, 'image')
+                config = self._config()
+                config.set('image', 'preprocess', pp)
+                full = ConfigData(config, 'image')
+                for pos in [(10,1,1), (11,6,6)]:
+                    self.assertTrue(np.allclose(data.get_patch(pos),
+                                                full.get_patch(pos)))
+
+        def testCropLazy(self):
+            config = self._config()
+            config.set('image', 'lazy', 'True')
+            crop(config, [Box((10,1,1), (12,7,7))])
+            self.assertFalse(config.has_option('image', 'zrange'))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
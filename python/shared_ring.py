@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Shared-memory ring buffer of samples.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import Queue
+
+import numpy as np
+
+from sample import Sample
+
+class SharedRing(object):
+    """
+    Fixed slots of samples in shared memory, for passing samples between
+    processes without pickling.
+
+    Each slot holds one sample of a fixed layout. Producers acquire a free
+    slot, write a sample into it, and pass the slot index to the consumer,
+    who reads the sample as zero-copy numpy views and releases the slot
+    when done. Shared memory is allocated at construction, so that the
+    ring must be created before forking producers.
+
+    Attributes:
+        layout:    List of (key, shape, dtype) of every data, sorted by key.
+        num_slots: Number of slots.
+    """
+
+    def __init__(self, layout, num_slots):
+        """
+        Initialize SharedRing.
+
+        Args:
+            layout:    Dictionary mapping key to (shape, dtype).
+            num_slots: Number of slots.
+        """
+        assert num_slots > 0
+        self.layout = [(k, tuple(int(x) for x in s), np.dtype(t).str)
+                       for k, (s, t) in sorted(layout.items())]
+        self.num_slots = num_slots
+        self._raw = dict()
+        for k, s, t in self.layout:
+            nbytes = int(np.prod(s)) * np.dtype(t).itemsize
+            self._raw[k] = RawArray('b', num_slots * nbytes)
+        self._free = multiprocessing.Queue()
+        for i in xrange(num_slots):
+            self._free.put(i)
+        self._views = None
+
+    def slot_nbytes(self):
+        """Return the size of a slot in bytes."""
+        return sum(int(np.prod(s)) * np.dtype(t).itemsize
+                   for _, s, t in self.layout)
+
+    def acquire(self, timeout=None):
+        """
+        Return the index of a free slot, blocking until one is released.
+        Returns None on timeout.
+        """
+        try:
+            return self._free.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def write(self, slot, sample):
+        """Copy sample into slot, casting to the layout dtype."""
+        views = self._slot_views(slot)
+        if sorted(sample.keys()) != sorted(views.keys()):
+            raise RuntimeError('sample keys %s do not match layout %s.' % \
+                               (sorted(sample.keys()), sorted(views.keys())))
+        for k, v in views.iteritems():
+            data = sample[k]
+            if data.shape != v.shape:
+                raise RuntimeError('[%s] shape %s does not match layout %s.' \
+                                   % (k, data.shape, v.shape))
+            v[...] = data
+
+    def read(self, slot):
+        """
+        Return the sample in slot as views, and a SlotHandle releasing the
+        slot. The views must not be used after release.
+        """
+        return self._slot_views(slot), SlotHandle(self, slot)
+
+    def release(self, slot):
+        """Return slot to the free slots."""
+        self._free.put(slot)
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _slot_views(self, slot):
+        """Return a Sample of views of slot."""
+        assert 0 <= slot < self.num_slots
+        if self._views is None:
+            self._views = dict()
+            for k, s, t in self.layout:
+                a = np.frombuffer(self._raw[k], dtype=t)
+                self._views[k] = a.reshape((self.num_slots,) + s)
+        return Sample(((k, self._views[k][slot]) for k, _, _ in self.layout),
+                      presorted=True)
+
+
+class SlotHandle(object):
+    """
+    Handle releasing a slot of SharedRing once, either explicitly or by
+    leaving a with block. on_release, if set, is called after releasing.
+    """
+
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+        self.released = False
+        self.on_release = None
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.ring.release(self.slot)
+            if self.on_release is not None:
+                self.on_release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    def _write(ring, value):
+        """Write a sample filled with value into a free slot, and queue it."""
+        slot = ring.acquire()
+        ring.write(slot, dict(a=np.full((2,3), value), b=np.full((4,), value)))
+        ring._free.put(slot)  # Handed back to the parent through the queue.
+
+    ####################################################################
+    class UnitTestSharedRing(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def _ring(self, num_slots=2):
+            layout = dict(b=((4,), 'uint8'), a=((2,3), 'float32'))
+            # Kept alive until the queue of free slots is flushed.
+            self.ring = SharedRing(layout, num_slots)
+            return self.ring
+
+        def testLayout(self):
+            ring = self._ring()
+            self.assertEqual([k for k, _, _ in ring.layout], ['a','b'])
+            self.assertEqual(ring.slot_nbytes(), 2*3*4 + 4)
+
+        def testWriteRead(self):
+            ring = self._ring()
+            slot = ring.acquire()
+            a = np.arange(6).reshape(2,3)
+            ring.write(slot, dict(a=a, b=np.ones(4)))
+            sample, handle = ring.read(slot)
+            self.assertEqual(sample.keys(), ['a','b'])
+            self.assertEqual(sample['a'].dtype, np.float32)
+            self.assertTrue(np.array_equal(sample['a'], a))
+            # Views of shared memory, not copies.
+            ring.write(slot, dict(a=a + 1, b=np.ones(4)))
+            self.assertTrue(np.array_equal(sample['a'], a + 1))
+            handle.release()
+            self.assertTrue(handle.released)
+
+        def testRelease(self):
+            ring = self._ring()
+            slots = [ring.acquire(), ring.acquire()]
+            self.assertEqual(sorted(slots), [0,1])
+            # Every slot is held.
+            self.assertTrue(ring.acquire(timeout=0.1) is None)
+            released = list()
+            _, handle = ring.read(slots[0])
+            handle.on_release = lambda: released.append(True)
+            with handle:
+                pass
+            handle.release()  # Released only once.
+            self.assertEqual(released, [True])
+            self.assertEqual(ring.acquire(timeout=1.0), slots[0])
+            self.assertTrue(ring.acquire(timeout=0.1) is None)
+
+        def testLayoutMismatch(self):
+            ring = self._ring()
+            slot = ring.acquire()
+            self.assertRaises(RuntimeError, ring.write, slot,
+                              dict(a=np.zeros((2,3))))
+            self.assertRaises(RuntimeError, ring.write, slot,
+                              dict(a=np.zeros((2,3)), c=np.zeros(4)))
+            self.assertRaises(RuntimeError, ring.write, slot,
+                              dict(a=np.zeros((3,2)), b=np.zeros(4)))
+
+        def testProcess(self):
+            ring = self._ring(num_slots=1)
+            p = multiprocessing.Process(target=_write, args=(ring, 7))
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+            slot = ring.acquire(timeout=1.0)
+            sample, handle = ring.read(slot)
+            with handle:
+                self.assertTrue(np.all(sample['a'] == 7))
+                self.assertTrue(np.all(sample['b'] == 7))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Streaming with bounded look-ahead.
+
+Kisuk Lee <kisuklee@mit.edu>, 2017
+"""
+
+import Queue
+import sys
+import threading
+import time
+
+class LookAhead(object):
+    """
+    Iterator computing items of an iterable ahead in a background thread.
+
+    At most depth computed items wait for the consumer. The producer blocks
+    when the consumer falls behind, and an exception raised by the producer
+    is re-raised by next. With depth 0, items are computed on demand in the
+    consumer's thread.
+
+    Attributes:
+        depth: Maximum number of computed items waiting for the consumer.
+    """
+
+    def __init__(self, iterable, depth=2):
+        """
+        Initialize LookAhead, and start producing.
+
+        Args:
+            iterable: Iterable to compute ahead, not used by anyone else.
+            depth:    Maximum number of computed items waiting.
+        """
+        assert depth >= 0
+        self.depth = depth
+        self._done = False
+        if depth == 0:
+            self._iter = iter(iterable)
+            return
+        self._queue = Queue.Queue(depth)
+        self._stop  = threading.Event()
+        # The producer does not refer to self, so that an abandoned
+        # LookAhead is collected, and closed.
+        self._thread = threading.Thread(target=_produce,
+                args=(iterable, self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next item. Blocks until it is ready."""
+        if self._done:
+            raise StopIteration
+        if self.depth == 0:
+            return next(self._iter)
+        msg, payload = self._queue.get()
+        if msg == 'item':
+            return payload
+        self._done = True
+        self._thread.join()
+        if msg == 'error':
+            raise payload[0], payload[1], payload[2]
+        raise StopIteration
+
+    def close(self):
+        """Stop producing. Items waiting are discarded."""
+        if self._done:
+            return
+        self._done = True
+        if self.depth == 0:
+            return
+        self._stop.set()
+        # Drain the queue, so that the producer does not block on putting.
+        while self._thread.is_alive():
+            self._drain()
+            self._thread.join(0.1)
+        self._drain()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, '_done'):
+            self.close()
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _drain(self):
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+class Pipeline(object):
+    """
+    Iterator running stages concurrently on consecutive items.
+
+    Every stage runs on its own worker threads, and passes items to the next
+    stage through a bounded queue, so that the throughput is set by the
+    slowest stage rather than the sum of all stages. The first stage is the
+    source, a function of no argument called repeatedly. Items may be
+    reordered by stages of several workers. An exception raised by a stage
+    is passed down, and re-raised by next.
+
+    Attributes:
+        names: Stage names.
+        depth: Maximum number of items waiting between stages.
+    """
+
+    def __init__(self, stages, depth=2):
+        """
+        Initialize Pipeline, and start every stage.
+
+        Args:
+            stages: List of (name, function, number of workers). The first
+                    function takes no argument, and every other takes the
+                    output of the previous stage.
+            depth:  Maximum number of items waiting between stages.
+        """
+        assert len(stages) > 0
+        assert depth > 0
+        self.names = [name for name, _, _ in stages]
+        self.depth = depth
+        self._done = False
+        self._stop = threading.Event()
+        self._stats = [list() for _ in stages]  # Per worker.
+        self._queues = [Queue.Queue(depth) for _ in stages]
+        self._threads = list()
+        inq = None
+        for (name, f, n), outq, stats in zip(stages, self._queues,
+                                             self._stats):
+            assert n > 0
+            for _ in xrange(n):
+                stat = dict(items=0, busy=0.0)
+                stats.append(stat)
+                t = threading.Thread(target=_run_stage,
+                        args=(f, inq, outq, self._stop, stat))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+            inq = outq
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next output of the last stage. Blocks until ready."""
+        if self._done:
+            raise StopIteration
+        msg, payload = self._queues[-1].get()
+        if msg == 'error':
+            self.close()
+            raise payload[0], payload[1], payload[2]
+        return payload
+
+    def stats(self):
+        """
+        Return a dictionary mapping stage name to the number of items, and
+        the busy time (in seconds) summed over its workers.
+        """
+        ret = dict()
+        for name, stats in zip(self.names, self._stats):
+            ret[name] = dict(items=sum(x['items'] for x in stats),
+                             busy=sum(x['busy'] for x in stats))
+        return ret
+
+    def close(self):
+        """Stop every stage. Items in flight are discarded."""
+        if self._done:
+            return
+        self._done = True
+        self._stop.set()
+        # Drain the queues, so that no worker blocks on putting.
+        for t in self._threads:
+            while t.is_alive():
+                self._drain()
+                t.join(0.1)
+        self._drain()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, '_done'):
+            self.close()
+
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _drain(self):
+        for q in self._queues:
+            try:
+                while True:
+                    q.get_nowait()
+            except Queue.Empty:
+                pass
+
+
+def _put(queue, msg, stop):
+    """Put msg, blocking until there is room. False if stopped."""
+    while not stop.is_set():
+        try:
+            queue.put(msg, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _run_stage(f, inq, outq, stop, stat):
+    """
+    Stage worker loop of Pipeline. Reads from inq, or calls f with no
+    argument if inq is None.
+    """
+    while not stop.is_set():
+        if inq is None:
+            msg = ('item', None)
+        else:
+            try:
+                msg = inq.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+        if msg[0] == 'item':
+            t0 = time.time()
+            try:
+                item = f() if inq is None else f(msg[1])
+                msg = ('item', item)
+            except:
+                msg = ('error', sys.exc_info())
+            stat['items'] += 1
+            stat['busy'] += time.time() - t0
+        if not _put(outq, msg, stop):
+            return
+
+
+def _produce(iterable, queue, stop):
+    """Producer thread loop of LookAhead."""
+    try:
+        for item in iterable:
+            if not _put(queue, ('item', item), stop):
+                return
+        _put(queue, ('end', None), stop)
+    except:
+        _put(queue, ('error', sys.exc_info()), stop)
+
+
+if __name__ == "__main__":
+
+    import ConfigParser
+    import unittest
+
+    import numpy as np
+
+    from dataset import VolumeDataset
+    from forward import ForwardScanner
+
+    def _count(n, produced=None, fail=None):
+        """Yield 0,...,n-1, recording each in produced, or raise at fail."""
+        for i in xrange(n):
+            if i == fail:
+                raise ValueError('failed at %d' % i)
+            if produced is not None:
+                produced.append(i)
+            yield i
+
+    ####################################################################
+    class UnitTestLookAhead(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testOrder(self):
+            for depth in [0, 1, 3]:
+                self.assertEqual(list(LookAhead(_count(20), depth)),
+                                 range(20))
+
+        def testError(self):
+            for depth in [0, 2]:
+                it = LookAhead(_count(5, fail=3), depth)
+                self.assertEqual([next(it) for _ in xrange(3)], [0,1,2])
+                with self.assertRaises(ValueError) as cm:
+                    next(it)
+                self.assertTrue('failed at 3' in str(cm.exception))
+                self.assertRaises(StopIteration, next, it)
+
+        def testBounded(self):
+            produced = list()
+            it = LookAhead(_count(100, produced), depth=2)
+            self.assertEqual(next(it), 0)
+            time.sleep(0.5)
+            # At most depth items waiting, and one blocked on putting.
+            self.assertTrue(len(produced) <= 4)
+            # Closing stops the producer.
+            it.close()
+            self.assertFalse(it._thread.is_alive())
+            n = len(produced)
+            time.sleep(0.2)
+            self.assertEqual(len(produced), n)
+            self.assertRaises(StopIteration, next, it)
+
+        def testOnDemand(self):
+            produced = list()
+            it = LookAhead(_count(100, produced), depth=0)
+            self.assertEqual(produced, [])
+            self.assertEqual(next(it), 0)
+            self.assertEqual(produced, [0])
+
+
+    ####################################################################
+    class UnitTestPipeline(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def _pipeline(self, fail=None, depth=2):
+            source = _count(1000, fail=fail)
+            stages = [('read', lambda: next(source), 1),
+                      ('double', lambda x: 2*x, 1),
+                      ('inc', lambda x: x + 1, 1)]
+            return Pipeline(stages, depth)
+
+        def testOrder(self):
+            # One worker per stage keeps the order.
+            with self._pipeline() as p:
+                self.assertEqual([next(p) for _ in xrange(20)],
+                                 [2*i + 1 for i in xrange(20)])
+                stats = p.stats()
+            self.assertEqual(sorted(stats.keys()), ['double','inc','read'])
+            self.assertTrue(stats['inc']['items'] >= 20)
+
+        def testError(self):
+            p = self._pipeline(fail=3)
+            self.assertEqual([next(p) for _ in xrange(3)], [1,3,5])
+            with self.assertRaises(ValueError) as cm:
+                next(p)
+            self.assertTrue('failed at 3' in str(cm.exception))
+            # Closed by the error.
+            self.assertFalse(any(t.is_alive() for t in p._threads))
+            self.assertRaises(StopIteration, next, p)
+
+        def testErrorInStage(self):
+            def f(x):
+                if x == 2:
+                    raise KeyError(x)
+                return x
+            source = _count(1000)
+            p = Pipeline([('read', lambda: next(source), 1), ('f', f, 2)])
+            with self.assertRaises(KeyError):
+                while True:
+                    next(p)
+            self.assertRaises(StopIteration, next, p)
+
+        def testClose(self):
+            p = self._pipeline(depth=1)
+            self.assertEqual(next(p), 1)
+            time.sleep(0.2)  # Every stage blocked on a full queue.
+            p.close()
+            self.assertFalse(any(t.is_alive() for t in p._threads))
+            self.assertRaises(StopIteration, next, p)
+            p.close()  # Closed only once.
+
+    ####################################################################
+    class UnitTestForwardScannerStream(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def _scanner(self):
+            config = ConfigParser.ConfigParser()
+            config.add_section('dataset')
+            config.set('dataset', 'input', 'image')
+            config.add_section('image')
+            config.set('image', 'shape', (10,20,20))
+            config.set('image', 'fov', (4,8,8))
+            config.set('image', 'filler', "{'type':'uniform'}")
+            dataset = VolumeDataset(config)
+            scan_spec = dict(output=(1,4,8,8))
+            return dataset, ForwardScanner(dataset, scan_spec)
+
+        def testStream(self):
+            dataset, fs = self._scanner()
+            # Samples are read ahead, and outputs pushed out of order.
+            items = list(fs.stream(depth=2))
+            self.assertEqual([tuple(loc) for loc, _ in items],
+                             [tuple(loc) for loc in fs.locs])
+            for loc, sample in reversed(items):
+                expected, _ = dataset.get_sample(loc)
+                self.assertTrue(np.array_equal(sample['input'],
+                                               expected['input']))
+                fs.push(dict(output=sample['input']), loc=loc)
+            self.assertTrue(np.array_equal(fs.outputs.get_data('output'),
+                    dataset._data['input'].get_data()))
+            # Every location is consumed.
+            self.assertTrue(fs.pull() is None)
+
+        def testStreamRemaining(self):
+            _, fs = self._scanner()
+            fs.pull()
+            fs.push(dict(output=np.zeros((1,4,8,8))))
+            locs = [tuple(loc) for loc, _ in fs]
+            self.assertEqual(locs, [tuple(loc) for loc in fs.locs[1:]])
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -10,6 +10,7 @@ import math
 import numpy as np
 
 from box import *
+import buffer_pool
 from vector import *
 import time
 
@@ -22,7 +23,8 @@ class TensorData(object):
     made through 3D vector, not 4D.
 
     Attributes:
-        _data:   numpy 4D array (channel,z,y,x)
+        _data:   numpy 4D array (channel,z,y,x), or a lazy volume such as
+                 emio.H5Volume, which reads only the requested patch
         _dim:    Dimension of each channel
         _offset: Coordinate offset from the origin
         _bb:     Bounding box
@@ -64,20 +66,36 @@ class TensorData(object):
         # Update range.
         self._set_range()
 
-    def get_patch(self, pos):
+    def get_patch(self, pos, fov=None, view=False):
         """
-        Extract a patch of size _fov centered on pos.
+        Extract a patch of size fov (_fov if None) centered on pos.
+
+        Passing fov leaves the state intact, so that patches of different
+        sizes can be extracted concurrently.
+
+        If view is True, a read-only view is returned instead of a copy.
+        Whoever writes to it should copy it first (see utils.writable).
         """
-        # Check validity.
-        assert self._rg.contains(pos)
+        fov = self._fov if fov is None else fov
         # Local coordinate system
         loc  = pos - self._offset
-        box  = centered_box(loc, self._fov)
+        box  = centered_box(loc, fov)
         vmin = box.min()
         vmax = box.max()
-        return np.copy(self._data[:,vmin[0]:vmax[0],
-                                    vmin[1]:vmax[1],
-                                    vmin[2]:vmax[2]])
+        # Check validity, equivalent to the containment of pos in range.
+        assert vmin == maximum(vmin, (0,0,0))
+        assert vmax == minimum(vmax, self._dim)
+        patch = self._data[:,vmin[0]:vmax[0],vmin[1]:vmax[1],vmin[2]:vmax[2]]
+        # Lazy volume (e.g. emio.H5Volume) returns a newly read array.
+        if isinstance(self._data, np.ndarray):
+            if view:
+                patch = patch.view()
+                patch.flags.writeable = False
+            else:
+                ret = buffer_pool.empty(patch.shape, patch.dtype)
+                ret[...] = patch
+                patch = ret
+        return patch
 
     ####################################################################
     ## Public methods for accessing attributes
@@ -103,19 +121,36 @@ class TensorData(object):
     def bounding_box(self):
         return Box(self._bb)
 
-    def range(self):
-        return Box(self._rg)
+    def range(self, fov=None):
+        """
+        Return the valid range, or the valid range given fov without
+        changing the current FoV (None if fov is larger than data).
+        """
+        if fov is None:
+            return Box(self._rg)
+        fov = Vec3d(fov)
+        if fov == (0,0,0):
+            fov = Vec3d(self._dim)
+        if fov != minimum(maximum(fov,(0,0,0)), self._dim):
+            return None
+        return self._range(fov)
 
     ####################################################################
     ## Private helper methods.
     ####################################################################
 
     def _check_data(self, data):
+        # Lazy volume reads only the requested patch, and is always 4D.
+        if not isinstance(data, np.ndarray):
+            assert hasattr(data, '__getitem__')
+            assert data.ndim==4
+            return data
+
         # Data should be either numpy 3D or 4D array.
-        assert isinstance(data, np.ndarray)
         assert data.ndim==3 or data.ndim==4
 
-        # Add channel dimension if data is 3D array.
+        # Add channel dimension if data is 3D array. Indexing with np.newaxis
+        # returns a view, so memory-mapped data (numpy.memmap) is not copied.
         if data.ndim == 3:
             data = data[np.newaxis,...]
 
@@ -123,12 +158,15 @@ class TensorData(object):
 
     def _set_range(self):
         """Set a valid range for extracting patches."""
-        top  = self._fov/2                # Top margin
-        btm  = self._fov - top - (1,1,1)  # Bottom margin
+        self._rg = self._range(self._fov)
+
+    def _range(self, fov):
+        """Return a valid range for extracting patches of size fov."""
+        top  = fov/2                # Top margin
+        btm  = fov - top - (1,1,1)  # Bottom margin
         vmin = self._offset + top
         vmax = self._offset + self._dim - btm
-
-        self._rg = Box(vmin, vmax)
+        return Box(vmin, vmax)
 
     # String representaion (for printing and debugging).
     def __str__( self ):
@@ -263,6 +301,32 @@ if __name__ == "__main__":
             T.set_fov((2,2,2))
             p = T.get_patch((2,2,2))
             self.assertTrue(np.array_equal(data[1:3,1:3,1:3], p[0, ...]))
+            # Per-call FoV leaves the state intact.
+            p = T.get_patch((2,2,2), fov=(4,4,4))
+            self.assertTrue(np.array_equal(data, p[0, ...]))
+            self.assertTrue(T.fov()==(2,2,2))
+            self.assertRaises(AssertionError, T.get_patch, (1,1,1), (4,4,4))
+
+        def testGetPatchView(self):
+            data = np.random.rand(4,4,4)
+            T = TensorData(data, (3,3,3))
+            p = T.get_patch((2,2,2), view=True)
+            self.assertTrue(np.array_equal(data[1:,1:,1:], p[0, ...]))
+            self.assertFalse(p.flags.writeable)
+            self.assertRaises(ValueError, p.fill, 0)
+            self.assertTrue(data.flags.writeable)
+
+        def testLazyGetPatch(self):
+            import os, tempfile
+            import emio
+            fname = os.path.join(tempfile.mkdtemp(), 'data.h5')
+            data = np.random.rand(4,4,4)
+            emio.imsave(data, fname)
+            T = TensorData(emio.imopen(fname), (3,3,3))
+            self.assertTrue(T.shape()==(1,4,4,4))
+            p = T.get_patch((2,2,2))
+            self.assertTrue(np.array_equal(data[1:,1:,1:], p[0, ...]))
+            os.remove(fname)
 
 
     ####################################################################
@@ -8,18 +8,28 @@ Kisuk Lee <kisuklee@mit.edu>, 2016
 
 from collections import OrderedDict
 import numpy as np
+import buffer_pool
+from sample import Sample
 from utils import *
 from vector import Vec3d, minimum, maximum
 
 def transform_tensor(func, data, *args, **kwargs):
     """Apply func to each channel of data (4D tensor)."""
     data = check_tensor(data)
-    arrs = list()
     f = globals()[func]
+    ret = None
     for c in xrange(data.shape[0]):
-        vol = f(data[c,...], *args, **kwargs)
-        arrs.append(check_tensor(vol))
-    return np.concatenate(arrs, axis=0)
+        out = f(data[c,...], *args, **kwargs)
+        vol = check_tensor(out)
+        if data.shape[0] == 1 and not np.may_share_memory(vol, data):
+            return vol  # Already a new array.
+        if ret is None:
+            shape = (data.shape[0]*vol.shape[0],) + vol.shape[1:]
+            ret = buffer_pool.empty(shape, vol.dtype)
+        n = vol.shape[0]
+        ret[c*n:(c+1)*n,...] = vol
+        buffer_pool.release(out)
+    return ret
 
 
 class SampleFunction(object):
@@ -34,8 +44,9 @@ class SampleFunction(object):
 
     def _transform_sample(self, func, sample, *args, **kwargs):
         """Apply func to a sample."""
-        ret = OrderedDict()
-        for key, data in sample.iteritems():
+        # Keep the key order and layout of a Sample.
+        ret = sample.copy() if isinstance(sample, Sample) else OrderedDict()
+        for key, data in sample.items():
             ret[key] = transform_tensor(func, data, *args, **kwargs)
         return ret
 
@@ -71,7 +82,7 @@ class Crop(object):
         data = check_tensor(data)
         if size is None:
             size = tuple(Vec3d(data.shape[-3:]) - Vec3d(offset))
-        ret = np.zeros((data.shape[-4],) + size, data.dtype)
+        ret = buffer_pool.empty((data.shape[-4],) + size, data.dtype)
         v1  = Vec3d(offset)
         v2  = v1 + Vec3d(size)
         ret[...] = data[...,v1[0]:v2[0],v1[1]:v2[1],v1[2]:v2[2]]
@@ -267,8 +278,8 @@ def binarize(img, dtype='float32'):
         ret: Binarized image.
     """
     img = check_volume(img)
-    ret = np.zeros(img.shape, dtype=dtype)
-    ret[:] = (img>0).astype(dtype)
+    ret = buffer_pool.empty(img.shape, dtype=dtype)
+    ret[:] = img>0
     return ret
 
 
@@ -316,7 +327,7 @@ def affinitize(img, dst=(1,1,1), dtype='float32'):
         ret: 3D affinity graph (4D tensor), 3 channels for z, y, x direction.
     """
     img = check_volume(img)
-    ret = np.zeros((3,) + img.shape, dtype=dtype)
+    ret = buffer_pool.zeros((3,) + img.shape, dtype=dtype)
 
     (dz,dy,dx) = dst
 
@@ -402,7 +413,7 @@ def affinitize_mask(msk, dst=(1,1,1), dtype='float32'):
         ret: 3D affinity mask (4D tensor), 3 channels for z, y, x direction.
     """
     msk = check_volume(msk)
-    ret = np.zeros((3,) + msk.shape, dtype=dtype)
+    ret = buffer_pool.zeros((3,) + msk.shape, dtype=dtype)
 
     (dz,dy,dx) = dst
 
@@ -480,7 +491,7 @@ def affinitize1_mask(msk, dst=(1,1,1), dtype='float32'):
 def rebalance_class(img, msk=None, dtype='float32'):
     """Multiclass rebalancing."""
     img = check_volume(img)
-    ret = np.zeros(img.shape, dtype=dtype)
+    ret = buffer_pool.zeros(img.shape, dtype=dtype)
 
     masked = img if msk is None else img[msk>0]
     unique_lbl, num_lbls = np.unique(masked, return_counts=True)
@@ -509,7 +520,7 @@ def rebalance_binary_class(img, msk=None, base_w=0.0, dtype='float32'):
         (18,158,158): 5.6 ms
     """
     img = check_volume(img)
-    ret = np.zeros(img.shape, dtype=dtype)
+    ret = buffer_pool.zeros(img.shape, dtype=dtype)
 
     if msk is None:
         msk   = np.ones(img.shape, dtype=bool)
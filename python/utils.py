@@ -43,6 +43,16 @@ def check_tensor(data):
     return data
 
 
+def writable(data):
+    """
+    Return data if writable, or its copy otherwise (e.g. a read-only patch
+    view, see TensorData.get_patch).
+    """
+    if data.flags.writeable:
+        return data
+    return np.array(data)
+
+
 def fill_data(shape, filler={'type':'zero'}, dtype='float32'):
     """
     Return numpy array of shape, filled with specified values.
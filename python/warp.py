@@ -11,7 +11,7 @@ import data_augmentation
 from warping import warping
 import numpy as np
 from utils import check_tensor, check_volume
-from vector import Vec3d
+from vector import Vec3d, minimum
 
 class WarpAugment(data_augmentation.DataAugment):
     """
@@ -23,9 +23,17 @@ class WarpAugment(data_augmentation.DataAugment):
         5. Perspective stretch
     """
 
-    def __init__(self, skip_ratio=0.3):
-        """Initialize WarpAugment."""
+    def __init__(self, skip_ratio=0.3, max_tries=3):
+        """
+        Initialize WarpAugment.
+
+        Args:
+            skip_ratio: Probability of skipping warp.
+            max_tries:  Number of draws, halving the amount of warping each
+                        time, before skipping warp that does not fit.
+        """
         self.ratio = skip_ratio
+        self.max_tries = max_tries
 
         # DEBUG
         # self.count = dict(skip=0, warp=0)
@@ -38,11 +46,16 @@ class WarpAugment(data_augmentation.DataAugment):
         """
         # Skip.
         self.skip = False
-        if self.ratio > np.random.rand():
+        if self.ratio > self.rng.rand():
             self.skip = True
             return dict(spec)
 
-        imgs = kwargs['imgs']
+        imgs = kwargs.pop('imgs')
+        slack = kwargs.pop('slack', None)
+        amount = kwargs.pop('amount', 1.0)
+        # getWarpParams scales scale_max itself by amount, which inverts the
+        # range of scale unless amount is 1. Scale the deviation instead.
+        scale_max = kwargs.pop('scale_max', 1.2)
 
         # Compute the largest image size.
         b = Box((0,0,0), (0,0,0))  # Empty box.
@@ -50,11 +63,21 @@ class WarpAugment(data_augmentation.DataAugment):
             b = b.merge(Box((0,0,0), v[-3:]))
         maxsz = tuple(b.size())
 
-        # Randomly draw warp parameters.
-        # TODO(kisuk): Optional parameter 'amount'?
-        params = warping.getWarpParams(maxsz, **kwargs)
+        # Randomly draw warp parameters. Halve the amount of warping until
+        # the required size fits in the slack, or skip.
+        for _ in xrange(self.max_tries):
+            params = warping.getWarpParams(maxsz, amount=amount,
+                    rng=self.rng, scale_max=1 + (scale_max - 1)*amount,
+                    **kwargs)
+            ret = self._enlarge(spec, imgs, tuple(params[0]), maxsz)
+            if slack is None or self._fits(spec, ret, slack):
+                break
+            amount *= 0.5
+        else:
+            self.skip = True
+            return dict(spec)
+
         self.size = tuple(x for x in params[0])  # Convert to tuple.
-        size_diff = tuple(x - y for x, y in zip(self.size,maxsz))
         self.rot     = params[1]
         self.shear   = params[2]
         self.scale   = params[3]
@@ -63,15 +86,6 @@ class WarpAugment(data_augmentation.DataAugment):
 
         # Save original spec.
         self.spec = dict(spec)
-
-        # Replace every shape to the largest required one.
-        # TODO(kisuk): Is this correct?
-        ret = dict()
-        for k, v in spec.iteritems():
-            if k in imgs:  # Images.
-                ret[k] = v[:-3] + self.size
-            else:  # Labels and masks.
-                ret[k] = v[:-3] + tuple(x + y for x, y in zip(v[-3:],size_diff))
         return ret
 
     def augment(self, sample, **kwargs):
@@ -112,6 +126,31 @@ class WarpAugment(data_augmentation.DataAugment):
             sample[k] = np.transpose(v, (1,0,2,3))
         return sample
 
+    ####################################################################
+    ## Private Helper Methods
+    ####################################################################
+
+    def _enlarge(self, spec, imgs, size, maxsz):
+        """Return spec enlarged to the required size."""
+        size_diff = tuple(x - y for x, y in zip(size, maxsz))
+        # Replace every shape to the largest required one.
+        # TODO(kisuk): Is this correct?
+        ret = dict()
+        for k, v in spec.iteritems():
+            if k in imgs:  # Images.
+                ret[k] = v[:-3] + size
+            else:  # Labels and masks.
+                ret[k] = v[:-3] + tuple(x + y for x, y in zip(v[-3:],size_diff))
+        return ret
+
+    def _fits(self, spec, ret, slack):
+        """Return true if the enlargement from spec to ret is within slack."""
+        for k, v in ret.iteritems():
+            e = Vec3d(v[-3:]) - Vec3d(spec[k][-3:])
+            if e != minimum(e, slack):
+                return False
+        return True
+
 
 if __name__ == "__main__":
 
@@ -129,7 +168,7 @@ if __name__ == "__main__":
         spec[k] = v[:-3] + newv
 
     # Augmentation.
-    aug = WarpAugment()
+    aug = WarpAugment(skip_ratio=0)
 
     # Test.
     ret = aug.prepare(spec, imgs=['input/p3','input/p2','input/p1'])
@@ -140,3 +179,44 @@ if __name__ == "__main__":
     print aug.scale
     print aug.stretch
     print aug.twist
+
+    import unittest
+
+    ####################################################################
+    class UnitTestWarpAugment(unittest.TestCase):
+
+        def setup(self):
+            pass
+
+        def testMilderRetries(self):
+            spec = {'input': (18,160,160), 'label': (3,18,160,160)}
+            aug = WarpAugment(skip_ratio=0, max_tries=4)
+            aug.set_rng(np.random.RandomState(0))
+            for slack in [(100,100,100), (20,40,40), (4,10,10), (2,4,4)]:
+                for _ in xrange(100):
+                    aug.prepare(spec, imgs=['input'], slack=Vec3d(slack))
+                    if aug.skip:
+                        continue
+                    # Within the bounds of the full amount.
+                    self.assertTrue(0.8 <= aug.scale[0] <= 1.0)
+                    self.assertTrue(aug.scale[0] == aug.scale[1])
+                    self.assertTrue(abs(aug.shear) <= 3)
+                    self.assertTrue(abs(aug.twist) <= 15)
+                    self.assertTrue(0 <= aug.rot <= 15)
+                    self.assertTrue(np.all(np.abs(aug.stretch) <= 0.1))
+
+        def testFitsInSlack(self):
+            spec = {'input': (18,160,160), 'label': (3,18,160,160)}
+            aug = WarpAugment(skip_ratio=0)
+            aug.set_rng(np.random.RandomState(0))
+            slack = Vec3d(4,20,20)
+            for _ in xrange(100):
+                ret = aug.prepare(spec, imgs=['input'], slack=slack)
+                for k, v in ret.iteritems():
+                    e = Vec3d(v[-3:]) - Vec3d(spec[k][-3:])
+                    self.assertTrue(e == minimum(e, slack))
+
+    ####################################################################
+    unittest.main()
+
+    ####################################################################
@@ -4,7 +4,8 @@ Adapted from ELEKTRONN (http://elektronn.org/).
 
 import numpy as np
 
-cdef extern from 'warping.c':
+# The kernels touch no Python object, so they run without the GIL.
+cdef extern from 'warping.c' nogil:
     int fastwarp2d_opt(const float * src,
                float * dest_d,
                const int sh[3],
@@ -71,8 +72,9 @@ def warp2dFast(img, patch_size, rot=0, shear=0, scale=(1,1), stretch=(0,0)):
     cdef float * stretch_ptr = &stretch_view[0]
 
     img = np.ascontiguousarray(img, dtype=np.float32)
-    cdef float [:, :, :] img_view = img
-    cdef float * in_ptr = &img_view[0, 0, 0]
+    # Read-only input (e.g. a patch view) is never written.
+    cdef const float [:, :, :] img_view = img
+    cdef const float * in_ptr = &img_view[0, 0, 0]
 
     cdef int [:] in_sh_view = np.ascontiguousarray(img.shape, dtype=np.int32)
     cdef int * in_sh_ptr = &in_sh_view[0]
@@ -84,7 +86,10 @@ def warp2dFast(img, patch_size, rot=0, shear=0, scale=(1,1), stretch=(0,0)):
     cdef int [:] ps_view = np.ascontiguousarray(out_arr.shape, dtype=np.int32)
     cdef int * ps_ptr  = &ps_view[0]
 
-    fastwarp2d_opt(in_ptr, out_ptr, in_sh_ptr, ps_ptr, rot, shear, scale_ptr, stretch_ptr)
+    cdef float c_rot = rot, c_shear = shear
+    with nogil:
+        fastwarp2d_opt(in_ptr, out_ptr, in_sh_ptr, ps_ptr, c_rot, c_shear,
+                       scale_ptr, stretch_ptr)
     return out_arr
 
 
@@ -121,7 +126,10 @@ def _warp2dFastLab(lab, patch_size, img_sh, rot, shear, scale, stretch):
     cdef int [:] ps_view = np.ascontiguousarray(out_arr.shape, dtype=np.int32)
     cdef int * ps_ptr  = &ps_view[0]
 
-    fastwarp2d_opt(in_ptr, out_ptr, in_sh_ptr, ps_ptr, rot, shear, scale_ptr, stretch_ptr)
+    cdef float c_rot = rot, c_shear = shear
+    with nogil:
+        fastwarp2d_opt(in_ptr, out_ptr, in_sh_ptr, ps_ptr, c_rot, c_shear,
+                       scale_ptr, stretch_ptr)
     out_arr = out_arr.astype(np.int16)[0]
     return out_arr
 
@@ -187,8 +195,9 @@ def warp3dFast(img, patch_size, rot=0, shear=0, scale=(1,1,1), stretch=(0,0,0,0)
 
     # Image.
     img = np.ascontiguousarray(img, dtype=np.float32)
-    cdef float [:, :, :, :] img_view = img
-    cdef float * in_ptr = &img_view[0, 0, 0, 0]
+    # Read-only input (e.g. a patch view) is never written.
+    cdef const float [:, :, :, :] img_view = img
+    cdef const float * in_ptr = &img_view[0, 0, 0, 0]
 
     # Image shape.
     cdef int [:] in_sh_view = np.ascontiguousarray(img.shape, dtype=np.int32)
@@ -204,8 +213,10 @@ def warp3dFast(img, patch_size, rot=0, shear=0, scale=(1,1,1), stretch=(0,0,0,0)
     cdef int [:] ps_view = np.ascontiguousarray(out_arr.shape, dtype=np.int32)
     cdef int * ps_ptr = &ps_view[0]
 
-    fastwarp3d_opt_zxy(in_ptr, out_ptr, in_sh_ptr, ps_ptr, rot, shear,
-                        scale_ptr, stretch_ptr, twist)
+    cdef float c_rot = rot, c_shear = shear, c_twist = twist
+    with nogil:
+        fastwarp3d_opt_zxy(in_ptr, out_ptr, in_sh_ptr, ps_ptr, c_rot, c_shear,
+                           scale_ptr, stretch_ptr, c_twist)
     return out_arr
 
 
@@ -252,7 +263,9 @@ def _warp3dFastLab(lab, patch_size, img_sh, rot, shear, scale, stretch, twist):
     cdef int [:] ps_view = np.ascontiguousarray(out_arr.shape, dtype=np.int32)
     cdef int * ps_ptr = &ps_view[0]
 
-    fastwarp3d_opt_zxy(in_ptr, out_ptr, in_sh_ptr, ps_ptr, rot, shear,
-                        scale_ptr, stretch_ptr, twist)
+    cdef float c_rot = rot, c_shear = shear, c_twist = twist
+    with nogil:
+        fastwarp3d_opt_zxy(in_ptr, out_ptr, in_sh_ptr, ps_ptr, c_rot, c_shear,
+                           scale_ptr, stretch_ptr, c_twist)
     # out_arr = out_arr.astype(np.int16)[:,0]
     return out_arr
@@ -235,9 +235,11 @@ def getRequiredPatchSize(patch_size, rot, shear, scale, stretch, twist=None):
     return req_size.astype(np.int), eff_size.astype(np.int), left_exc.astype(np.int)
 
 
-def getWarpParams(patch_size, amount=1.0, **kwargs):
+def getWarpParams(patch_size, amount=1.0, rng=np.random, **kwargs):
     """
     To be called from CNNData. Get warping parameters + required warping input patch size.
+
+    rng is the source of random numbers (numpy.random or RandomContext).
     """
     if amount > 1:
         print 'WARNING: warpAugment amount > 1 this requires more than 1.4 bigger patches before warping'
@@ -251,17 +253,17 @@ def getWarpParams(patch_size, amount=1.0, **kwargs):
     if 'scale_max' in kwargs:
        scale_max = kwargs['scale_max']
 
-    shear = shear_max * 2 * (np.random.rand() - 0.5)
+    shear = shear_max * 2 * (rng.rand() - 0.5)
     if n_dim == 3:
-        twist = rot_max * 2 * (np.random.rand() - 0.5)
-        rot = min(rot_max - abs(twist), rot_max * (np.random.rand()))
-        scale = 1 - (scale_max - 1) * np.random.rand()
+        twist = rot_max * 2 * (rng.rand() - 0.5)
+        rot = min(rot_max - abs(twist), rot_max * (rng.rand()))
+        scale = 1 - (scale_max - 1) * rng.rand()
         scale = (scale, scale, 1)
-        stretch = stretch_max * 2 * (np.random.rand(4) - 0.5)
+        stretch = stretch_max * 2 * (rng.rand(4) - 0.5)
     elif n_dim == 2:
-        rot = rot_max * 2 * (np.random.rand() - 0.5)
-        scale = 1 - (scale_max - 1) * np.random.rand(2)
-        stretch = stretch_max * 2 * (np.random.rand(2) - 0.5)
+        rot = rot_max * 2 * (rng.rand() - 0.5)
+        scale = 1 - (scale_max - 1) * rng.rand(2)
+        stretch = stretch_max * 2 * (rng.rand(2) - 0.5)
         twist = None
 
     # DEBUG